@@ -1,22 +1,37 @@
-from flask import Flask, render_template, request, send_file, jsonify
+import time
+_IMPORT_STARTED = time.perf_counter()  # для времени запуска в /health
+
+from flask import Flask, Request, Response, g, render_template, request, send_file, jsonify, stream_with_context
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 import os
 import io
-import time
 import logging
 import traceback
+import threading
 from pathlib import Path
 from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas as rl_canvas
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.utils import ImageReader
 import tempfile
 import base64
-from PIL import Image, ImageDraw, ImageFont
+import hashlib
+import PIL
+from PIL import Image
 import json
+import metrics
+import geometry
+import previews
+import profiling
+import stamp_rules
+from batch_engine import iter_batch, resolve_workers, run_batch
+from caching import ArtifactFile, DiskCache, LRUCache, TieredCache
+from jobs import DiskResultStore, JobManager
+from uploads import BudgetExceeded, InflightBudget, check_pdf_bytes, pdf_stream_error
+from streaming import ZIP_COMPRESSION, iter_multipart, iter_zip, new_boundary
+from pdf_images import encode_image, encode_png, opacity_bucket, pack_image, unpack_image, EncodedImage, OPACITY_STEP
+from pdf_incremental import CopyThroughWriter, IncrementalUpdateUnsupported, IncrementalWriter, find_page, page_count
+from pdf_stamping import StampSession
+from pdf_vector import load_vector_source, with_opacity
+from seal_assets import asset, fit, load_source, resize, resolution_tier, scale_alpha, tier_size
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -39,121 +54,228 @@ def pt_to_mm(v):
 
 def pil_to_png_bytes(pil_img: Image.Image, opacity: float = 1.0) -> bytes:
     """PIL.Image -> PNG bytes, с учётом общей прозрачности."""
-    img = pil_img.convert("RGBA")
-    if opacity < 0.999:
-        r,g,b,a = img.split()
-        a = a.point(lambda v: int(v * opacity))
-        img = Image.merge("RGBA", (r,g,b,a))
+    img = scale_alpha(pil_img, opacity)
     buf = io.BytesIO()
-    img.save(buf, "PNG", optimize=False, compress_level=0)
+    img.save(buf, "PNG", compress_level=6)
     return buf.getvalue()
 
-def draw_png_bytes(c, png_bytes: bytes, x, y, w, h):
-    """Каждый вызов — НОВЫЙ BytesIO, иначе ReportLab может читать "середину" буфера."""
-    # Проверяем, что PNG байты корректны
-    if not png_bytes or len(png_bytes) < 100:
+def stamp_image(it):
+    """Закодированное изображение элемента: готовое (image) или из PNG (png_bytes)"""
+    if it.get("image") is not None:
+        return it["image"]
+    png_bytes = it.get("png_bytes")
+    if not png_bytes or not png_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
         raise ValueError(f"Invalid PNG bytes: length={len(png_bytes) if png_bytes else 0}")
-    
-    # Проверяем, что это действительно PNG
-    if not png_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
-        raise ValueError("Not a valid PNG file")
-    
-    bio = io.BytesIO(png_bytes)
-    bio.seek(0)
-    c.drawImage(ImageReader(bio), x, y, width=w, height=h, mask='auto')
-
-def make_overlay(page_w, page_h, items):
-    """items: [{png_bytes,x,y,w,h}] -> overlay PDF page"""
-    packet = io.BytesIO()
-    c = rl_canvas.Canvas(packet, pagesize=(page_w, page_h))
-    for it in items:
-        draw_png_bytes(c, it["png_bytes"], it["x"], it["y"], it["w"], it["h"])
-    c.showPage(); c.save(); packet.seek(0)
-    return PdfReader(packet).pages[0]
+    return encode_png(png_bytes)
+
+def seal_cache_key(seal_type, add_signature=False, opacity=1.0):
+    """Идентификатор изображения печати для ключей кешей"""
+    return (seal_type, bool(add_signature), round(float(opacity), 3))
 
 def normalize_rect_visual_to_user(page, x, y, w, h):
     """
     x,y,w,h — в pt от визуального нижнего-левого угла.
     Возвращает координаты в user-space страницы с учётом /Rotate и CropBox.
-    Для 90°/270° корректно меняем w↔h.
+    Для 90°/270° w↔h меняются местами.
+    """
+    nx, ny, nw, nh = geometry.visual_to_user(geometry.page_geometry(page), (x,), (y,), (w,), (h,))
+    return nx[0], ny[0], nw[0], nh[0]
+
+def stamp_placements(page, items):
     """
-    pw = float(page.mediabox.width)
-    ph = float(page.mediabox.height)
-    rot = int(page.get("/Rotate", 0)) % 360
-
-    if rot == 0:
-        nx, ny, nw, nh = x, y, w, h
-    elif rot == 90:
-        nx = y
-        ny = pw - (x + w)
-        nw, nh = h, w   # swap
-    elif rot == 180:
-        nx = pw - (x + w)
-        ny = ph - (y + h)
-        nw, nh = w, h
-    elif rot == 270:
-        nx = ph - (y + h)
-        ny = x
-        nw, nh = h, w   # swap
+    items в визуальных координатах -> geometry.Placements в user-space страницы:
+    боксы страницы читаются один раз, все прямоугольники пересчитываются и прижимаются к CropBox вместе
+    """
+    page_geometry = geometry.page_geometry(page)
+    placements = geometry.place_items(page_geometry, items, stamp_image)
+    # Логирование для отладки — одна строка на страницу (форматируется только при уровне DEBUG)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"geometry= {page_geometry}, "
+                      f"in= {[(it['x'], it['y'], it['w'], it['h']) for it in items]}, "
+                      f"norm= {list(zip(placements.x, placements.y, placements.w, placements.h))}")
+    return placements
+
+def stamp_page(session, page, items, target=None):
+    """
+    Накладывает items на страницу page (или на её копию target в выходном документе).
+    Этапы — нормализация координат, встраивание изображений и правка страницы — замеряются отдельно.
+    """
+    with metrics.timed('normalize'):
+        placements = stamp_placements(page, items)
+    with metrics.timed('overlay_build'):
+        for encoded, *_ in placements:
+            session.image(encoded)
+    with metrics.timed('page_merge'):
+        session.stamp(page if target is None else target, placements)
+
+def record_document(reader, pdf_data, pages):
+    """Учитывает обработанный документ в метриках (и в профиле запроса, если он снимается)"""
+    objects = sum(len(table) for table in reader.xref.values()) + len(reader.xref_objStm)
+    if hasattr(pdf_data, 'seek'):
+        position = pdf_data.tell()
+        size = pdf_data.seek(0, os.SEEK_END)
+        pdf_data.seek(position)
     else:
-        nx, ny, nw, nh = x, y, w, h
-
-    # CropBox offset
-    crop = page.cropbox
-    nx += float(crop.lower_left[0])
-    ny += float(crop.lower_left[1])
-    return nx, ny, nw, nh
-
-def merge_on_page(page, items):
-    """Корректно учитываем CropBox и Rotate без поворота оверлея."""
-    pw, ph = float(page.mediabox.width), float(page.mediabox.height)
-
-    # Нормализуем координаты для каждого элемента
-    normalized_items = []
-    for i, it in enumerate(items):
-        nx, ny, nw, nh = normalize_rect_visual_to_user(page, it["x"], it["y"], it["w"], it["h"])
-        
-        # Защитные бортики: clamp в границы страницы
-        nx = max(0.0, min(nx, pw - nw))
-        ny = max(0.0, min(ny, ph - nh))
-        
-        # Проверяем размеры
-        if nw <= 0 or nh <= 0 or nw > pw*2 or nh > ph*2:
-            raise ValueError(f"Invalid size: {(nw,nh)} for page {(pw,ph)}")
-        
-        # Логирование для отладки
-        logging.info(f"rot= {int(page.get('/Rotate', 0))}, "
-              f"in= ({it['x']:.2f}, {it['y']:.2f}, {it['w']:.2f}, {it['h']:.2f}), "
-              f"norm= ({nx:.2f}, {ny:.2f}, {nw:.2f}, {nh:.2f}), "
-              f"mb= ({pw:.2f}, {ph:.2f}), "
-              f"crop= ({float(page.cropbox.lower_left[0]):.2f}, {float(page.cropbox.lower_left[1]):.2f})")
-        
-        normalized_items.append({
-            "png_bytes": it["png_bytes"],
-            "x": nx,
-            "y": ny,
-            "w": nw,
-            "h": nh
-        })
+        size = len(pdf_data)
+    metrics.count_document(pages, objects, size)
 
-    # Создаем оверлей с нормализованными координатами
-    overlay_page = make_overlay(pw, ph, normalized_items)
+def stamp_pdf_rewrite(pdf_data, reader, items_by_page, output_pdf=None):
+    """
+    Полная перезапись документа. Каждое изображение печати встраивается один раз
+    и используется всеми страницами (StampSession), CropBox и Rotate учитываются
+    пересчётом координат — страница не поворачивается.
+
+    Быстрый путь (CopyThroughWriter): разбираются только страницы с печатями,
+    остальные объекты копируются побайтно — время зависит от числа печатей,
+    а не от числа страниц. Если исходник для него не подходит — PdfWriter.
+    """
+    try:
+        with metrics.timed('xref_scan'):
+            rewrite = CopyThroughWriter(pdf_data, reader)
+    except IncrementalUpdateUnsupported as e:
+        logging.info(f"Copy-through rewrite unavailable, using PdfWriter: {e}")
+    else:
+        session = StampSession(rewrite.add_object, rewrite.update_object)
+        total = page_count(reader)
+        for index, items in items_by_page.items():
+            if items and 0 <= index < total:
+                with metrics.timed('page_lookup'):
+                    page = find_page(reader, index)
+                stamp_page(session, page, items)
+        record_document(reader, pdf_data, total)
+        return write_pdf_output(output_pdf, rewrite.write)
 
-    # НЕ поворачиваем оверлей - вся магия в пересчете координат
-    page.merge_page(overlay_page)
+    writer = PdfWriter()
+    session = StampSession(writer._add_object)
+    with metrics.timed('parse'):
+        pages = reader.pages
+        total = len(pages)
+    for i, page in enumerate(pages):
+        out_page = writer.add_page(page)
+        if items_by_page.get(i):
+            stamp_page(session, page, items_by_page[i], out_page)
+    record_document(reader, pdf_data, total)
+    return write_pdf_output(output_pdf, writer.write)
+
+# Режимы сохранения: полная перезапись документа или инкрементальное дописывание
+OUTPUT_MODES = ('rewrite', 'incremental')
+DEFAULT_OUTPUT_MODE = os.environ.get('DEFAULT_OUTPUT_MODE', 'rewrite')
+
+def resolve_output_mode(output_mode=None):
+    """Проверяет режим сохранения, None -> режим по умолчанию"""
+    output_mode = output_mode or DEFAULT_OUTPUT_MODE
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode: {output_mode} (expected one of {', '.join(OUTPUT_MODES)})")
+    return output_mode
+
+def stamp_pdf_incremental(pdf_data, items_by_page, reader=None, output_pdf=None):
+    """
+    Дописывает печати в конец PDF отдельной ревизией: только изменённые страницы,
+    новые изображения и новая секция xref. Стоимость зависит от числа печатей, а не от размера документа.
+
+    Args:
+        pdf_data: исходный PDF (bytes/memoryview или seekable файл, см. open_pdf_input)
+        items_by_page: {индекс страницы (0-based): [{image | png_bytes, x, y, w, h}]}
+        reader: уже открытый PdfReader над теми же данными (необязательно)
+        output_pdf: путь, файлоподобный объект или None — вернуть bytes
+    """
+    update = IncrementalWriter(pdf_data, reader)
+    session = StampSession(update.add_object, update.update_object)
+    total = page_count(update.reader)
+    for index, items in items_by_page.items():
+        if not 0 <= index < total:
+            continue
+        # Разбираем только страницы с печатями, а не всё дерево страниц
+        with metrics.timed('page_lookup'):
+            page = find_page(update.reader, index)
+        stamp_page(session, page, items)
+    record_document(update.reader, pdf_data, total)
+    return write_pdf_output(output_pdf, update.write)
+
+# Порог, выше которого загрузки и входные потоки не копируются в память, а остаются во временном файле
+SPOOL_THRESHOLD = int(os.environ.get('SPOOL_THRESHOLD_MB', 8)) * 1024 * 1024
+
+def open_pdf_input(src):
+    """
+    Источник PDF -> (данные для IncrementalWriter, поток для PdfReader) без временных файлов.
+
+    src: путь, bytes/bytearray/memoryview или файлоподобный объект с read().
+    Потоки больше SPOOL_THRESHOLD используются как есть, без чтения в память.
+    """
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as f:
+            src = f.read()
+    elif hasattr(src, 'read'):
+        if hasattr(src, 'seek'):
+            src.seek(0, os.SEEK_END)
+            size = src.tell()
+            src.seek(0)
+            if size > SPOOL_THRESHOLD:
+                return src, src
+        src = src.read()
+    # BytesIO поверх bytes не копирует буфер, пока в него не пишут
+    return src, io.BytesIO(src)
+
+def write_pdf_output(output_pdf, write):
+    """
+    Пишет результат через write(stream).
+    output_pdf: путь, файлоподобный объект или None — тогда возвращаются bytes.
+    """
+    with metrics.timed('write'):
+        if output_pdf is None:
+            buf = io.BytesIO()
+            write(buf)
+            return buf.getvalue()
+        if isinstance(output_pdf, (str, os.PathLike)):
+            with open(output_pdf, 'wb') as output_file:
+                write(output_file)
+            return None
+        write(output_pdf)
+        return None
+
+def _try_incremental(pdf_data, reader, items_by_page, output_pdf):
+    """Инкрементальное сохранение; (False, None) — документ не поддерживает режим (нужна перезапись)"""
+    try:
+        return True, stamp_pdf_incremental(pdf_data, items_by_page, reader, output_pdf)
+    except IncrementalUpdateUnsupported as e:
+        logging.warning(f"Incremental save unavailable, falling back to rewrite: {e}")
+        return False, None
 
 # Предкеш PNG печатей для производительности (будет инициализирован после определения функций)
 SEAL_BYTES_FALCON = None
 SEAL_BYTES_FALCON_SIGNATURE = None
 SEAL_BYTES_IP = None
 SEAL_BYTES_IP_SIGNATURE = None
+SEAL_ASSETS_DIGEST = ""  # хеш изображений печатей — входит в ключ кеша результатов
+SEAL_RENDER_VERSION = b"trimmed-v1"  # меняется при изменении способа встраивания печатей
+
+# Сколько памяти под загруженные файлы может занять один запрос (остальное — во временных файлах)
+UPLOAD_MEMORY_BYTES = int(os.environ.get('UPLOAD_MEMORY_MB', 16)) * 1024 * 1024
+
+class SpoolingRequest(Request):
+    """
+    Части multipart пишутся сразу в спул: в памяти до SPOOL_THRESHOLD на файл и не больше
+    UPLOAD_MEMORY_BYTES на все файлы запроса, дальше — во временных файлах
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        memory = getattr(self, '_spool_memory', UPLOAD_MEMORY_BYTES)
+        max_size = min(SPOOL_THRESHOLD, memory)
+        if max_size <= 0:
+            return tempfile.TemporaryFile(mode='w+b')
+        self._spool_memory = memory - max_size
+        return tempfile.SpooledTemporaryFile(max_size=max_size, mode='rb+')
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64MB max file size for batch processing
-app.config['UPLOAD_FOLDER'] = 'uploads'
 
-# Создаем папку для загрузок если её нет
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Число обратных прокси перед приложением. Адрес клиента (request.remote_addr) берётся из
+# X-Forwarded-For только на столько шагов, сколько добавили наши прокси: левые записи
+# заголовка присылает сам клиент, и доверять им нельзя. 0 — прокси нет, заголовок не читается
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
 
 # Инициализируем кеш печатей при создании приложения (для Gunicorn)
 try:
@@ -165,7 +287,8 @@ except Exception as e:
 @app.errorhandler(413)
 def too_large(e):
     """Обработчик ошибки превышения размера файла"""
-    return jsonify({'error': 'Файл слишком большой. Максимальный размер: 16 МБ'}), 413
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({'error': f'Файл слишком большой. Максимальный размер: {limit_mb} МБ'}), 413
 
 @app.errorhandler(500)
 def internal_error(e):
@@ -177,48 +300,116 @@ def not_found(e):
     """Обработчик ошибки 404"""
     return jsonify({'error': 'Страница не найдена'}), 404
 
-def _img_with_opacity(pil_img: Image.Image, opacity: float) -> Image.Image:
-    """Применяет прозрачность к изображению"""
-    if opacity >= 0.999:
-        return pil_img
-    pil_img = pil_img.convert("RGBA")
-    r, g, b, a = pil_img.split()
-    a = a.point(lambda v: int(v * opacity))
-    return Image.merge("RGBA", (r, g, b, a))
-
-def _make_overlay(page_w_pt, page_h_pt, seals_for_page, stamp_factory):
-    """Создаёт PDF-оверлей размера страницы и рисует все печати."""
-    packet = io.BytesIO()
-    c = rl_canvas.Canvas(packet, pagesize=(page_w_pt, page_h_pt))
-
-    for seal in seals_for_page:
-        x_pt = float(seal['xPt'])
-        y_pt = float(seal['yPt'])
-        w_pt = float(seal['wPt'])
-        h_pt = float(seal['hPt'])
-        opacity = float(seal.get('opacity', 1.0))
-        seal_type = seal.get('type', 'falcon')
-
-        # Используем предкешированные PNG байты
-        if seal_type == "falcon":
-            seal_bytes = SEAL_BYTES_FALCON
-        else:  # ip
-            seal_bytes = SEAL_BYTES_IP
-
-        # Применяем прозрачность
-        if opacity < 0.999:
-            # Создаем временное изображение с прозрачностью
-            img = Image.open(io.BytesIO(seal_bytes))
-            img = _img_with_opacity(img, opacity)
-            seal_bytes = pil_to_png_bytes(img)
-
-        # Рисуем с использованием новой функции
-        draw_png_bytes(c, seal_bytes, x_pt, y_pt, w_pt, h_pt)
-
-    c.showPage()
-    c.save()
-    packet.seek(0)
-    return PdfReader(packet)
+# Эндпоинты, медленные запросы к которым профилируются при PROFILE_SLOW_MS > 0
+PROFILED_ENDPOINTS = {'save_document', 'save_document_session', 'stamp_document_rules', 'batch_stamp',
+                      'batch_process_files'}
+
+# Эндпоинты, которым нужен кеш печатей (в режиме SEAL_CACHE_INIT=lazy он строится при первом из них)
+SEAL_ENDPOINTS = {'upload_file', 'save_document', 'save_document_session', 'stamp_document_rules',
+                  'preview_placements', 'batch_process_files', 'batch_stamp'}
+
+# Бюджет байт тел запросов, обрабатываемых одновременно: общий и на один адрес клиента.
+# Размер запроса — Content-Length (без него — MAX_CONTENT_LENGTH)
+UPLOAD_ENDPOINTS = {'upload_file', 'save_document', 'batch_process_files', 'batch_stamp', 'create_document'}
+UPLOAD_BUDGET = InflightBudget(
+    total_bytes=int(os.environ.get('UPLOAD_INFLIGHT_MB', 256)) * 1024 * 1024,
+    client_bytes=int(os.environ.get('UPLOAD_CLIENT_INFLIGHT_MB', 128)) * 1024 * 1024,
+    wait=float(os.environ.get('UPLOAD_WAIT_SECONDS', 2)),
+    retry_after=int(os.environ.get('UPLOAD_RETRY_AFTER', 5)),
+)
+UPLOAD_REJECTIONS = metrics.REGISTRY.register(metrics.Counter(
+    'falcon_upload_rejections_total', 'Запросы, отклонённые из-за бюджета загрузок', ['status']))
+metrics.REGISTRY.register(metrics.Gauges(
+    'falcon_upload_inflight_bytes', 'Байты тел запросов в обработке', [],
+    lambda: {(): UPLOAD_BUDGET.in_use}))
+
+@app.before_request
+def admit_upload():
+    """Резервирует бюджет до чтения тела запроса; при нехватке — 429/503 с Retry-After"""
+    if request.endpoint not in UPLOAD_ENDPOINTS:
+        return None
+    size = request.content_length or app.config['MAX_CONTENT_LENGTH']
+    try:
+        g.upload_budget = UPLOAD_BUDGET.acquire(size, request.remote_addr)
+    except BudgetExceeded as e:
+        UPLOAD_REJECTIONS.inc(status=e.status)
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.status_code = e.status
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+@app.after_request
+def hold_upload_budget(response):
+    # Потоковый ответ ещё читает загруженные файлы — бюджет освобождается, когда сервер закроет ответ
+    if response.is_streamed and 'upload_budget' in g:
+        token = g.pop('upload_budget')
+        response.call_on_close(lambda: UPLOAD_BUDGET.release(token))
+    return response
+
+@app.teardown_request
+def release_upload(exc=None):
+    token = g.pop('upload_budget', None)
+    if token is not None:
+        UPLOAD_BUDGET.release(token)
+
+@app.before_request
+def prepare_seal_cache():
+    if request.endpoint in SEAL_ENDPOINTS:
+        ensure_seal_cache()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.set_endpoint(request.endpoint or 'unknown')
+    if request.content_length:
+        metrics.BYTES_IN.inc(request.content_length, endpoint=request.endpoint or 'unknown')
+    if request.endpoint in PROFILED_ENDPOINTS and profiling.should_profile():
+        g.profiler = profiling.begin()
+        metrics.track_documents(g.profiler.documents)
+
+def finish_request_profile(profiler, meta):
+    metrics.track_documents(None)
+    profiling.end(profiler, meta)
+
+def _count_response_bytes(chunks, endpoint, profile=None):
+    """Считает байты потокового ответа по мере отдачи; профиль запроса закрывается в конце потока"""
+    try:
+        for chunk in chunks:
+            metrics.BYTES_OUT.inc(len(chunk), endpoint=endpoint)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if profile is not None:
+            finish_request_profile(*profile)
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'request_started' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+
+    profile = None
+    if 'profiler' in g:
+        profile = (g.pop('profiler'), {
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'request_bytes': request.content_length,
+        })
+
+    if response.content_length is not None:
+        metrics.BYTES_OUT.inc(response.content_length, endpoint=endpoint)
+    elif response.is_streamed and not response.direct_passthrough:
+        # Потоковый ответ обрабатывается уже после after_request — профиль снимаем до конца потока
+        response.response = _count_response_bytes(response.response, endpoint, profile)
+        profile = None
+    if profile is not None:
+        finish_request_profile(*profile)
+    return response
 
 # Настройки печати ФАЛКОН-ТРАНС
 COMPANY_NAME = "ФАЛКОН-ТРАНС"
@@ -227,22 +418,40 @@ OGRN = "ОГРН 1127746519306"
 CITY = "МОСКВА"
 DIRECTOR_NAME = "Заикин С.С."
 
+# Реестр печатей. image — растровый исходник (PNG); vector — одностраничный PDF или SVG
+# (нужен svglib), который встраивается как Form XObject вместо PNG, если файл есть.
+# Блоки с подписью остаются растровыми. static/images/falcon_seal.svg — эскиз, который
+# не совпадает с печатью из PNG, поэтому по умолчанию не подключён
+SEAL_REGISTRY = {
+    'falcon': {
+        'name': 'ФАЛКОН-ТРАНС (ООО)',
+        'type': 'company',
+        'description': 'Официальная печать компании ФАЛКОН-ТРАНС',
+        'image': 'static/images/falcon_seal.png',
+        'vector': os.environ.get('SEAL_VECTOR_FALCON', 'static/images/falcon_seal.pdf'),
+    },
+    'ip': {
+        'name': 'ИП Заикина',
+        'type': 'individual',
+        'description': 'Печать индивидуального предпринимателя',
+        'image': 'static/images/ip_seal.png',
+        'vector': os.environ.get('SEAL_VECTOR_IP', 'static/images/ip_seal.pdf'),
+    },
+}
+
+def vector_seal(seal_type):
+    """Векторная печать (VectorSeal) или None, если для печати есть только PNG"""
+    path = SEAL_REGISTRY.get(seal_type, SEAL_REGISTRY['falcon'])['vector']
+    return load_vector_source(path) if path else None
+
 def create_company_seal(seal_type="falcon"):
-    """Загружает готовое изображение печати"""
+    """Загружает готовое изображение печати (исходник с диска читается один раз, изменять его нельзя)"""
     try:
-        # Выбираем путь к печати в зависимости от типа
-        if seal_type == "falcon":
-            seal_path = "static/images/falcon_seal.png"
-        elif seal_type == "ip":
-            seal_path = "static/images/ip_seal.png"
-        else:
-            seal_path = "static/images/falcon_seal.png"  # По умолчанию
+        # Выбираем путь к печати в зависимости от типа (неизвестный тип — печать ФАЛКОН-ТРАНС)
+        seal_path = SEAL_REGISTRY.get(seal_type, SEAL_REGISTRY['falcon'])['image']
 
-        if os.path.exists(seal_path):
-            img = Image.open(seal_path)
-            # Конвертируем в RGBA если нужно
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
+        img = load_source(seal_path)
+        if img is not None:
             return img
         else:
             # Если файл не найден, создаем простую заглушку
@@ -250,6 +459,7 @@ def create_company_seal(seal_type="falcon"):
             print(f"Создаем простую заглушку. Загрузите файл {os.path.basename(seal_path)} в папку static/images/")
 
             # Создаем простую заглушку
+            from PIL import ImageDraw, ImageFont
             size = 200
             img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
             draw = ImageDraw.Draw(img)
@@ -276,6 +486,7 @@ def create_company_seal(seal_type="falcon"):
     except Exception as e:
         print(f"Ошибка при загрузке печати: {e}")
         # Возвращаем простую заглушку в случае ошибки
+        from PIL import ImageDraw
         size = 200
         img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
@@ -290,26 +501,72 @@ def seal_png_bytes(seal_type, add_signature=False):
     if add_signature:
         img = create_signature_block(seal_type, add_signature)
     else:
-        # Для простых печатей используем create_company_seal
-        img = create_company_seal(seal_type)
-        # Масштабируем до нужного размера
-        original_width, original_height = img.size
-        max_width = 176
-        max_height = 136
-        width_ratio = max_width / original_width
-        height_ratio = max_height / original_height
-        scale_factor = min(width_ratio, height_ratio)
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
+        # Для простых печатей используем create_company_seal, масштабируя до нужного размера
+        img = fit(create_company_seal(seal_type), 176, 136)
+
     return pil_to_png_bytes(img)
 
-def initialize_seal_cache():
-    """Инициализирует кеш печатей"""
+# Готовые изображения печатей на диске: после перезапуска (или в новом экземпляре с тем же
+# каталогом) они читаются через mmap вместо повторной обработки. Пустое значение — не сохранять
+SEAL_ARTIFACT_DIR = os.environ.get('SEAL_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'falcon_seal_artifacts'))
+SEAL_ARTIFACTS = ArtifactFile(SEAL_ARTIFACT_DIR) if SEAL_ARTIFACT_DIR else None
+
+def seal_artifacts_version():
+    """Версия кеша печатей: хеш исходников из SEAL_REGISTRY и параметров отрисовки"""
+    digest = hashlib.sha256(SEAL_RENDER_VERSION + f":{SEAL_DPI}:{SEAL_MAX_UPSCALE}:{OPACITY_STEP}:"
+                                                  f"{PIL.__version__}".encode())
+    for seal_type, seal in sorted(SEAL_REGISTRY.items()):
+        for path in (seal['image'], seal['vector']):
+            try:
+                with open(path, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+            except (OSError, TypeError):
+                digest.update(b'-')
+    return digest.hexdigest()
+
+def load_seal_artifacts(version):
+    """Заполняет кеш печатей из файла артефактов; False — файла этой версии нет"""
     global SEAL_BYTES_FALCON, SEAL_BYTES_FALCON_SIGNATURE, SEAL_BYTES_IP, SEAL_BYTES_IP_SIGNATURE
+    records = SEAL_ARTIFACTS.load(version) if SEAL_ARTIFACTS is not None else None
+    if not records:
+        return False
+    png = {}
+    SEAL_IMAGE_CACHE.clear()
+    for key, meta, blobs in records:
+        if key[0] == 'png':
+            png[key[1:]] = bytes(blobs[0])
+        else:
+            SEAL_IMAGE_CACHE.put(key, unpack_image(meta, blobs))
+    SEAL_BYTES_FALCON, SEAL_BYTES_FALCON_SIGNATURE = png[('falcon', False)], png[('falcon', True)]
+    SEAL_BYTES_IP, SEAL_BYTES_IP_SIGNATURE = png[('ip', False)], png[('ip', True)]
+    print(f"✅ Seal artifacts loaded: {len(SEAL_IMAGE_CACHE)} variants from {SEAL_ARTIFACTS.path(version)}")
+    return True
+
+def save_seal_artifacts(version):
+    """Сохраняет PNG печатей и закодированные варианты из SEAL_IMAGE_CACHE (векторные не нужны)"""
+    if SEAL_ARTIFACTS is None:
+        return
+    records = [(('png', seal_type, add_signature), {}, [seal_png(seal_type, add_signature)])
+               for seal_type in ('falcon', 'ip') for add_signature in (False, True)]
+    for key, value in SEAL_IMAGE_CACHE.items():
+        if isinstance(value, EncodedImage):
+            records.append((key, *pack_image(value)))
+    if SEAL_ARTIFACTS.save(version, records):
+        print(f"✅ Seal artifacts saved: {SEAL_ARTIFACTS.path(version)}")
+
+def initialize_seal_cache():
+    """Инициализирует кеш печатей: из файла артефактов, если он есть, иначе из исходников"""
+    global SEAL_BYTES_FALCON, SEAL_BYTES_FALCON_SIGNATURE, SEAL_BYTES_IP, SEAL_BYTES_IP_SIGNATURE, SEAL_ASSETS_DIGEST
     try:
         print("🔄 Initializing seal cache...")
+        version = seal_artifacts_version()
+        for seal_type in SEAL_REGISTRY:
+            if vector_seal(seal_type) is not None:
+                print(f"✅ {seal_type.upper()} vector seal: {SEAL_REGISTRY[seal_type]['vector']}")
+        if load_seal_artifacts(version):
+            SEAL_ASSETS_DIGEST = version
+            print("🎉 Seal cache initialization completed successfully")
+            return
         SEAL_BYTES_FALCON = seal_png_bytes('falcon', False)
         print(f"✅ FALCON seal: {len(SEAL_BYTES_FALCON)} bytes")
         SEAL_BYTES_FALCON_SIGNATURE = seal_png_bytes('falcon', True)
@@ -318,6 +575,9 @@ def initialize_seal_cache():
         print(f"✅ IP seal: {len(SEAL_BYTES_IP)} bytes")
         SEAL_BYTES_IP_SIGNATURE = seal_png_bytes('ip', True)
         print(f"✅ IP signature: {len(SEAL_BYTES_IP_SIGNATURE)} bytes")
+        SEAL_ASSETS_DIGEST = version
+        prepare_seal_images()
+        save_seal_artifacts(version)
         print("🎉 Seal cache initialization completed successfully")
     except Exception as e:
         print(f"❌ Error initializing seal cache: {e}")
@@ -325,31 +585,104 @@ def initialize_seal_cache():
         traceback.print_exc()
         raise
 
-def create_signature_block(seal_type="falcon", add_signature=False):
-    """Создает блок с печатью и опционально подписью"""
-    # Загружаем оригинальную печать
-    seal = create_company_seal(seal_type)
+def seal_png(seal_type, add_signature=False):
+    """PNG печати из предкеша"""
+    if seal_type == "falcon":
+        return SEAL_BYTES_FALCON_SIGNATURE if add_signature else SEAL_BYTES_FALCON
+    return SEAL_BYTES_IP_SIGNATURE if add_signature else SEAL_BYTES_IP
+
+# Готовые к вставке изображения печатей: (печать, подпись, ступень прозрачности[, ступень разрешения]) -> EncodedImage
+SEAL_IMAGE_CACHE = LRUCache(maxsize=int(os.environ.get('SEAL_IMAGE_CACHE_SIZE', 256)))
 
-    # Масштабирование с сохранением пропорций (как в pdf_processor.py)
-    original_width, original_height = seal.size
-    max_width = 176  # Финальный размер из pdf_processor.py
-    max_height = 136  # Финальный размер из pdf_processor.py
+# Разрешение печатей: пиксели подбираются под физический размер печати при SEAL_DPI.
+# Выше разрешения исходника (× SEAL_MAX_UPSCALE) не масштабируем — деталей это не добавит
+SEAL_DPI = int(os.environ.get('SEAL_DPI', 200))
+SEAL_MAX_UPSCALE = float(os.environ.get('SEAL_MAX_UPSCALE', 1.0))
 
-    # Вычисляем коэффициент масштабирования (как в pdf_processor.py)
-    width_ratio = max_width / original_width
-    height_ratio = max_height / original_height
-    scale_factor = min(width_ratio, height_ratio)  # Меньший коэффициент для сохранения пропорций
+def seal_source(seal_type, add_signature=False):
+    """Исходник для ступеней разрешения: печать в исходном размере или блок с подписью"""
+    if add_signature:
+        return create_signature_block(seal_type, True)
+    return create_company_seal(seal_type)
+
+def seal_tier(seal_type, add_signature, width_pt, height_pt):
+    """Ступень разрешения для печати размером width_pt × height_pt"""
+    source = seal_source(seal_type, add_signature)
+    return resolution_tier(source.size, width_pt, height_pt, SEAL_DPI, SEAL_MAX_UPSCALE)
+
+def seal_image(seal_type, add_signature=False, opacity=1.0, width_pt=None, height_pt=None):
+    """
+    Закодированное изображение печати; прозрачность округляется до OPACITY_STEP.
+    С размером печати (width_pt, height_pt) разрешение берётся из ближайшей ступени
+    под SEAL_DPI, без размера — стандартный вариант 176×136. Если у печати есть
+    векторный исходник, возвращается VectorSeal — размер для него не важен.
+    """
+    seal_type = "falcon" if seal_type == "falcon" else "ip"
+    opacity = opacity_bucket(opacity)
+    vector = None if add_signature else vector_seal(seal_type)
+    if vector is not None:
+        return SEAL_IMAGE_CACHE.get_or_build(('vector', seal_type, opacity, vector.digest),
+                                             lambda: with_opacity(vector, opacity))
+    tier = seal_tier(seal_type, add_signature, width_pt, height_pt) if width_pt and height_pt else None
+    key = seal_cache_key(seal_type, add_signature, opacity) + ((tier,) if tier is not None else ())
+
+    def build():
+        if tier is None:
+            img = Image.open(io.BytesIO(seal_png(seal_type, add_signature)))
+        else:
+            source = seal_source(seal_type, add_signature)
+            img = resize(source, tier_size(source.size, tier))
+        # Цвет у всех вариантов прозрачности общий — пересчитывается только альфа-канал
+        rgb = SEAL_IMAGE_CACHE.get_or_build(key[:2] + (1.0,) + key[3:], lambda: encode_image(img, trim_borders=True)).rgb \
+            if opacity < 1.0 else None
+        return encode_image(img, opacity, rgb=rgb, trim_borders=True)
+
+    return SEAL_IMAGE_CACHE.get_or_build(key, build)
+
+def signature_block_image(seal_type, add_signature=False):
+    """Закодированный блок create_signature_block (для /upload), строится один раз"""
+    seal_type = seal_type if seal_type in ("falcon", "ip") else "falcon"
+    return SEAL_IMAGE_CACHE.get_or_build(
+        ('block', seal_type, bool(add_signature)),
+        lambda: encode_image(create_signature_block(seal_type, add_signature), trim_borders=True))
+
+def prepare_seal_images():
+    """
+    Кодирует печати заранее: все ступени прозрачности для печатей редактора
+    и непрозрачные блоки с подписью. Процессы пула получают их от сервера forkserver
+    (см. batch_engine), куда app загружается заранее.
+    """
+    SEAL_IMAGE_CACHE.clear()
+    steps = int(round(1 / OPACITY_STEP))
+    for seal_type in ("falcon", "ip"):
+        for step in range(steps + 1):
+            seal_image(seal_type, False, step * OPACITY_STEP)
+        seal_image(seal_type, True)
+        for add_signature in (False, True):
+            signature_block_image(seal_type, add_signature)
+        # Ступень для размера печати /batch-stamp по умолчанию
+        seal_image(seal_type, False, 1.0, mm(46.4), mm(35.9))
+    print(f"✅ Seal images encoded: {len(SEAL_IMAGE_CACHE)} variants")
 
-    # Новые размеры
-    new_width = int(original_width * scale_factor)
-    new_height = int(original_height * scale_factor)
+def create_signature_block(seal_type="falcon", add_signature=False):
+    """
+    Блок с печатью и опционально подписью. Собирается один раз на вариант
+    (ASSET_CACHE); возвращаемое изображение общее — изменять его нельзя.
+    """
+    seal_type = seal_type if seal_type in ("falcon", "ip") else "falcon"
+    return asset(('signature_block', seal_type, bool(add_signature)),
+                 lambda: _render_signature_block(seal_type, add_signature))
 
-    # Изменяем размер печати с высоким качеством (без размытия)
-    seal = seal.resize((new_width, new_height), Image.Resampling.LANCZOS)
+def _render_signature_block(seal_type, add_signature):
+    # Масштабирование с сохранением пропорций до финального размера 176×136
+    # (LANCZOS в премультиплицированном виде — без тёмных ореолов по краям)
+    seal = fit(create_company_seal(seal_type), 176, 136)
+    new_width, new_height = seal.size
 
     # Создаем изображение с прозрачным фоном
     if add_signature:
         # Если нужна подпись, создаем больший блок
+        from PIL import ImageDraw, ImageFont
         img = Image.new('RGBA', (new_width + 200, new_height + 100), (0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
 
@@ -380,74 +713,55 @@ def create_signature_block(seal_type="falcon", add_signature=False):
 
 def find_signature_position(page_text):
     """Интеллектуальный поиск позиции для печати"""
-    signature_patterns = ['подпись', 'podpis', 'подпи', 'signature']
-    signature_keywords = ['подпис', 'директор', 'заикин']
-
-    # Ищем паттерны в тексте
-    signature_x = None
-    signature_y = None
-
-    # Простой поиск по ключевым словам
-    for pattern in signature_patterns + signature_keywords:
-        if pattern.lower() in page_text.lower():
+    # Простой поиск по ключевым словам (те же, что у правил с "text": true)
+    for pattern in stamp_rules.SIGNATURE_KEYWORDS:
+        if pattern in page_text.lower():
             # Если найдено, используем позицию на 1.5см выше и 3см левее
             return 50, 300  # x=50 (3см левее), y=300 (1.5см выше)
 
     # Если ничего не найдено, возвращаем резервную позицию
     return 20, 200  # Резервная позиция (левее и выше)
 
-def add_signature_to_pdf(input_pdf_path, output_pdf_path, seal_type="falcon", add_signature=False):
-    """Добавляет подпись и печать к PDF на последней странице"""
-    # Читаем исходный PDF
-    reader = PdfReader(input_pdf_path)
-    writer = PdfWriter()
+def add_signature_to_pdf(input_pdf, output_pdf=None, seal_type="falcon", add_signature=False, output_mode=None):
+    """
+    Добавляет подпись и печать к PDF на последней странице.
+    input_pdf/output_pdf — как в add_signature_to_pdf_batch; без output_pdf возвращает bytes.
+    """
+    output_mode = resolve_output_mode(output_mode)
 
-    # Получаем размеры страницы
-    page = reader.pages[0]
+    # Читаем исходный PDF
+    pdf_data, pdf_stream = open_pdf_input(input_pdf)
+    with metrics.timed('parse'):
+        reader = PdfReader(pdf_stream)
+        # Получаем размеры страницы (дерево страниц целиком не разбираем)
+        page = find_page(reader, 0)
+        last_index = page_count(reader) - 1
     page_width = float(page.mediabox.width)
     page_height = float(page.mediabox.height)
 
-    # Извлекаем текст с последней страницы для поиска позиции
-    last_page = reader.pages[-1]
-    try:
-        page_text = last_page.extract_text()
-    except:
-        page_text = ""
-
     # Используем стандартные координаты вместо интеллектуального поиска
+    # (текст страницы для find_signature_position не извлекаем — он не нужен)
     coordinates = get_standard_seal_coordinates(page_width, page_height, seal_type, add_signature)
     
-    # Создаем PNG байты печати
-    signature_block = create_signature_block(seal_type, add_signature)
-    seal_bytes = pil_to_png_bytes(signature_block)
-
-    # Получаем размеры печати из созданного изображения
-    signature_width = signature_block.size[0]
-    signature_height = signature_block.size[1]
-
-    # Обрабатываем все страницы
-    for page_num in range(len(reader.pages)):
-        page = reader.pages[page_num]
-        
-        # Добавляем подпись только на последнюю страницу
-        if page_num == len(reader.pages) - 1:
-            # Создаем items для merge_on_page
-            items = [{
-                "png_bytes": seal_bytes,
-                "x": coordinates['x'],
-                "y": coordinates['y'],
-                "w": coordinates['width'],
-                "h": coordinates['height']
-            }]
-            
-            # Используем новую функцию для корректной обработки
-            merge_on_page(page, items)
-        
-        writer.add_page(page)
-
-    # Сохраняем результат
-    with open(output_pdf_path, 'wb') as output_file:
-        writer.write(output_file)
+    # Кодируем изображение печати для вставки в PDF
+    with metrics.timed('seal_render'):
+        seal_image_data = signature_block_image(seal_type, add_signature)
+
+    items = [{
+        "image": seal_image_data,
+        "x": coordinates['x'],
+        "y": coordinates['y'],
+        "w": coordinates['width'],
+        "h": coordinates['height']
+    }]
+
+    if output_mode == 'incremental':
+        done, result = _try_incremental(pdf_data, reader, {last_index: items}, output_pdf)
+        if done:
+            return result
+
+    # Добавляем подпись только на последнюю страницу и сохраняем результат
+    return stamp_pdf_rewrite(pdf_data, reader, {last_index: items}, output_pdf)
 
 def get_standard_seal_coordinates(page_width_pt, page_height_pt, seal_type="falcon", add_signature=False):
     """
@@ -506,23 +820,27 @@ def get_standard_seal_coordinates(page_width_pt, page_height_pt, seal_type="falc
             'height': mm(SEAL_HEIGHT_MM * SCALE)    # увеличиваем в SCALE раз
         }
 
-def add_signature_to_pdf_batch(input_pdf_path, output_pdf_path, seal_type="falcon", add_signature=False, coordinates=None):
+def add_signature_to_pdf_batch(input_pdf, output_pdf=None, seal_type="falcon", add_signature=False, coordinates=None, output_mode=None):
     """
     Добавляет подпись и печать к PDF на последней странице с точными координатами
     
     Args:
-        input_pdf_path: путь к входному PDF
-        output_pdf_path: путь к выходному PDF
+        input_pdf: путь, bytes/memoryview или файлоподобный объект
+        output_pdf: путь, файлоподобный объект или None — вернуть bytes
         seal_type: тип печати ("falcon" или "ip")
         add_signature: добавлять ли подпись
         coordinates: словарь с координатами {x, y, width, height} в пунктах
+        output_mode: "rewrite" (по умолчанию) или "incremental"
     """
+    output_mode = resolve_output_mode(output_mode)
+
     # Читаем исходный PDF
-    reader = PdfReader(input_pdf_path)
-    writer = PdfWriter()
-    
-    # Получаем размеры страницы
-    page = reader.pages[0]
+    pdf_data, pdf_stream = open_pdf_input(input_pdf)
+    with metrics.timed('parse'):
+        reader = PdfReader(pdf_stream)
+        # Получаем размеры страницы (дерево страниц целиком не разбираем)
+        page = find_page(reader, 0)
+        last_index = page_count(reader) - 1
     page_width = float(page.mediabox.width)
     page_height = float(page.mediabox.height)
     
@@ -530,64 +848,212 @@ def add_signature_to_pdf_batch(input_pdf_path, output_pdf_path, seal_type="falco
     if coordinates is None:
         coordinates = get_standard_seal_coordinates(page_width, page_height, seal_type, add_signature)
     
-    # Выбираем предкешированные PNG байты
-    if seal_type == "falcon":
-        if add_signature:
-            seal_bytes = SEAL_BYTES_FALCON_SIGNATURE
-        else:
-            seal_bytes = SEAL_BYTES_FALCON
-    else:  # ip
-        if add_signature:
-            seal_bytes = SEAL_BYTES_IP_SIGNATURE
-        else:
-            seal_bytes = SEAL_BYTES_IP
-    
-    # Обрабатываем все страницы
-    for page_num in range(len(reader.pages)):
-        page = reader.pages[page_num]
-        
-        # Добавляем подпись только на последнюю страницу
-        if page_num == len(reader.pages) - 1:
-            # Создаем items для merge_on_page
-            items = [{
-                "png_bytes": seal_bytes,
-                "x": coordinates['x'],
-                "y": coordinates['y'],
-                "w": coordinates['width'],
-                "h": coordinates['height']
-            }]
-            
-            # Используем новую функцию для корректной обработки
-            merge_on_page(page, items)
-        
-        writer.add_page(page)
-    
-    # Сохраняем результат
-    with open(output_pdf_path, 'wb') as output_file:
-        writer.write(output_file)
+    # Берём заранее закодированное изображение печати
+    seal_type = "falcon" if seal_type == "falcon" else "ip"
+    items = [{
+        "image": seal_image(seal_type, add_signature, 1.0, coordinates['width'], coordinates['height']),
+        "x": coordinates['x'],
+        "y": coordinates['y'],
+        "w": coordinates['width'],
+        "h": coordinates['height']
+    }]
+
+    if output_mode == 'incremental':
+        done, result = _try_incremental(pdf_data, reader, {last_index: items}, output_pdf)
+        if done:
+            return result
+
+    # Добавляем подпись только на последнюю страницу и сохраняем результат
+    return stamp_pdf_rewrite(pdf_data, reader, {last_index: items}, output_pdf)
+
+def stamp_pdf_pages(input_pdf, items_by_page, output_pdf=None, output_mode=None):
+    """
+    Накладывает печати на произвольные страницы.
 
-def cleanup_old_files():
-    """Очищает старые файлы из папки uploads (старше 1 часа)"""
-    try:
-        upload_folder = app.config['UPLOAD_FOLDER']
-        if not os.path.exists(upload_folder):
-            return
+    Args:
+        input_pdf: путь, bytes/memoryview или файлоподобный объект
+        items_by_page: {индекс страницы (0-based): [{image | png_bytes, x, y, w, h}]}
+        output_pdf: путь, файлоподобный объект или None — вернуть bytes
+        output_mode: "rewrite" или "incremental"
+    """
+    output_mode = resolve_output_mode(output_mode)
+    pdf_data, pdf_stream = open_pdf_input(input_pdf)
+    with metrics.timed('parse'):
+        reader = PdfReader(pdf_stream)
+
+    if output_mode == 'incremental':
+        done, result = _try_incremental(pdf_data, reader, items_by_page, output_pdf)
+        if done:
+            return result
+
+    return stamp_pdf_rewrite(pdf_data, reader, items_by_page, output_pdf)
 
-        current_time = time.time()
-        max_age = 3600  # 1 час в секундах
-
-        for filename in os.listdir(upload_folder):
-            file_path = os.path.join(upload_folder, filename)
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getmtime(file_path)
-                if file_age > max_age:
-                    try:
-                        os.unlink(file_path)
-                        print(f"Удален старый файл: {filename}")
-                    except Exception as e:
-                        print(f"Ошибка при удалении файла {filename}: {e}")
+def rule_default_rect(rule):
+    """Стандартный прямоугольник (x, y, w, h) печати правила — как у add_signature_to_pdf"""
+    coordinates = get_standard_seal_coordinates(0, 0, rule.seal, rule.signature)
+    return coordinates['x'], coordinates['y'], coordinates['width'], coordinates['height']
+
+def page_text(reader, index):
+    """Текст страницы; если извлечь его не удалось (битый шрифт или поток) — пустая строка"""
+    try:
+        return find_page(reader, index).extract_text()
     except Exception as e:
-        print(f"Ошибка при очистке файлов: {e}")
+        logging.warning(f"Text extraction failed on page {index + 1}: {e}")
+        return ''
+
+
+def stamp_pdf_rules(input_pdf, rules, output_pdf=None, output_mode=None):
+    """
+    Накладывает печати по правилам (см. stamp_rules): страницы выбираются по номеру,
+    диапазону, чётности или тексту, все печати документа накладываются за один проход.
+
+    Args:
+        input_pdf: путь, bytes/memoryview или файлоподобный объект
+        rules: [stamp_rules.Rule] (из stamp_rules.parse_rules)
+        output_pdf: путь, файлоподобный объект или None — вернуть bytes
+        output_mode: "rewrite" или "incremental"
+    """
+    output_mode = resolve_output_mode(output_mode)
+    pdf_data, pdf_stream = open_pdf_input(input_pdf)
+    with metrics.timed('parse'):
+        reader = PdfReader(pdf_stream)
+        total = page_count(reader)
+
+    # Разбираются только выбранные страницы; текст извлекается лишь для правил с text
+    with metrics.timed('rules'):
+        planned = stamp_rules.plan(
+            rules, total,
+            lambda i: geometry.visual_size(geometry.page_geometry(find_page(reader, i))),
+            lambda i: page_text(reader, i),
+            rule_default_rect)
+
+    # Одинаковые печати разных страниц — одно изображение (StampSession встроит его один раз)
+    items_by_page = {
+        index: [{
+            "image": seal_image(rule.seal, rule.signature, rule.opacity, w, h),
+            "x": x, "y": y, "w": w, "h": h,
+        } for rule, (x, y, w, h) in entries]
+        for index, entries in planned.items()
+    }
+    logging.debug(f"Rules: {len(rules)} rules -> {sum(map(len, items_by_page.values()))} seals "
+                  f"on {len(items_by_page)} of {total} pages")
+
+    if output_mode == 'incremental':
+        done, result = _try_incremental(pdf_data, reader, items_by_page, output_pdf)
+        if done:
+            return result
+
+    return stamp_pdf_rewrite(pdf_data, reader, items_by_page, output_pdf)
+
+def decode_pdf_data(pdf_data_str):
+    """Декодирует PDF из base64 (строка или data URL)"""
+    if not isinstance(pdf_data_str, str):
+        raise ValueError("Неверный формат данных PDF")
+    with metrics.timed('base64_decode'):
+        if pdf_data_str.startswith('data:'):
+            return base64.b64decode(pdf_data_str.split(',')[1])
+        return base64.b64decode(pdf_data_str)
+
+def encode_pdf_data(pdf_bytes):
+    """PDF -> строка base64 для JSON-ответов"""
+    with metrics.timed('base64_encode'):
+        return base64.b64encode(pdf_bytes).decode('ascii')
+
+def stamped_filename(original_filename):
+    """Имя результата: санитизированное имя исходного файла + _stamped.pdf"""
+    name = secure_filename(Path(original_filename).stem) or "document"
+    return f"{name}_stamped.pdf"
+
+# Кеш готовых PDF по содержимому: повторная загрузка того же файла с теми же
+# параметрами отдаётся без обработки. Память — на процесс, диск — общий для всех процессов.
+_result_cache_disk_mb = int(os.environ.get('RESULT_CACHE_DISK_MB', 512))
+RESULT_CACHE = TieredCache(
+    LRUCache(maxsize=1024, max_bytes=int(os.environ.get('RESULT_CACHE_MB', 64)) * 1024 * 1024),
+    DiskCache(
+        os.environ.get('RESULT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'falcon_result_cache'),
+        _result_cache_disk_mb * 1024 * 1024,
+    ) if _result_cache_disk_mb > 0 else None,
+)
+
+# Меняется при изменении пересчёта координат печатей (см. geometry): прежние результаты из кеша не отдаются
+PLACEMENT_VERSION = b"geometry-v2"
+
+def result_cache_key(pdf_source, params):
+    """
+    sha256 от байтов PDF, нормализованных параметров наложения и изображений печатей.
+    pdf_source — bytes или seekable файл (позиция возвращается в начало).
+    """
+    digest = hashlib.sha256()
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        digest.update(pdf_source)
+    else:
+        pdf_source.seek(0)
+        for chunk in iter(lambda: pdf_source.read(1024 * 1024), b''):
+            digest.update(chunk)
+        pdf_source.seek(0)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    digest.update(SEAL_ASSETS_DIGEST.encode('ascii'))
+    digest.update(PLACEMENT_VERSION)
+    return digest.hexdigest()
+
+def normalize_coordinates(coordinates):
+    """Координаты для ключа кеша: float с точностью до 0.001 pt"""
+    if coordinates is None:
+        return None
+    return {k: round(float(coordinates[k]), 3) for k in ('x', 'y', 'width', 'height')}
+
+class BatchResultCache:
+    """Кеш результатов для iter_batch: проверяется в основном процессе до отправки в пул"""
+
+    def lookup(self, job):
+        if 'pdf_bytes' not in job:
+            try:
+                job['pdf_bytes'] = decode_pdf_data(job['pdf_data'])
+            except Exception:
+                # Ошибку декодирования покажет сама обработка
+                return None
+            del job['pdf_data']
+        job['cache_key'] = result_cache_key(job['pdf_bytes'], {
+            'op': 'batch',
+            'seal_type': 'falcon' if job['seal_type'] == 'falcon' else 'ip',
+            'add_signature': bool(job['add_signature']),
+            'coordinates': normalize_coordinates(job['coordinates']),
+            'rules': [list(rule) for rule in job['rules']] if job.get('rules') else None,
+            'output_mode': job['output_mode'],
+        })
+        cached = RESULT_CACHE.get(job['cache_key'])
+        return {'ok': True, 'pdf_bytes': cached, 'cached': True} if cached is not None else None
+
+    def store(self, job, result):
+        if 'cache_key' in job:
+            RESULT_CACHE.put(job['cache_key'], result['pdf_bytes'])
+
+BATCH_RESULT_CACHE = BatchResultCache()
+
+def stamp_batch_file(job):
+    """
+    Обрабатывает один файл пакета (выполняется в процессе пула batch_engine).
+
+    job: {pdf_bytes | pdf_data (base64), seal_type, add_signature, coordinates, output_mode, [rules]}
+    С rules (список stamp_rules.Rule) печати ставятся по правилам, остальные параметры печати не используются.
+    Returns: {'ok': True, 'pdf_bytes': ...}
+    """
+    pdf_data = job['pdf_bytes'] if 'pdf_bytes' in job else decode_pdf_data(job['pdf_data'])
+    check_pdf_bytes(pdf_data)
+    if job.get('rules'):
+        return {'ok': True, 'pdf_bytes': stamp_pdf_rules(pdf_data, job['rules'], None, job['output_mode'])}
+    stamped = add_signature_to_pdf_batch(pdf_data, None, job['seal_type'], job['add_signature'],
+                                         job['coordinates'], job['output_mode'])
+    return {'ok': True, 'pdf_bytes': stamped}
+
+# Готовые результаты (/upload, фоновые задачи) живут ограниченное время в каталоге на диске:
+# его видят все воркеры gunicorn, поэтому /download и /api/jobs/<id>/files отдаёт любой из них
+RESULT_STORE = DiskResultStore(
+    os.environ.get('RESULT_STORE_DIR') or os.path.join(tempfile.gettempdir(), 'falcon_results'),
+    max_items=int(os.environ.get('RESULT_STORE_ITEMS', 512)),
+    max_bytes=int(os.environ.get('RESULT_STORE_MB', 512)) * 1024 * 1024,
+    ttl=int(os.environ.get('RESULT_TTL_SECONDS', 3600)),
+)
 
 @app.route('/')
 def index():
@@ -629,29 +1095,32 @@ def upload_file():
     if not file.filename.lower().endswith('.pdf'):
         return jsonify({'error': 'Пожалуйста, загрузите PDF файл'}), 400
 
+    # Заголовок и конец файла проверяем до разбора
+    error = pdf_stream_error(file.stream)
+    if error:
+        return jsonify({'error': error}), 400
+
     # Получаем параметры из формы
     seal_type = request.form.get('seal_type', 'falcon')
     add_signature = request.form.get('add_signature', 'false').lower() == 'true'
 
     try:
-        # Очищаем старые файлы перед обработкой
-        cleanup_old_files()
-
-        # Сохраняем загруженный файл
         filename = secure_filename(file.filename)
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(input_path)
 
         # Создаем имя для выходного файла
         name, ext = os.path.splitext(filename)
         output_filename = f"{name}_с_подписью{ext}"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-
-        # Добавляем подпись с выбранными параметрами
-        add_signature_to_pdf(input_path, output_path, seal_type, add_signature)
 
-        # Удаляем исходный файл
-        os.unlink(input_path)
+        # Добавляем подпись с выбранными параметрами: исходник читаем прямо из загрузки,
+        # результат кладём в хранилище с TTL вместо папки uploads
+        cache_key = result_cache_key(file.stream, {
+            'op': 'upload',
+            'seal_type': seal_type,
+            'add_signature': add_signature
+        })
+        result_data = RESULT_CACHE.get_or_build(
+            cache_key, lambda: add_signature_to_pdf(file.stream, None, seal_type, add_signature))
+        RESULT_STORE.put(f"upload/{output_filename}", result_data)
 
         return jsonify({
             'success': True,
@@ -665,14 +1134,17 @@ def upload_file():
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        stored = RESULT_STORE.get(f"upload/{filename}")
+        if stored is None:
+            return jsonify({'error': 'Файл не найден или срок его хранения истёк'}), 404
+        return send_file(io.BytesIO(stored[0]), mimetype='application/pdf',
+                         as_attachment=True, download_name=filename)
     except Exception as e:
         return jsonify({'error': f'Ошибка при скачивании файла: {str(e)}'}), 500
 
 @app.route('/health')
 def health_check():
-    return jsonify({'status': 'healthy'})
+    return jsonify({'status': 'healthy', 'startup': startup_info()})
 
 @app.route('/ping')
 def ping():
@@ -689,19 +1161,14 @@ def get_available_seals():
     """Возвращает информацию о доступных печатях"""
     seals = [
         {
-            'id': 'falcon',
-            'name': 'ФАЛКОН-ТРАНС (ООО)',
-            'type': 'company',
-            'description': 'Официальная печать компании ФАЛКОН-ТРАНС',
-            'image_url': '/static/images/falcon_seal.png'
-        },
-        {
-            'id': 'ip',
-            'name': 'ИП Заикина',
-            'type': 'individual',
-            'description': 'Печать индивидуального предпринимателя',
-            'image_url': '/static/images/ip_seal.png'
+            'id': seal_type,
+            'name': seal['name'],
+            'type': seal['type'],
+            'description': seal['description'],
+            'image_url': '/' + seal['image'],
+            'vector': vector_seal(seal_type) is not None
         }
+        for seal_type, seal in SEAL_REGISTRY.items()
     ]
     return jsonify({'seals': seals})
 
@@ -709,24 +1176,379 @@ def get_available_seals():
 def get_usage_stats():
     """Возвращает статистику использования приложения"""
     try:
-        # Подсчитываем количество файлов в папке uploads
-        upload_folder = app.config['UPLOAD_FOLDER']
-        if os.path.exists(upload_folder):
-            files_count = len([f for f in os.listdir(upload_folder) if f.endswith('.pdf')])
-        else:
-            files_count = 0
-
         stats = {
-            'total_processed_files': files_count,
+            'total_processed_files': len(RESULT_STORE),
             'max_file_size_mb': app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024),
-            'available_seals': 2,  # falcon и ip
+            'available_seals': len(SEAL_REGISTRY),
             'service_status': 'active',
-            'version': '1.0.0'
+            'version': '1.0.0',
+            'seal_image_cache': SEAL_IMAGE_CACHE.stats(),
+            'result_store': RESULT_STORE.stats(),
+            'result_cache': RESULT_CACHE.stats(),
+            'uploads': UPLOAD_BUDGET.stats(),
+            'preview_cache': PREVIEW_CACHE.stats(),
+            'document_sessions': DOCUMENT_SESSIONS.stats(),
+            'jobs': get_job_manager().stats()
         }
         return jsonify(stats)
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении статистики: {str(e)}'}), 500
 
+# Состояние кешей и очередей — значения считываются при каждом запросе /metrics
+metrics.REGISTRY.register(metrics.Gauges(
+    'falcon_cache_entries', 'Записей в кешах', ['cache'], lambda: {
+        ('seal_image',): len(SEAL_IMAGE_CACHE),
+        ('preview',): len(PREVIEW_CACHE.memory),
+        ('result_memory',): len(RESULT_CACHE.memory),
+        ('result_store',): len(RESULT_STORE),
+    }))
+metrics.REGISTRY.register(metrics.Gauges(
+    'falcon_cache_bytes', 'Объём данных в кешах', ['cache'], lambda: {
+        ('result_memory',): RESULT_CACHE.memory.stats().get('bytes'),
+        ('result_disk',): RESULT_CACHE.disk.stats()['bytes'] if RESULT_CACHE.disk is not None else None,
+        ('result_store',): RESULT_STORE.stats()['bytes'],
+        ('preview',): PREVIEW_CACHE.memory.stats()['bytes'],
+        ('preview_disk',): PREVIEW_CACHE.disk.stats()['bytes'] if PREVIEW_CACHE.disk is not None else None,
+    }))
+metrics.REGISTRY.register(metrics.Gauges(
+    'falcon_jobs', 'Фоновые задачи по статусам', ['status'],
+    lambda: {(status,): count for status, count in _job_manager.stats().items()} if _job_manager else {}))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """Сохранённые профили медленных запросов"""
+    return jsonify({
+        'enabled': profiling.enabled(),
+        'threshold_ms': profiling.PROFILE_SLOW_MS,
+        'mode': profiling.PROFILE_MODE,
+        'profiles': [dict(meta, download_url=f"/api/profiles/{meta['id']}") for meta in profiling.STORE.list()],
+    })
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """Файл профиля; ?format=text — сводка pstats (для cProfile)"""
+    found = profiling.STORE.get(profile_id)
+    if found is None:
+        return jsonify({'error': 'Профиль не найден'}), 404
+    meta, path = found
+    if request.args.get('format') == 'text' and meta['mode'] == 'cprofile':
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(int(request.args.get('limit', 60)))
+        return Response(out.getvalue(), mimetype='text/plain')
+    return send_file(path, as_attachment=True, download_name=meta['filename'])
+
+# Сессии документов редактора: PDF загружается один раз (ключ — sha256 содержимого),
+# дальше превью и сохранение ссылаются на него по идентификатору. Время жизни продлевается
+# при каждом обращении; при нехватке места первыми вытесняются давно не использованные.
+# Сессии лежат на диске, общем для воркеров: запросы редактора может обслужить любой из них
+DOCUMENT_SESSIONS = DiskResultStore(
+    os.environ.get('DOCUMENT_SESSIONS_DIR') or os.path.join(tempfile.gettempdir(), 'falcon_documents'),
+    max_items=int(os.environ.get('DOCUMENT_SESSIONS', 64)),
+    max_bytes=int(os.environ.get('DOCUMENT_SESSIONS_MB', 256)) * 1024 * 1024,
+    ttl=int(os.environ.get('DOCUMENT_TTL_SECONDS', 3600)),
+)
+# Миниатюры: память процесса поверх дискового кеша, общего для воркеров
+_preview_cache_disk_mb = int(os.environ.get('PREVIEW_CACHE_DISK_MB', 256))
+PREVIEW_CACHE = TieredCache(
+    LRUCache(maxsize=int(os.environ.get('PREVIEW_CACHE_ITEMS', 2048)),
+             max_bytes=int(os.environ.get('PREVIEW_CACHE_MB', 64)) * 1024 * 1024),
+    DiskCache(
+        os.environ.get('PREVIEW_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'falcon_previews'),
+        _preview_cache_disk_mb * 1024 * 1024,
+    ) if _preview_cache_disk_mb > 0 else None,
+)
+
+def _session_meta(meta):
+    """Описание сессии из JSON: геометрия страниц снова PageGeometry"""
+    meta['geometry'] = [geometry.PageGeometry(w, h, rotate, tuple(crop)) for w, h, rotate, crop in meta['geometry']]
+    return meta
+
+def document_session(doc_id):
+    """(байты PDF, описание) документа сессии или None; обращение продлевает сессию"""
+    stored = DOCUMENT_SESSIONS.get(f"document/{doc_id}", touch=True)
+    return (stored[0], _session_meta(stored[1])) if stored is not None else None
+
+def document_session_meta(doc_id):
+    """Описание документа сессии без чтения самого PDF или None; обращение продлевает сессию"""
+    meta = DOCUMENT_SESSIONS.get_meta(f"document/{doc_id}", touch=True)
+    return _session_meta(meta) if meta is not None else None
+
+def page_preview(doc_id, index, scale):
+    """
+    PNG миниатюры страницы из кеша или отрисованный заново — только тогда PDF
+    читается из сессии. None — сессия истекла.
+    """
+    key = hashlib.sha256(f"{doc_id}:{index}:{scale}".encode('ascii')).hexdigest()
+    png = PREVIEW_CACHE.get(key)
+    if png is None:
+        stored = DOCUMENT_SESSIONS.get(f"document/{doc_id}")
+        if stored is None:
+            return None
+        with metrics.timed('preview_render'):
+            png = previews.render_page(stored[0], index, scale)
+        PREVIEW_CACHE.put(key, png)
+    return png
+
+@app.route('/api/documents', methods=['POST'])
+@app.route('/api/preview', methods=['POST'])
+def create_document():
+    """
+    Открывает сессию документа (multipart file или тело application/pdf).
+    Ответ: идентификатор документа, видимые размеры страниц в пунктах и адреса превью и сохранения.
+    """
+    if 'file' in request.files:
+        upload = request.files['file']
+        stream, filename = upload.stream, upload.filename
+    else:
+        stream, filename = request.stream, request.args.get('filename')
+    pdf_data = stream.read()
+    try:
+        check_pdf_bytes(pdf_data)
+        reader = PdfReader(io.BytesIO(pdf_data))
+        page_geometries = [geometry.page_geometry(page) for page in reader.pages]
+    except Exception as e:
+        return jsonify({'error': f'Не удалось прочитать PDF: {e}'}), 400
+
+    doc_id = hashlib.sha256(pdf_data).hexdigest()[:32]
+    pages = [geometry.visual_size(g) for g in page_geometries]
+    DOCUMENT_SESSIONS.put(f"document/{doc_id}", pdf_data, {'pages': pages, 'geometry': page_geometries, 'filename': filename})
+    return jsonify({
+        'success': True,
+        'doc_id': doc_id,
+        'page_count': len(pages),
+        'pages': [{'width': w, 'height': h} for w, h in pages],
+        'renderer': previews.available(),
+        'page_url': f'/api/documents/{doc_id}/pages/{{page}}?scale={{scale}}',
+        'save_url': f'/api/documents/{doc_id}/save',
+        'placements_url': f'/api/documents/{doc_id}/placements',
+        'stamp_url': f'/api/documents/{doc_id}/stamp',
+        'expires_in': DOCUMENT_SESSIONS.ttl
+    })
+
+@app.route('/api/documents/<doc_id>/pages/<int:page>', methods=['GET'])
+@app.route('/api/preview/<doc_id>/pages/<int:page>', methods=['GET'])
+def get_page_preview(doc_id, page):
+    """PNG страницы (0-based) при ?scale= пикселей на пункт; кешируется по (документ, страница, масштаб)"""
+    meta = document_session_meta(doc_id)
+    if meta is None:
+        return jsonify({'error': 'Документ не найден или срок его хранения истёк'}), 404
+    if not 0 <= page < len(meta['pages']):
+        return jsonify({'error': 'Нет такой страницы'}), 404
+    try:
+        scale = previews.quantize_scale(request.args.get('scale', 0.25))
+    except ValueError:
+        return jsonify({'error': 'Неверный масштаб'}), 400
+
+    etag = f"{doc_id}-{page}-{scale}"
+    if etag in request.if_none_match:
+        return Response(status=304)
+    try:
+        png = page_preview(doc_id, page, scale)
+    except previews.PreviewUnavailable as e:
+        return jsonify({'error': str(e)}), 501
+    if png is None:
+        return jsonify({'error': 'Документ не найден или срок его хранения истёк'}), 404
+    response = Response(png, mimetype='image/png')
+    # Содержимое определяется хешем документа — его можно кешировать в браузере
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    response.set_etag(etag)
+    return response
+
+def geometry_from_json(page):
+    """geometry.PageGeometry из {mediabox: [x0, y0, x1, y1], cropbox: [...], rotate} (cropbox по умолчанию — mediabox)"""
+    x0, y0, x1, y1 = (float(v) for v in page['mediabox'])
+    crop = tuple(float(v) for v in page.get('cropbox') or (x0, y0, x1, y1))
+    if len(crop) != 4:
+        raise ValueError(f"Invalid cropbox: {page.get('cropbox')}")
+    return geometry.PageGeometry(x1 - x0, y1 - y0, int(page.get('rotate', 0)) % 360, crop)
+
+def rect_json(rect):
+    return dict(zip(('x', 'y', 'w', 'h'), (round(v, 2) for v in rect)))
+
+def place_editor_seals(page_geometries, seals):
+    """
+    Где окажутся печати редактора: для каждой — прямоугольник в user-space (как при
+    наложении в stamp_editor_seals) и видимый прямоугольник, в котором её покажет просмотрщик
+    """
+    placements = []
+    by_page = {}
+    for i, seal in enumerate(seals):
+        page_index = int(seal.get('pageIndex', 0))
+        placement = {'index': i, 'pageIndex': page_index}
+        placements.append(placement)
+        if not 0 <= page_index < len(page_geometries):
+            placement['error'] = 'Нет такой страницы'
+        elif not all(isinstance(seal.get(k), (int, float)) for k in ('xPt', 'yPt', 'wPt', 'hPt')):
+            placement['error'] = 'Неверные координаты печати'
+        else:
+            placement['requested'] = tuple(float(seal[k]) for k in ('xPt', 'yPt', 'wPt', 'hPt'))
+            by_page.setdefault(page_index, []).append(placement)
+
+    # Все печати страницы пересчитываются вместе, как при наложении
+    for page_index, page_placements in by_page.items():
+        g = page_geometries[page_index]
+        user = zip(*geometry.visual_to_user(g, *zip(*(p['requested'] for p in page_placements))))
+        valid = []
+        for placement, rect in zip(page_placements, user):
+            error = geometry.size_error(g, rect[2], rect[3])
+            if error:
+                placement['error'] = error
+                placement['requested'] = rect_json(placement['requested'])
+            else:
+                valid.append((placement, rect))
+        if not valid:
+            continue
+        clamped = geometry.clamp(g, *zip(*(rect for _, rect in valid)))
+        for (placement, rect), user_rect in zip(valid, zip(*clamped)):
+            requested = placement['requested']
+            rendered = geometry.user_to_visual(g, *user_rect)
+            placement.update({
+                'requested': rect_json(requested),
+                'user': rect_json(user_rect),
+                'rendered': rect_json(rendered),
+                'clamped': any(abs(a - b) > 0.01 for a, b in zip(rect, user_rect)),
+                'matches': all(abs(a - b) <= 0.5 for a, b in zip(requested, rendered)),
+            })
+    return placements
+
+def placement_previews(doc_id, meta, seals, placements, scale):
+    """PNG области с печатями для каждой затронутой страницы (печати — там, где они окажутся)"""
+    by_page = {}
+    for seal, placement in zip(seals, placements):
+        if 'rendered' in placement:
+            by_page.setdefault(placement['pageIndex'], []).append((seal, placement))
+    images = []
+    for page_index, page_seals in sorted(by_page.items()):
+        page_png = page_preview(doc_id, page_index, scale)
+        if page_png is None:
+            continue
+        rects = []
+        stamps = []
+        for seal, placement in page_seals:
+            requested = tuple(placement['requested'].values())
+            rendered = tuple(placement['rendered'].values())
+            seal_type = "falcon" if seal.get('type', 'falcon') == 'falcon' else "ip"
+            seal_img = Image.open(io.BytesIO(seal_png(seal_type)))
+            stamps.append((seal_img, rendered, opacity_bucket(seal.get('opacity', 1.0)),
+                           None if placement['matches'] else requested))
+            rects += [requested, rendered]
+        size = meta['pages'][page_index]
+        region = previews.union_region(rects, size)
+        png = previews.placement_png(page_png, scale, size[1], region, stamps, meta['geometry'][page_index].rotate)
+        images.append({
+            'pageIndex': page_index,
+            'region': rect_json(region),
+            'scale': scale,
+            'image': f'data:image/png;base64,{base64.b64encode(png).decode("ascii")}'
+        })
+    return images
+
+@app.route('/api/placements', methods=['POST'], defaults={'doc_id': None})
+@app.route('/api/documents/<doc_id>/placements', methods=['POST'])
+def preview_placements(doc_id):
+    """
+    Проверка размещения печатей без сохранения документа. Тело — {seals} в формате
+    /save-document и, без сессии, {pages: [{mediabox, cropbox, rotate}]}. Ответ — прямоугольники
+    печатей (запрошенный, в user-space и видимый после наложения), а для сессии с превью
+    (?image=1 по умолчанию) — PNG области страницы с печатями при ?scale= (по умолчанию 1).
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    seals = data.get('seals')
+    if not isinstance(seals, list):
+        return jsonify({'success': False, 'error': "Missing or invalid 'seals' array"}), 400
+
+    meta = None
+    if doc_id is not None:
+        meta = document_session_meta(doc_id)
+        if meta is None:
+            return jsonify({'success': False, 'error': 'Документ не найден или срок его хранения истёк'}), 404
+        page_geometries = meta['geometry']
+    else:
+        try:
+            page_geometries = [geometry_from_json(page) for page in data.get('pages') or []]
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': f'Неверная геометрия страниц: {e}'}), 400
+
+    with metrics.timed('placement_preview'):
+        placements = place_editor_seals(page_geometries, seals)
+        response = {'success': True, 'placements': placements}
+        if meta is not None and request.args.get('image', '1') != '0' and previews.available():
+            try:
+                scale = previews.quantize_scale(request.args.get('scale', 1.0))
+            except ValueError:
+                return jsonify({'success': False, 'error': 'Неверный масштаб'}), 400
+            response['previews'] = placement_previews(doc_id, meta, seals, placements, scale)
+    return jsonify(response)
+
+@app.route('/api/documents/<doc_id>/save', methods=['POST'])
+def save_document_session(doc_id):
+    """
+    Накладывает печати на документ сессии. Тело — JSON {seals, outputMode} в формате
+    /save-document, но без pdfData; ответ — сам PDF (application/pdf), без base64.
+    """
+    stored = document_session(doc_id)
+    if stored is None:
+        return jsonify({'success': False, 'error': 'Документ не найден или срок его хранения истёк'}), 404
+    pdf_data, meta = stored
+    try:
+        data = request.get_json(force=True) or {}
+        result_data = stamp_editor_seals(pdf_data, data.get('seals'), data.get('outputMode'))
+    except Exception as e:
+        logging.exception("save_document_session failed")
+        return jsonify({
+            'success': False,
+            'error': f'{e}',
+            'trace': traceback.format_exc()[:4000]
+        }), 400
+
+    return send_file(io.BytesIO(result_data), mimetype='application/pdf', as_attachment=True,
+                     download_name=stamped_filename(meta.get('filename') or 'document.pdf'))
+
+@app.route('/api/documents/<doc_id>/stamp', methods=['POST'])
+def stamp_document_rules(doc_id):
+    """
+    Накладывает печати на документ сессии по правилам. Тело — JSON {rules, outputMode},
+    формат правил — в stamp_rules; ответ — PDF (application/pdf).
+    """
+    stored = document_session(doc_id)
+    if stored is None:
+        return jsonify({'success': False, 'error': 'Документ не найден или срок его хранения истёк'}), 404
+    pdf_data, meta = stored
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        rules = stamp_rules.parse_rules(data.get('rules'))
+    except stamp_rules.RuleError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        if not ensure_seal_cache():
+            raise ValueError("Failed to initialize seal cache")
+        output_mode = resolve_output_mode(data.get('outputMode'))
+        cache_key = result_cache_key(pdf_data, {
+            'op': 'rules',
+            'rules': [list(rule) for rule in rules],
+            'output_mode': output_mode,
+        })
+        result_data = RESULT_CACHE.get(cache_key)
+        if result_data is None:
+            result_data = stamp_pdf_rules(pdf_data, rules, None, output_mode)
+            RESULT_CACHE.put(cache_key, result_data)
+    except Exception as e:
+        logging.exception("stamp_document_rules failed")
+        return jsonify({
+            'success': False,
+            'error': f'{e}',
+            'trace': traceback.format_exc()[:4000]
+        }), 400
+
+    return send_file(io.BytesIO(result_data), mimetype='application/pdf', as_attachment=True,
+                     download_name=stamped_filename(meta.get('filename') or 'document.pdf'))
+
 @app.route('/api/coordinates', methods=['GET'])
 def get_seal_coordinates():
     """Возвращает стандартные координаты для печати и подписи"""
@@ -768,6 +1590,70 @@ def get_seal_coordinates():
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении координат: {str(e)}'}), 500
 
+def stamp_editor_seals(pdf_data, seals, output_mode=None):
+    """
+    Накладывает печати из редактора ({pageIndex, xPt, yPt, wPt, hPt, type, opacity}, координаты
+    в пунктах от левого нижнего угла видимой страницы) и возвращает байты PDF.
+    output_mode: "rewrite" — полная перезапись, "incremental" — дописывание изменений в конец файла
+    """
+    if not isinstance(seals, list):
+        raise ValueError("Missing or invalid 'seals' array")
+    output_mode = resolve_output_mode(output_mode)
+    check_pdf_bytes(pdf_data)
+
+    # Проверяем инициализацию кеша печатей
+    if not ensure_seal_cache():
+        raise ValueError("Failed to initialize seal cache")
+
+    # Группируем печати по странице (0-based)
+    seals_by_page = {}
+    for seal in seals:
+        i = int(seal.get('pageIndex', 0))
+        seals_by_page.setdefault(i, []).append(seal)
+
+    # Используем новую систему координат
+    items_by_page = {}
+    for i, page_seals in seals_by_page.items():
+        items = items_by_page.setdefault(i, [])
+        for seal in page_seals:
+            # Валидация координат
+            required_keys = ['xPt', 'yPt', 'wPt', 'hPt']
+            if not all(key in seal and isinstance(seal[key], (int, float)) for key in required_keys):
+                raise ValueError(f"Invalid seal coordinates: {seal}")
+
+            # Готовое изображение печати нужной прозрачности (кодируется один раз)
+            seal_type = "falcon" if seal.get('type', 'falcon') == 'falcon' else "ip"
+            opacity = opacity_bucket(seal.get('opacity', 1.0))
+
+            # Конвертируем координаты из редактора в новый формат
+            items.append({
+                "image": seal_image(seal_type, False, opacity, float(seal['wPt']), float(seal['hPt'])),
+                "x": float(seal['xPt']),
+                "y": float(seal['yPt']),
+                "w": float(seal['wPt']),
+                "h": float(seal['hPt'])
+            })
+
+    # Весь документ обрабатывается в памяти, без временных файлов.
+    # Порядок печатей важен (перекрытия), поэтому ключ строится по исходному списку
+    cache_key = result_cache_key(pdf_data, {
+        'op': 'save-document',
+        'output_mode': output_mode,
+        'seals': [
+            [int(seal.get('pageIndex', 0)), 'falcon' if seal.get('type', 'falcon') == 'falcon' else 'ip',
+             opacity_bucket(seal.get('opacity', 1.0))]
+            + [round(float(seal[k]), 3) for k in ('xPt', 'yPt', 'wPt', 'hPt')]
+            for seal in seals
+        ]
+    })
+    result_data = RESULT_CACHE.get_or_build(
+        cache_key, lambda: stamp_pdf_pages(pdf_data, items_by_page, None, output_mode))
+    logging.info(f"DEBUG: Размер созданного PDF: {len(result_data)} байт")
+
+    if not result_data:
+        raise ValueError("Создан пустой PDF файл")
+    return result_data
+
 @app.route('/save-document', methods=['POST'])
 def save_document():
     """Сохраняет документ с наложенными печатями"""
@@ -782,111 +1668,18 @@ def save_document():
             raise ValueError("Missing or invalid 'seals' array")
 
         # Декодируем PDF из base64
-        pdf_data_str = data['pdfData']
-        if isinstance(pdf_data_str, str):
-            # Если это строка с data URL
-            if pdf_data_str.startswith('data:'):
-                pdf_data = base64.b64decode(pdf_data_str.split(',')[1])
-            else:
-                # Если это просто base64 строка
-                pdf_data = base64.b64decode(pdf_data_str)
-        else:
-            raise ValueError("Неверный формат данных PDF")
-
-        # Создаем временный файл для исходного PDF
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_pdf:
-            temp_pdf.write(pdf_data)
-            temp_pdf_path = temp_pdf.name
+        pdf_data = decode_pdf_data(data['pdfData'])
+        result_data = stamp_editor_seals(pdf_data, data['seals'], data.get('outputMode'))
 
-        # Создаем временный файл для результата
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_result:
-            result_path = temp_result.name
+        # Кодируем в base64 для отправки
+        result_base64 = encode_pdf_data(result_data)
+        logging.info(f"DEBUG: Размер base64 данных: {len(result_base64)} символов")
 
-        try:
-            # Проверяем инициализацию кеша печатей
-            if SEAL_BYTES_FALCON is None or SEAL_BYTES_IP is None:
-                logging.info("Кеш печатей не инициализирован, инициализируем...")
-                initialize_seal_cache()
-                # Дополнительная проверка после инициализации
-                if SEAL_BYTES_FALCON is None or SEAL_BYTES_IP is None:
-                    raise ValueError("Failed to initialize seal cache")
-                logging.info(f"Кеш инициализирован: FALCON={len(SEAL_BYTES_FALCON)} байт, IP={len(SEAL_BYTES_IP)} байт")
-            
-            # Читаем исходный PDF
-            reader = PdfReader(temp_pdf_path)
-            writer = PdfWriter()
-
-            # Группируем печати по странице (0-based)
-            seals_by_page = {}
-            for seal in data.get('seals', []):
-                i = int(seal.get('pageIndex', 0))
-                seals_by_page.setdefault(i, []).append(seal)
-
-            for i, page in enumerate(reader.pages):
-                if i in seals_by_page:
-                    # Используем новую систему координат
-                    items = []
-                    for seal in seals_by_page[i]:
-                        # Валидация координат
-                        required_keys = ['xPt', 'yPt', 'wPt', 'hPt']
-                        if not all(key in seal and isinstance(seal[key], (int, float)) for key in required_keys):
-                            raise ValueError(f"Invalid seal coordinates: {seal}")
-                        
-                        # Выбираем правильные PNG байты
-                        seal_type = seal.get('type', 'falcon')
-                        if seal_type == 'falcon':
-                            png_bytes = SEAL_BYTES_FALCON
-                        else:  # ip
-                            png_bytes = SEAL_BYTES_IP
-                        
-                        # Проверяем, что PNG байты корректны
-                        if not png_bytes or len(png_bytes) < 100:
-                            raise ValueError(f"Invalid PNG bytes for seal type: {seal_type}")
-                        
-                        # Конвертируем координаты из редактора в новый формат
-                        items.append({
-                            "png_bytes": png_bytes,
-                            "x": float(seal['xPt']),
-                            "y": float(seal['yPt']),
-                            "w": float(seal['wPt']),
-                            "h": float(seal['hPt'])
-                        })
-                    
-                    # Используем новую функцию merge_on_page
-                    merge_on_page(page, items)
-                writer.add_page(page)
-
-            # Сохраняем результат
-            with open(result_path, 'wb') as output_file:
-                writer.write(output_file)
-
-            # Проверяем размер файла
-            file_size = os.path.getsize(result_path)
-            logging.info(f"DEBUG: Размер созданного PDF: {file_size} байт")
-
-            if file_size == 0:
-                raise ValueError("Создан пустой PDF файл")
-
-            # Читаем результат и отправляем
-            with open(result_path, 'rb') as f:
-                result_data = f.read()
-
-            # Кодируем в base64 для отправки
-            result_base64 = base64.b64encode(result_data).decode('utf-8')
-            logging.info(f"DEBUG: Размер base64 данных: {len(result_base64)} символов")
-
-            return jsonify({
-                'success': True,
-                'pdfData': f'data:application/pdf;base64,{result_base64}',
-                'filename': f'document_with_seals_{int(time.time())}.pdf'
-            })
-
-        finally:
-            # Удаляем временные файлы
-            if os.path.exists(temp_pdf_path):
-                os.unlink(temp_pdf_path)
-            if os.path.exists(result_path):
-                os.unlink(result_path)
+        return jsonify({
+            'success': True,
+            'pdfData': f'data:application/pdf;base64,{result_base64}',
+            'filename': f'document_with_seals_{int(time.time())}.pdf'
+        })
 
     except Exception as e:
         logging.exception("save_document failed")
@@ -896,6 +1689,126 @@ def save_document():
             'trace': traceback.format_exc()[:4000]  # чтобы увидеть корень
         }), 400
 
+def _batch_process_result(original_filename, outcome):
+    """Запись результата /api/batch-process для одного файла"""
+    if not outcome['ok']:
+        return {
+            'success': False,
+            'filename': original_filename or 'unknown.pdf',
+            'error': outcome['error']
+        }
+
+    result_data = outcome['pdf_bytes']
+
+    # Кодируем в base64
+    result_base64 = encode_pdf_data(result_data)
+
+    return {
+        'success': True,
+        'filename': stamped_filename(original_filename or 'document.pdf'),
+        'pdfData': f'data:application/pdf;base64,{result_base64}',
+        'size': len(result_data)
+    }
+
+def _batch_stamp_item(original_filename, outcome, binary=False):
+    """Запись результата /batch-stamp для одного файла (binary=True — без data URL)"""
+    if not outcome['ok']:
+        return {
+            'filename': original_filename,
+            'ok': False,
+            'error': outcome['error']
+        }
+
+    stamped_bytes = outcome['pdf_bytes']
+    item = {
+        'filename': stamped_filename(original_filename),
+        'ok': True,
+        'size': len(stamped_bytes)
+    }
+    if not binary:
+        # Создаем data URL
+        item['pdfData'] = "data:application/pdf;base64," + encode_pdf_data(stamped_bytes)
+    return item
+
+def detach_uploaded_streams(files):
+    """Отвязывает потоки загруженных файлов от запроса (request.close() их больше не закроет)"""
+    for file in files:
+        file.stream = io.BytesIO()
+
+def ndjson_line(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+def ndjson_response(records):
+    """Потоковый ответ application/x-ndjson из генератора строк"""
+    response = Response(stream_with_context(records), mimetype='application/x-ndjson')
+    # Отключаем буферизацию на прокси, чтобы клиент видел строки сразу
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _batch_process_jobs(payload):
+    """Задания пула и имена файлов для /api/batch-process"""
+    jobs = []
+    filenames = []
+    for file_data in payload['files']:
+        # Файлы с pdfData не-строкой пропускаем, как и раньше
+        if 'pdfData' in file_data and not isinstance(file_data['pdfData'], str):
+            continue
+        jobs.append({
+            'pdf_data': file_data.get('pdfData'),
+            'seal_type': payload['seal_type'],
+            'add_signature': payload['add_signature'],
+            'coordinates': payload['coordinates'],
+            'output_mode': payload['output_mode']
+        })
+        filenames.append(file_data.get('filename'))
+    return jobs, filenames
+
+def _run_batch_job(job, payload):
+    """Выполняет фоновую задачу пакетной обработки; PDF складываются в RESULT_STORE"""
+    metrics.set_endpoint('batch_job')
+    jobs, filenames = _batch_process_jobs(payload)
+    stats = {}
+    for index, outcome in iter_batch(stamp_batch_file, jobs, payload.get('workers'), stats, BATCH_RESULT_CACHE):
+        original_filename = filenames[index] or 'document.pdf'
+        if outcome['ok']:
+            result_name = stamped_filename(original_filename)
+            RESULT_STORE.put(f"{job.id}/{index}", outcome['pdf_bytes'], {'filename': result_name})
+            record = {
+                'index': index,
+                'success': True,
+                'filename': result_name,
+                'size': len(outcome['pdf_bytes']),
+                'download_url': f'/api/jobs/{job.id}/files/{index}'
+            }
+        else:
+            record = {'index': index, 'success': False, 'filename': original_filename, 'error': outcome['error']}
+        get_job_manager().record(job, record)
+    return stats
+
+# Очередь и статусы фоновых задач — в SQLite, общей для воркеров (JOBS_DB= — только в памяти процесса,
+# тогда gunicorn должен работать с одним воркером)
+JOBS_DB = os.environ.get('JOBS_DB', os.path.join(tempfile.gettempdir(), 'falcon_jobs.sqlite3'))
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """
+    Менеджер фоновых задач создаётся при первом обращении: процессы пула
+    batch_engine импортируют app и не должны поднимать свои потоки и очередь.
+    """
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(
+                _run_batch_job,
+                threads=int(os.environ.get('JOB_THREADS', 2)),
+                ttl=RESULT_STORE.ttl,
+                db_path=JOBS_DB or None,
+            )
+        return _job_manager
+
 @app.route('/api/batch-process', methods=['POST'])
 def batch_process_files():
     """Пакетная обработка файлов с точными координатами"""
@@ -909,6 +1822,10 @@ def batch_process_files():
         seal_type = data.get('seal_type', 'falcon')
         add_signature = data.get('add_signature', False)
         coordinates = data.get('coordinates')  # {x, y, width, height} в пунктах
+        try:
+            output_mode = resolve_output_mode(data.get('output_mode'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         # Валидация координат
         if coordinates:
@@ -916,85 +1833,171 @@ def batch_process_files():
             if not all(key in coordinates for key in required_keys):
                 return jsonify({'error': 'Неверный формат координат'}), 400
 
-        results = []
+        payload = {
+            'files': data['files'],
+            'seal_type': seal_type,
+            'add_signature': add_signature,
+            'coordinates': coordinates,
+            'output_mode': output_mode,
+            'workers': data.get('workers')
+        }
 
-        for file_data in data['files']:
-            try:
-                # Декодируем PDF из base64
-                pdf_data_str = file_data['pdfData']
-                if isinstance(pdf_data_str, str):
-                    if pdf_data_str.startswith('data:'):
-                        pdf_data = base64.b64decode(pdf_data_str.split(',')[1])
-                    else:
-                        pdf_data = base64.b64decode(pdf_data_str)
-                else:
-                    continue
-
-                # Создаем временные файлы
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_input:
-                    temp_input.write(pdf_data)
-                    input_path = temp_input.name
-
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_output:
-                    output_path = temp_output.name
+        if data.get('async'):
+            # Фоновая задача: ответ сразу, прогресс — через /api/jobs/<id>
+            job = get_job_manager().submit(payload, total=len(_batch_process_jobs(payload)[0]))
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': f'/api/jobs/{job.id}',
+                'events_url': f'/api/jobs/{job.id}/events',
+                'result_url': f'/api/jobs/{job.id}/result'
+            }), 202
+
+        jobs, filenames = _batch_process_jobs(payload)
+
+        if data.get('stream') == 'ndjson':
+            # Потоковый ответ: одна строка JSON на файл по мере готовности
+            def generate():
+                stats = {}
+                processed = 0
+                for index, outcome in iter_batch(stamp_batch_file, jobs, data.get('workers'), stats, BATCH_RESULT_CACHE):
+                    record = _batch_process_result(filenames[index], outcome)
+                    processed += record['success']
+                    yield ndjson_line({'type': 'result', 'index': index, **record})
+                yield ndjson_line({
+                    'type': 'summary',
+                    'total_files': len(data['files']),
+                    'processed_files': processed,
+                    'stats': stats
+                })
 
-                try:
-                    # Обрабатываем файл
-                    add_signature_to_pdf_batch(input_path, output_path, seal_type, add_signature, coordinates)
-
-                    # Читаем результат
-                    with open(output_path, 'rb') as f:
-                        result_data = f.read()
-
-                    # Кодируем в base64
-                    result_base64 = base64.b64encode(result_data).decode('utf-8')
-
-                    # Санитизируем имя файла
-                    original_filename = file_data.get('filename', 'document.pdf')
-                    name = secure_filename(Path(original_filename).stem) or "document"
-                    out_name = f"{name}_stamped.pdf"
-                    
-                    results.append({
-                        'success': True,
-                        'filename': out_name,
-                        'pdfData': f'data:application/pdf;base64,{result_base64}',
-                        'size': len(result_data)
-                    })
+            return ndjson_response(generate())
 
-                finally:
-                    # Удаляем временные файлы
-                    if os.path.exists(input_path):
-                        os.unlink(input_path)
-                    if os.path.exists(output_path):
-                        os.unlink(output_path)
-
-            except Exception as e:
-                results.append({
-                    'success': False,
-                    'filename': file_data.get('filename', 'unknown.pdf'),
-                    'error': str(e)
-                })
+        # Файлы распределяются по процессам пула, порядок результатов сохраняется
+        outcomes, stats = run_batch(stamp_batch_file, jobs, data.get('workers'), BATCH_RESULT_CACHE)
+        results = [_batch_process_result(filename, outcome) for filename, outcome in zip(filenames, outcomes)]
 
         return jsonify({
             'success': True,
             'results': results,
             'total_files': len(data['files']),
-            'processed_files': len([r for r in results if r['success']])
+            'processed_files': len([r for r in results if r['success']]),
+            'stats': stats
         })
 
     except Exception as e:
         return jsonify({'error': f'Ошибка при пакетной обработке: {str(e)}'}), 500
 
+def _job_or_404(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return None, (jsonify({'error': 'Задача не найдена'}), 404)
+    return job, None
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус фоновой задачи и результаты по уже готовым файлам"""
+    job, error = _job_or_404(job_id)
+    if error:
+        return error
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Прогресс задачи как Server-Sent Events: progress на каждый файл, done в конце"""
+    job, error = _job_or_404(job_id)
+    if error:
+        return error
+
+    def generate():
+        for event, payload in get_job_manager().events(job.id):
+            if event == 'ping':
+                # Комментарий SSE не даёт прокси закрыть простаивающее соединение
+                yield ': ping\n\n'
+            else:
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Все готовые файлы задачи одним ZIP-архивом (с manifest.json)"""
+    job, error = _job_or_404(job_id)
+    if error:
+        return error
+    if not job.finished:
+        return jsonify({'error': 'Задача ещё выполняется', 'status': job.status}), 409
+
+    compression = request.args.get('compression', 'stored')
+    if compression not in ZIP_COMPRESSION:
+        return jsonify({'error': f'Неизвестный тип сжатия: {compression}'}), 400
+
+    def entries():
+        for record in job.to_dict()['results']:
+            meta = {k: v for k, v in record.items() if k != 'download_url'}
+            stored = RESULT_STORE.get(f"{job.id}/{record['index']}") if record['success'] else None
+            if record['success'] and stored is None:
+                meta.update(success=False, error='Срок хранения результата истёк')
+            yield record['filename'], stored[0] if stored else None, meta
+
+    response = Response(iter_zip(entries(), compression), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="job_{job.id}.zip"'
+    return response
+
+@app.route('/api/jobs/<job_id>/files/<int:index>', methods=['GET'])
+def job_file(job_id, index):
+    """Один готовый PDF фоновой задачи"""
+    stored = RESULT_STORE.get(f"{job_id}/{index}")
+    if stored is None:
+        return jsonify({'error': 'Файл не найден или срок его хранения истёк'}), 404
+    data, meta = stored
+    return send_file(io.BytesIO(data), mimetype='application/pdf',
+                     as_attachment=True, download_name=meta.get('filename', f'{index}.pdf'))
+
+# Кеш печатей: eager — строится при импорте модуля (с preload_app в gunicorn.conf.py — один раз
+# в мастер-процессе, воркеры получают его через fork), lazy — при первом запросе, которому он нужен
+SEAL_CACHE_INIT = os.environ.get('SEAL_CACHE_INIT', 'eager')
+
+# Время запуска для /health; pid — процесса, который импортировал приложение
+STARTUP = {'pid': os.getpid(), 'started_at': time.time(), 'import_seconds': None, 'seal_cache_seconds': None}
+_seal_cache_lock = threading.Lock()
+
 # Инициализируем кеш печатей после определения всех функций
 def init_seal_cache():
+    started = time.perf_counter()
     try:
         initialize_seal_cache()
+        STARTUP['seal_cache_seconds'] = round(time.perf_counter() - started, 3)
         print("✅ Seal cache initialized successfully")
     except Exception as e:
         print(f"❌ Failed to initialize seal cache: {e}")
 
+def ensure_seal_cache():
+    """Строит кеш печатей, если он ещё не готов; True — кеш готов"""
+    if STARTUP['seal_cache_seconds'] is None:
+        with _seal_cache_lock:
+            if STARTUP['seal_cache_seconds'] is None:
+                init_seal_cache()
+    return STARTUP['seal_cache_seconds'] is not None
+
+def startup_info():
+    return {
+        'import_seconds': STARTUP['import_seconds'],
+        'seal_cache_seconds': STARTUP['seal_cache_seconds'],
+        'seal_cache': 'ready' if STARTUP['seal_cache_seconds'] is not None else 'pending',
+        'seal_cache_init': SEAL_CACHE_INIT,
+        # Воркер gunicorn с preload_app — дочерний процесс того, кто импортировал приложение
+        'preloaded': os.getpid() != STARTUP['pid'],
+        'uptime_seconds': round(time.time() - STARTUP['started_at'], 1),
+    }
+
 # Вызываем инициализацию
-init_seal_cache()
+if SEAL_CACHE_INIT != 'lazy':
+    init_seal_cache()
 
 @app.route('/batch-stamp', methods=['POST'])
 def batch_stamp():
@@ -1018,85 +2021,130 @@ def batch_stamp():
         w_mm = float(config.get('width', 46.4))
         h_mm = float(config.get('height', 35.9))
         opacity = float(config.get('opacity', 0.95))
-        
-        items = []
-        
-        for file in files:
-            try:
-                # Проверяем тип файла
-                if not file.filename.lower().endswith('.pdf'):
-                    items.append({
-                        'filename': file.filename,
-                        'ok': False,
-                        'error': 'Не PDF файл'
-                    })
-                    continue
-                
-                # Читаем файл в байты
-                pdf_bytes = file.read()
-                
-                # Создаем временные файлы
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_input:
-                    temp_input.write(pdf_bytes)
-                    input_path = temp_input.name
-                
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_output:
-                    output_path = temp_output.name
-                
-                try:
-                    # Обрабатываем файл с нашими координатами
-                    coordinates = {
-                        'x': mm(x_mm),
-                        'y': mm(y_mm),
-                        'width': mm(w_mm),
-                        'height': mm(h_mm)
-                    }
-                    
-                    add_signature_to_pdf_batch(input_path, output_path, 'falcon', False, coordinates)
-                    
-                    # Читаем результат
-                    with open(output_path, 'rb') as f:
-                        stamped_bytes = f.read()
-                    
-                    # Создаем data URL
-                    data_url = "data:application/pdf;base64," + base64.b64encode(stamped_bytes).decode("utf-8")
-                    
-                    # Санитизируем имя файла
-                    name = secure_filename(Path(file.filename).stem) or "document"
-                    out_name = f"{name}_stamped.pdf"
-                    
-                    items.append({
-                        'filename': out_name,
-                        'ok': True,
-                        'pdfData': data_url,
-                        'size': len(stamped_bytes)
-                    })
-                    
-                finally:
-                    # Удаляем временные файлы
-                    if os.path.exists(input_path):
-                        os.unlink(input_path)
-                    if os.path.exists(output_path):
-                        os.unlink(output_path)
-                        
-            except Exception as e:
-                logging.exception(f"Error processing {file.filename}")
-                items.append({
+        try:
+            output_mode = resolve_output_mode(config.get('output_mode'))
+            # Правила (см. stamp_rules) заменяют одну печать на последней странице
+            rules = stamp_rules.parse_rules(config['rules']) if config.get('rules') is not None else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Обрабатываем файлы с нашими координатами
+        coordinates = {
+            'x': mm(x_mm),
+            'y': mm(y_mm),
+            'width': mm(w_mm),
+            'height': mm(h_mm)
+        }
+
+        items = [None] * len(files)
+        job_slots = []
+        for slot, file in enumerate(files):
+            # Проверяем тип файла
+            if not file.filename.lower().endswith('.pdf'):
+                items[slot] = {
                     'filename': file.filename,
                     'ok': False,
-                    'error': str(e)
+                    'error': 'Не PDF файл'
+                }
+                continue
+            # Заголовок %PDF и маркер %%EOF — по спулу, без чтения файла целиком
+            error = pdf_stream_error(file.stream)
+            if error:
+                items[slot] = {'filename': file.filename, 'ok': False, 'error': error}
+                continue
+            job_slots.append(slot)
+
+        streams = [file.stream for file in files]
+
+        def jobs():
+            # Файлы читаются по одному, когда пул готов взять следующее задание
+            for slot in job_slots:
+                yield {
+                    'pdf_bytes': streams[slot].read(),
+                    'seal_type': 'falcon',
+                    'add_signature': False,
+                    'coordinates': coordinates,
+                    'rules': rules,
+                    'output_mode': output_mode
+                }
+
+        workers = min(resolve_workers(config.get('workers')), max(len(job_slots), 1))
+
+        output_format = request.args.get('format') or config.get('format')
+        if (request.args.get('stream') or config.get('stream')) == 'ndjson':
+            output_format = 'ndjson'
+
+        if output_format in ('ndjson', 'zip', 'multipart'):
+            # Потоковый ответ по мере готовности файлов.
+            # Flask закрывает файлы запроса до начала стриминга, поэтому забираем потоки себе
+            compression = request.args.get('compression') or config.get('compression', 'stored')
+            if compression not in ZIP_COMPRESSION:
+                return jsonify({'error': f'Неизвестный тип сжатия: {compression}'}), 400
+            detach_uploaded_streams(files)
+            stats = {}
+
+            def outcomes():
+                try:
+                    for slot, item in enumerate(items):
+                        if item is not None:
+                            yield slot, {'ok': False, 'error': item['error']}
+                    for job_index, outcome in iter_batch(stamp_batch_file, jobs(), workers, stats, BATCH_RESULT_CACHE):
+                        yield job_slots[job_index], outcome
+                finally:
+                    for stream in streams:
+                        stream.close()
+
+            def entries():
+                # (имя в архиве, байты | None, метаданные) — без base64
+                for slot, outcome in outcomes():
+                    item = _batch_stamp_item(files[slot].filename, outcome, binary=True)
+                    yield item['filename'], outcome.get('pdf_bytes'), {'index': slot, **item}
+
+            ts = int(time.time())
+            if output_format == 'zip':
+                response = Response(stream_with_context(iter_zip(entries(), compression)), mimetype='application/zip')
+                response.headers['Content-Disposition'] = f'attachment; filename=stamped_{ts}.zip'
+                return response
+
+            if output_format == 'multipart':
+                boundary = new_boundary()
+                return Response(stream_with_context(iter_multipart(entries(), boundary)),
+                                mimetype=f'multipart/mixed; boundary={boundary}')
+
+            def generate():
+                ok_count = 0
+                for slot, outcome in outcomes():
+                    item = _batch_stamp_item(files[slot].filename, outcome)
+                    ok_count += item['ok']
+                    yield ndjson_line({'type': 'item', 'index': slot, **item})
+                yield ndjson_line({
+                    'type': 'summary',
+                    'count': len(files),
+                    'ok': ok_count,
+                    'ts': ts,
+                    'stats': stats
                 })
+
+            return ndjson_response(generate())
+
+        stats = {}
+        for job_index, outcome in iter_batch(stamp_batch_file, jobs(), workers, stats, BATCH_RESULT_CACHE):
+            slot = job_slots[job_index]
+            items[slot] = _batch_stamp_item(files[slot].filename, outcome)
         
         return jsonify({
             "success": True, 
             "items": items, 
             "count": len(items), 
-            "ts": int(time.time())
+            "ts": int(time.time()),
+            "stats": stats
         })
         
     except Exception as e:
         logging.exception("batch_stamp failed")
         return jsonify({'error': f'Ошибка при обработке: {str(e)}'}), 500
 
+STARTUP['import_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 3)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080))) 
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""
+Параллельная пакетная обработка PDF в пуле процессов.
+Каждый файл обрабатывается независимо: ошибка одного не влияет на остальные,
+результаты возвращаются в порядке входных файлов.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import metrics
+import profiling
+
+# Число процессов по умолчанию: BATCH_WORKERS или число ядер
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 0)) or os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    """Прогрев процесса: кеш печатей строится один раз на процесс, а не на файл"""
+    import app
+    app.ensure_seal_cache()
+
+
+def _mp_context():
+    """
+    Способ запуска процессов пула: forkserver, где он есть, иначе spawn.
+
+    fork не подходит: пул создаётся лениво в воркере gunicorn, где уже работают потоки
+    запросов, задач и heartbeat, и дочерний процесс может унаследовать блокировку,
+    захваченную другим потоком (sqlite, _pool_lock, кеши печатей), — и зависнуть.
+    Сервер forkserver однопоточный, app загружается в него заранее, и процессы пула
+    получают от него прогретый кеш печатей; при spawn прогрев делает _init_worker.
+    """
+    import multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['app'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _get_pool():
+    """Общий пул на BATCH_WORKERS процессов; пакеты (в том числе фоновые задачи) делят его"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # multiprocessing и пул процессов импортируются при первом пакете, а не при запуске приложения
+            from concurrent.futures import ProcessPoolExecutor
+            _pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=_mp_context(),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def resolve_workers(requested=None):
+    """Число процессов для пакета: запрошенное, но не больше BATCH_WORKERS"""
+    if not requested:
+        return BATCH_WORKERS
+    return max(1, min(int(requested), BATCH_WORKERS))
+
+
+def _safe_call(func, job):
+    try:
+        return func(job)
+    except Exception as e:
+        logging.exception("Batch job failed")
+        return {'ok': False, 'error': str(e)}
+
+
+def _pooled_call(func, job, profile_mode=None):
+    """
+    _safe_call в процессе пула: метрики (и профиль, если запрос профилируется)
+    возвращаются вместе с результатом.
+    """
+    profiler = profiling.Profiler(profile_mode) if profile_mode else None
+    with metrics.capture() as samples:
+        if profiler:
+            profiler.start()
+        try:
+            result = _safe_call(func, job)
+        finally:
+            if profiler:
+                profiler.stop()
+    return result, samples, profiler.data() if profiler else None
+
+
+def iter_batch(func, jobs, workers=None, stats=None, cache=None):
+    """
+    Выполняет func(job) для каждого задания и отдаёт (индекс, результат)
+    по мере готовности — для потоковых ответов.
+
+    func должна быть функцией уровня модуля (передаётся в процессы через pickle)
+    и возвращать dict; исключения превращаются в {'ok': False, 'error': ...}.
+    jobs может быть ленивым итератором: в пул одновременно отправляется
+    не больше workers заданий, поэтому входные файлы не копятся в памяти.
+    cache — объект с lookup(job) -> результат | None и store(job, result):
+    найденные в нём задания не отправляются в пул, успешные результаты сохраняются.
+    Если передан stats (dict), после завершения в него пишется сводка.
+    """
+    workers = resolve_workers(workers)
+    if hasattr(jobs, '__len__'):
+        workers = min(workers, max(len(jobs), 1))
+    started = time.perf_counter()
+    count = 0
+    cache_hits = 0
+
+    def cached(job):
+        nonlocal cache_hits
+        result = cache.lookup(job) if cache is not None else None
+        cache_hits += result is not None
+        return result
+
+    def remember(job, result):
+        if cache is not None and result.get('ok'):
+            cache.store(job, result)
+
+    if workers <= 1:
+        for index, job in enumerate(jobs):
+            count += 1
+            result = cached(job)
+            if result is None:
+                result = _safe_call(func, job)
+                remember(job, result)
+            yield index, result
+    else:
+        from concurrent.futures import FIRST_COMPLETED, wait
+        from concurrent.futures.process import BrokenProcessPool
+
+        # workers ограничивает число одновременно выполняемых заданий этого пакета
+        pool = _get_pool()
+        profiler = profiling.current()
+        profile_mode = profiler.mode if profiler else None
+        source = enumerate(jobs)
+        pending = {}
+        broken = False
+
+        def submit_next():
+            """Отправляет в пул следующее задание; готовые без пула результаты возвращает списком"""
+            nonlocal broken
+            ready = []
+            for index, job in source:
+                result = cached(job)
+                if result is not None:
+                    ready.append((index, result))
+                    continue
+                try:
+                    pending[pool.submit(_pooled_call, func, job, profile_mode)] = (index, job)
+                except BrokenProcessPool as e:
+                    broken = True
+                    ready.append((index, {'ok': False, 'error': f'Worker crashed: {e}'}))
+                break
+            return ready
+
+        try:
+            for _ in range(workers):
+                for ready in submit_next():
+                    count += 1
+                    yield ready
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, job = pending.pop(future)
+                    try:
+                        result, samples, profile = future.result()
+                        metrics.merge(samples)
+                        if profiler:
+                            profiler.add_child(profile)
+                    except BrokenProcessPool as e:
+                        # Процесс упал (например, OOM) — пул пересоздаётся при следующем пакете
+                        broken = True
+                        result = {'ok': False, 'error': f'Worker crashed: {e}'}
+                    except Exception as e:
+                        result = {'ok': False, 'error': str(e)}
+                    remember(job, result)
+                    count += 1
+                    yield index, result
+                    for ready in submit_next():
+                        count += 1
+                        yield ready
+        finally:
+            # Клиент отключился посреди потока — не оставляем задания в очереди пула
+            for future in pending:
+                future.cancel()
+            if broken:
+                _reset_pool()
+
+    if stats is not None:
+        elapsed = time.perf_counter() - started
+        stats.update({
+            'workers': workers,
+            'files': count,
+            'cache_hits': cache_hits,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'files_per_sec': round(count / elapsed, 2) if elapsed > 0 else None,
+        })
+
+
+def run_batch(func, jobs, workers=None, cache=None):
+    """
+    Выполняет func(job) для каждого задания (см. iter_batch).
+
+    Returns:
+        (results, stats) — результаты в порядке jobs и сводка по пропускной способности
+    """
+    results = [None] * len(jobs)
+    stats = {}
+    for index, result in iter_batch(func, jobs, workers, stats, cache):
+        results[index] = result
+    return results, stats
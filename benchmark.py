@@ -0,0 +1,323 @@
+"""
+Бенчмарк конвейера наложения печатей на синтетических документах.
+
+Корпуса генерируются локально (reportlab): обычные страницы, повёрнутые
+на 90/180/270, с ненулевым CropBox и «сканы» с растровым изображением на
+каждой странице. Замеряются:
+
+- stamp_pdf_pages — наложение печати на страницу (ядро всех режимов);
+- add_signature_to_pdf_batch;
+- POST /save-document и POST /batch-stamp через тестовый клиент Flask.
+
+По каждому случаю: пропускная способность, задержки p50/p95/p99 и пиковый
+RSS за этот случай (в Linux счётчик VmHWM сбрасывается перед каждым случаем
+через /proc/self/clear_refs; где это недоступно — ru_maxrss, максимум за всё
+время процесса, см. peak_rss_scope в отчёте). Результаты пишутся в JSON; --compare сравнивает их с прошлым
+прогоном (например, с предыдущего коммита).
+
+    python benchmark.py --pages 1,10,100 --iterations 20 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+"""
+
+import argparse
+import base64
+import gc
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+# Кеш результатов отключаем: иначе все итерации после первой — попадания в кеш
+os.environ.setdefault('RESULT_CACHE_MB', '0')
+os.environ.setdefault('RESULT_CACHE_DISK_MB', '0')
+
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+CORPORA = ('plain', 'rotated', 'cropbox', 'scanned')
+STAGES = ('stamp_pdf_pages', 'add_signature_to_pdf_batch', 'save_document', 'batch_stamp')
+
+
+def make_document(kind, pages, seed=0):
+    """Синтетический PDF (bytes) из pages страниц формата A4"""
+    rng = random.Random(seed)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    width, height = A4
+    for number in range(1, pages + 1):
+        if kind == 'rotated':
+            c.setPageRotation((90, 180, 270)[number % 3])
+        elif kind == 'cropbox':
+            c.setCropBox((36, 48, width - 24, height - 60))
+        if kind == 'scanned':
+            # Растровая «страница» со своим шумом — каждая встраивается отдельно
+            scan = Image.effect_noise((620, 877), 40).point(lambda v: 190 + v // 4)
+            for _ in range(25):
+                y = rng.randrange(60, 800)
+                scan.paste(60, (rng.randrange(40, 90), y, rng.randrange(300, 580), y + 6))
+            jpeg = io.BytesIO()
+            scan.save(jpeg, 'JPEG', quality=60)  # JPEG встраивается как есть (DCTDecode)
+            jpeg.seek(0)
+            c.drawImage(ImageReader(jpeg), 0, 0, width, height)
+        else:
+            c.setFont("Helvetica", 11)
+            for line in range(40):
+                c.drawString(50, height - 60 - line * 18, f"Page {number}, line {line}: " + "lorem ipsum " * 6)
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def percentile(values, q):
+    """Перцентиль с линейной интерполяцией (q в диапазоне 0..100)"""
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def reset_peak_rss():
+    """Сбрасывает пиковый RSS процесса (VmHWM, только Linux); False, если сбросить нельзя"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_mb(field):
+    """Поле /proc/self/status в МБ или None, если /proc нет"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Пиковый RSS в МБ: VmHWM процесса, если есть /proc, иначе ru_maxrss (КБ в Linux, байты в macOS)"""
+    if who == resource.RUSAGE_SELF:
+        peak = _proc_status_mb('VmHWM')
+        if peak is not None:
+            return peak
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages:
+    """Замеряемые операции; каждая принимает байты PDF и возвращает размер результата"""
+
+    def __init__(self, app_module, output_mode, batch_size, workers):
+        self.app = app_module
+        self.client = app_module.app.test_client()
+        self.output_mode = output_mode
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def stamp_pdf_pages(self, pdf_data, pages):
+        app = self.app
+        items = [{"image": app.seal_image('falcon'), "x": app.mm(17.6), "y": app.mm(67.6),
+                  "w": app.mm(46.4), "h": app.mm(35.9)}]
+        return len(app.stamp_pdf_pages(pdf_data, {pages - 1: items}, None, self.output_mode))
+
+    def add_signature_to_pdf_batch(self, pdf_data, pages):
+        return len(self.app.add_signature_to_pdf_batch(pdf_data, None, 'falcon', False, None, self.output_mode))
+
+    def save_document(self, pdf_data, pages):
+        response = self.client.post('/save-document', json={
+            'pdfData': base64.b64encode(pdf_data).decode(),
+            'outputMode': self.output_mode,
+            'seals': [{'pageIndex': pages - 1, 'xPt': 50, 'yPt': 190, 'wPt': 130, 'hPt': 100,
+                       'opacity': 0.95, 'type': 'falcon'}],
+        })
+        body = response.get_json()
+        if response.status_code != 200 or not body.get('success'):
+            raise RuntimeError(f"/save-document: {response.status_code} {body.get('error')}")
+        return len(body['pdfData'])
+
+    def batch_stamp(self, pdf_data, pages):
+        config = {'output_mode': self.output_mode, 'format': 'zip'}
+        if self.workers:
+            config['workers'] = self.workers
+        response = self.client.post('/batch-stamp', data={
+            'config': json.dumps(config),
+            'files': [(io.BytesIO(pdf_data), f'doc{i}.pdf') for i in range(self.batch_size)],
+        }, content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f"/batch-stamp: {response.status_code}")
+        return len(response.get_data())
+
+
+def run_case(func, pdf_data, pages, iterations, warmup):
+    for _ in range(warmup):
+        func(pdf_data, pages)
+    latencies = []
+    output_bytes = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        output_bytes = func(pdf_data, pages)
+        latencies.append((time.perf_counter() - t) * 1000)
+    return latencies, time.perf_counter() - started, output_bytes
+
+
+def run(args):
+    import app as app_module
+    app_module.initialize_seal_cache()
+    stages = Stages(app_module, args.mode, args.batch_size, args.workers)
+
+    results = []
+    for kind in args.corpora:
+        for pages in args.pages:
+            pdf_data = make_document(kind, pages)
+            print(f"📄 {kind}, {pages} стр.: {len(pdf_data) / 1024:.0f} КБ")
+            for stage in args.stages:
+                gc.collect()
+                per_case = reset_peak_rss()
+                # После сброса пик равен текущему RSS — в нём и память, удержанная прошлыми случаями
+                rss_start = _proc_status_mb('VmRSS')
+                try:
+                    latencies, elapsed, output_bytes = run_case(
+                        getattr(stages, stage), pdf_data, pages, args.iterations, args.warmup)
+                except Exception as e:
+                    # Например, 413 на больших сканах — отмечаем случай и идём дальше
+                    print(f"   {stage:<28} ❌ {e}")
+                    results.append({'stage': stage, 'corpus': kind, 'pages': pages,
+                                    'input_bytes': len(pdf_data), 'error': str(e)})
+                    continue
+                docs = args.iterations * (args.batch_size if stage == 'batch_stamp' else 1)
+                result = {
+                    'stage': stage,
+                    'corpus': kind,
+                    'pages': pages,
+                    'input_bytes': len(pdf_data),
+                    'output_bytes': output_bytes,
+                    'iterations': args.iterations,
+                    'docs_per_sec': round(docs / elapsed, 2),
+                    'pages_per_sec': round(docs * pages / elapsed, 1),
+                    'latency_ms': {
+                        'mean': round(sum(latencies) / len(latencies), 2),
+                        'min': round(min(latencies), 2),
+                        'p50': round(percentile(latencies, 50), 2),
+                        'p95': round(percentile(latencies, 95), 2),
+                        'p99': round(percentile(latencies, 99), 2),
+                        'max': round(max(latencies), 2),
+                    },
+                    'peak_rss_mb': peak_rss_mb(),
+                    # case — пик только этого случая; process — максимум с запуска бенчмарка
+                    'peak_rss_scope': 'case' if per_case else 'process',
+                    'rss_start_mb': rss_start,
+                    # Дочерние процессы сбросить нельзя: максимум по всем завершённым
+                    'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+                }
+                results.append(result)
+                lat = result['latency_ms']
+                print(f"   {stage:<28} p50 {lat['p50']:>8.2f} мс  p95 {lat['p95']:>8.2f}  p99 {lat['p99']:>8.2f}"
+                      f"  {result['docs_per_sec']:>7.2f} док/с  RSS {result['peak_rss_mb']} МБ")
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'output_mode': args.mode,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'batch_size': args.batch_size,
+            'workers': args.workers,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Печатает изменение p50/p95 относительно baseline; возвращает число регрессий"""
+    previous = {(r['stage'], r['corpus'], r['pages']): r for r in baseline['results']}
+    regressions = 0
+    print(f"\n📊 Сравнение с {baseline['meta'].get('revision') or 'baseline'} (порог {threshold:.0%}):")
+    for result in report['results']:
+        old = previous.get((result['stage'], result['corpus'], result['pages']))
+        if old is None or 'error' in old or 'error' in result:
+            continue
+        changes = []
+        for key in ('p50', 'p95'):
+            before, after = old['latency_ms'][key], result['latency_ms'][key]
+            ratio = after / before if before else 1.0
+            changes.append(f"{key} {before:.2f} → {after:.2f} мс ({ratio - 1:+.0%})")
+            if key == 'p50' and ratio > 1 + threshold:
+                regressions += 1
+                changes.append("⚠️ регрессия")
+        print(f"   {result['stage']:<28} {result['corpus']:<8} {result['pages']:>4} стр.  " + "  ".join(changes))
+    return regressions
+
+
+def parse_list(value, allowed=None):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    if allowed is not None:
+        unknown = set(items) - set(allowed)
+        if unknown:
+            raise argparse.ArgumentTypeError(f"неизвестные значения: {', '.join(sorted(unknown))}")
+    return items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк наложения печатей")
+    parser.add_argument('--pages', type=lambda v: [int(p) for p in parse_list(v)], default=[1, 10, 100, 500],
+                        help="размеры документов в страницах (через запятую)")
+    parser.add_argument('--corpora', type=lambda v: parse_list(v, CORPORA), default=list(CORPORA),
+                        help=f"типы документов: {', '.join(CORPORA)}")
+    parser.add_argument('--stages', type=lambda v: parse_list(v, STAGES), default=list(STAGES),
+                        help=f"замеряемые операции: {', '.join(STAGES)}")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--mode', choices=('rewrite', 'incremental'), default='rewrite', help="режим сохранения PDF")
+    parser.add_argument('--batch-size', type=int, default=4, help="файлов в одном запросе /batch-stamp")
+    parser.add_argument('--workers', type=int, default=None, help="процессов для /batch-stamp")
+    parser.add_argument('--output', default='benchmark.json', help="куда записать JSON с результатами")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.10, help="допустимый рост p50 при сравнении")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    # Приложение ищет печати по относительным путям static/images
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    report = run(args)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты записаны в {output}")
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
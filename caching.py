@@ -0,0 +1,306 @@
+"""
+Простые потокобезопасные кеши для горячего пути наложения печатей
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    LRU-кеш фиксированного размера со счётчиками попаданий/промахов.
+    С max_bytes значения считаются bytes-подобными и ограничивается их суммарный размер.
+    """
+
+    def __init__(self, maxsize=128, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._size(self._data[key])
+            self._data[key] = value
+            self._bytes += self._size(value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def _size(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def get_or_build(self, key, factory):
+        """Возвращает значение из кеша или строит его через factory() и кладёт в кеш"""
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def items(self):
+        """Снимок содержимого [(ключ, значение)] без изменения порядка вытеснения"""
+        with self._lock:
+            return list(self._data.items())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        """Счётчики для /api/stats"""
+        total = self.hits + self.misses
+        stats = {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+        if self.max_bytes is not None:
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class DiskCache:
+    """
+    Кеш bytes-значений в каталоге: один файл на ключ (ключ — hex-хеш).
+    Каталог может делиться между процессами; порядок вытеснения — по mtime,
+    который обновляется при каждом попадании.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        """(путь, mtime, размер) всех файлов кеша"""
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, st.st_mtime, st.st_size
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем во временный файл и переименовываем: читатели не увидят недописанный файл
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Disk cache write failed: {e}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        with self._lock:
+            self._bytes += len(value)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Пересчитываем по каталогу (его могли менять другие процессы) и чистим до 90% лимита
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._bytes = total
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'directory': self.directory,
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class TieredCache:
+    """Двухуровневый кеш: LRU в памяти процесса поверх общего дискового кеша (disk может быть None)"""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return default if value is None else value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def get_or_build(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        return {
+            'memory': self.memory.stats(),
+            'disk': self.disk.stats() if self.disk is not None else None,
+        }
+
+
+class ArtifactFile:
+    """
+    Версионированный файл готовых артефактов: <directory>/<version>.bin.
+
+    Запись — [(ключ, описание, [блоки bytes])]: ключ — кортеж простых значений,
+    описание — JSON-совместимый словарь. Формат: MAGIC, длина индекса, индекс
+    в JSON, затем блоки подряд. Файл открывается через mmap и блоки отдаются
+    как memoryview без копирования: страницы общие для всех процессов, открывших
+    одну версию, и читаются с диска только при обращении.
+    """
+
+    MAGIC = b'FTARTIFACTS1\n'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._mmap = None  # отображение загруженной версии (держим, пока живут memoryview)
+
+    def path(self, version):
+        return os.path.join(self.directory, f"{version}.bin")
+
+    def load(self, version):
+        """Записи версии version или None, если файла нет или он повреждён"""
+        try:
+            with open(self.path(version), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            header = len(self.MAGIC) + 8
+            if mapped[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("bad magic")
+            (index_length,) = struct.unpack('>Q', mapped[len(self.MAGIC):header])
+            index = json.loads(mapped[header:header + index_length])
+            base = header + index_length
+            data = memoryview(mapped)
+            records = []
+            for entry in index:
+                blobs = []
+                for offset, length in entry['blobs']:
+                    if base + offset + length > len(mapped):
+                        raise ValueError("truncated")
+                    blobs.append(data[base + offset:base + offset + length])
+                records.append((tuple(entry['key']), entry['meta'], blobs))
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            logging.warning(f"Artifact file {self.path(version)} ignored: {e}")
+            return None
+        self._mmap = mapped
+        return records
+
+    def save(self, version, records):
+        """Записывает версию целиком (временный файл + rename) и удаляет остальные версии"""
+        index, blobs, offset = [], [], 0
+        for key, meta, entry_blobs in records:
+            spans = []
+            for blob in entry_blobs:
+                spans.append([offset, len(blob)])
+                blobs.append(blob)
+                offset += len(blob)
+            index.append({'key': list(key), 'meta': meta, 'blobs': spans})
+        index = json.dumps(index, separators=(',', ':')).encode()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.MAGIC + struct.pack('>Q', len(index)) + index)
+                    for blob in blobs:
+                        f.write(blob)
+                os.replace(tmp_path, self.path(version))
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            for name in os.listdir(self.directory):
+                if name.endswith('.bin') and name != f"{version}.bin":
+                    os.unlink(os.path.join(self.directory, name))
+        except OSError as e:
+            logging.warning(f"Artifact file write failed: {e}")
+            return False
+        return True
@@ -0,0 +1,125 @@
+"""
+Геометрия страниц и пересчёт координат печатей.
+
+Координаты печатей приходят в видимой системе страницы: пункты от левого
+нижнего угла так, как страницу показывает просмотрщик (CropBox, /Rotate по
+часовой стрелке). Рисуются печати в user-space страницы. Боксы и поворот
+страницы читаются из PyPDF2 один раз (PageGeometry), а все прямоугольники
+страницы пересчитываются и прижимаются к её границам за один проход:
+преобразование для поворота выбирается один раз на страницу, координаты
+хранятся в плотных массивах array('d').
+"""
+
+from array import array
+from collections import namedtuple
+
+# Размеры MediaBox, /Rotate (0, 90, 180, 270) и CropBox (x0, y0, x1, y1) — всё, что нужно для
+# перевода координат; извлекается из страницы один раз
+PageGeometry = namedtuple('PageGeometry', 'media_width media_height rotate crop')
+
+
+def page_geometry(page):
+    crop = page.cropbox
+    return PageGeometry(float(page.mediabox.width), float(page.mediabox.height),
+                        int(page.get('/Rotate', 0)) % 360,
+                        (float(crop.left), float(crop.bottom), float(crop.right), float(crop.top)))
+
+
+def visual_size(geometry):
+    """Видимый размер страницы в пунктах (CropBox, с учётом /Rotate) — как в редакторе"""
+    x0, y0, x1, y1 = geometry.crop
+    width, height = x1 - x0, y1 - y0
+    if geometry.rotate % 180:
+        width, height = height, width
+    return round(width, 2), round(height, 2)
+
+
+def user_to_visual(geometry, x, y, w, h):
+    """
+    Прямоугольник user-space -> видимый прямоугольник (x, y, w, h) в пунктах от левого
+    нижнего угла страницы — там, где его покажет просмотрщик
+    """
+    x0, y0, x1, y1 = geometry.crop
+    cw, ch = x1 - x0, y1 - y0
+    a, b = x - x0, y - y0
+    if geometry.rotate == 90:
+        return b, cw - a - w, h, w
+    if geometry.rotate == 180:
+        return cw - a - w, ch - b - h, w, h
+    if geometry.rotate == 270:
+        return ch - b - h, a, h, w
+    return a, b, w, h
+
+
+def visual_to_user(geometry, xs, ys, ws, hs):
+    """
+    Видимые прямоугольники (последовательности x, y, w, h) -> user-space, обратное
+    user_to_visual. Для 90°/270° ширина и высота меняются местами. Возвращает четыре array('d').
+    """
+    x0, y0, x1, y1 = geometry.crop
+    cw, ch = x1 - x0, y1 - y0
+    rot = geometry.rotate
+    if rot == 90:
+        return (array('d', [x0 + cw - y - h for y, h in zip(ys, hs)]), array('d', [y0 + x for x in xs]),
+                array('d', hs), array('d', ws))
+    if rot == 180:
+        return (array('d', [x0 + cw - x - w for x, w in zip(xs, ws)]),
+                array('d', [y0 + ch - y - h for y, h in zip(ys, hs)]),
+                array('d', ws), array('d', hs))
+    if rot == 270:
+        return (array('d', [x0 + y for y in ys]), array('d', [y0 + ch - x - w for x, w in zip(xs, ws)]),
+                array('d', hs), array('d', ws))
+    return array('d', [x0 + x for x in xs]), array('d', [y0 + y for y in ys]), array('d', ws), array('d', hs)
+
+
+def size_error(geometry, w, h):
+    """Текст ошибки, если размер печати в user-space недопустим (нулевой или больше двух страниц), иначе None"""
+    pw, ph = geometry.media_width, geometry.media_height
+    if w <= 0 or h <= 0 or w > pw * 2 or h > ph * 2:
+        return f"Invalid size: {(w, h)} for page {(pw, ph)}"
+    return None
+
+
+def clamp(geometry, xs, ys, ws, hs):
+    """
+    Прямоугольники user-space, прижатые к видимой области страницы (CropBox).
+    ValueError — недопустимый размер (см. size_error).
+    """
+    x0, y0, x1, y1 = geometry.crop
+    pw, ph = geometry.media_width, geometry.media_height
+    if ws and (min(ws) <= 0 or min(hs) <= 0 or max(ws) > pw * 2 or max(hs) > ph * 2):
+        raise ValueError(next(filter(None, (size_error(geometry, w, h) for w, h in zip(ws, hs)))))
+    return (array('d', [max(x0, min(x, x1 - w)) for x, w in zip(xs, ws)]),
+            array('d', [max(y0, min(y, y1 - h)) for y, h in zip(ys, hs)]),
+            ws, hs)
+
+
+class Placements:
+    """
+    Печати одной страницы в user-space: изображения и координаты в массивах array('d').
+    Итерация даёт (изображение, x, y, w, h) — в таком виде их принимает StampSession.stamp.
+    """
+
+    __slots__ = ('images', 'x', 'y', 'w', 'h')
+
+    def __init__(self, images, x, y, w, h):
+        self.images = images
+        self.x, self.y, self.w, self.h = x, y, w, h
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        return zip(self.images, self.x, self.y, self.w, self.h)
+
+
+def place(geometry, images, xs, ys, ws, hs):
+    """Видимые прямоугольники печатей страницы -> Placements в user-space (с clamp)"""
+    return Placements(list(images), *clamp(geometry, *visual_to_user(geometry, xs, ys, ws, hs)))
+
+
+def place_items(geometry, items, image=lambda it: it["image"]):
+    """То же для элементов {x, y, w, h, ...}; image(item) — изображение печати"""
+    return place(geometry, [image(it) for it in items],
+                 [it["x"] for it in items], [it["y"] for it in items],
+                 [it["w"] for it in items], [it["h"] for it in items])
@@ -0,0 +1,36 @@
+"""
+Настройки gunicorn (файл подхватывается автоматически: gunicorn app:app).
+
+preload_app: приложение импортируется, а кеши печатей строятся один раз в
+мастер-процессе; воркеры получают их через fork (copy-on-write) и готовы
+к первому запросу сразу, без повторной инициализации в каждом из них.
+Отключается через GUNICORN_PRELOAD=0 (например, вместе с SEAL_CACHE_INIT=lazy).
+
+worker_class gthread: запрос обслуживает поток воркера, поэтому долгие ответы
+(SSE /api/jobs/<id>/events, потоковые /batch-stamp) занимают один поток, а не
+весь воркер. Потоков на воркер — GUNICORN_THREADS, воркеров — WEB_CONCURRENCY
+(как обычно у gunicorn). Готовые результаты, сессии документов и статусы задач лежат
+на диске, общем для воркеров, поэтому запросы можно раскидывать по любым из них.
+"""
+
+import gc
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def when_ready(server):
+    # Объекты, созданные при загрузке, сборщик мусора больше не обходит — страницы
+    # памяти с ними не копируются в воркерах при первой же сборке
+    if preload_app:
+        gc.freeze()
+    server.log.info("Startup: %s", _startup())
+
+
+def _startup():
+    if not preload_app:
+        return "app is loaded in workers"
+    import app
+    return app.startup_info()
@@ -0,0 +1,456 @@
+"""
+Фоновые задачи пакетной обработки и ограниченное хранилище результатов.
+
+- DiskResultStore: готовые PDF в каталоге на диске с лимитами по количеству/объёму
+  и TTL (заменяет периодическую чистку папки uploads). Каталог общий для всех
+  процессов (воркеров gunicorn), поэтому результат, сохранённый одним воркером, отдаёт любой.
+- JobManager: задачи выполняются во внутреннем пуле потоков; прогресс
+  доступен опросом и как поток событий (SSE). С очередью в SQLite (db_path)
+  задания и статусы общие для всех процессов и переживают перезапуск:
+  статус задачи из другого воркера читается из базы, а задачи умершего
+  процесса (без heartbeat) подхватывает один из живых.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class DiskResultStore:
+    """
+    Хранилище результатов в каталоге, общем для процессов: один файл на ключ
+    (имя — sha256 ключа), запись через временный файл и rename. Время жизни
+    отсчитывается от mtime, touch его обновляет; при переполнении удаляются
+    записи с самым старым mtime. Формат файла: длина метаданных (4 байта),
+    метаданные в JSON, данные.
+    """
+
+    def __init__(self, directory, max_items=256, max_bytes=256 * 1024 * 1024, ttl=3600):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def put(self, key, data, meta=None):
+        header = json.dumps(meta or {}, ensure_ascii=False).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('>I', len(header)))
+                f.write(header)
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+        with self._lock:
+            self._purge(limits=True)
+
+    def get(self, key, touch=False):
+        """
+        (data, meta) или None, если записи нет или она устарела.
+        touch=True продлевает время жизни записи (скользящий TTL, как у сессий).
+        """
+        return self._read(key, touch, with_data=True)
+
+    def get_meta(self, key, touch=False):
+        """Только метаданные записи (данные с диска не читаются) или None"""
+        entry = self._read(key, touch, with_data=False)
+        return entry[1] if entry is not None else None
+
+    def _read(self, key, touch, with_data):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expired = os.fstat(f.fileno()).st_mtime + self.ttl < time.time()
+                if not expired:
+                    (length,) = struct.unpack('>I', f.read(4))
+                    meta = json.loads(f.read(length))
+                    data = f.read() if with_data else None
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Result store entry {path} unreadable: {e}")
+            return None
+        if expired:
+            _unlink(path)
+            return None
+        if touch:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        return data, meta
+
+    def delete(self, key):
+        _unlink(self._path(key))
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge()
+
+    def _entries(self):
+        """[(mtime, размер, путь)] записей каталога, от старых к новым"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(entries)
+
+    def _purge(self, limits=False):
+        """Удаляет устаревшие записи (и брошенные временные файлы), с limits — и самые старые сверх лимитов"""
+        deadline = time.time() - self.ttl
+        entries = []
+        for mtime, size, path in self._entries():
+            if mtime < deadline:
+                _unlink(path)
+            elif not path.endswith('.tmp'):
+                entries.append((size, path))
+        if not limits:
+            return
+        count, total = len(entries), sum(size for size, _ in entries)
+        for size, path in entries:
+            if count <= self.max_items and total <= self.max_bytes:
+                break
+            _unlink(path)
+            count -= 1
+            total -= size
+            self.evictions += 1
+
+    def _live(self):
+        deadline = time.time() - self.ttl
+        return [(size, path) for mtime, size, path in self._entries()
+                if mtime >= deadline and not path.endswith('.tmp')]
+
+    def __len__(self):
+        return len(self._live())
+
+    def stats(self):
+        live = self._live()
+        return {
+            'directory': self.directory,
+            'items': len(live),
+            'bytes': sum(size for size, _ in live),
+            'max_items': self.max_items,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            'evictions': self.evictions,
+        }
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class Job:
+    """Состояние одной фоновой задачи"""
+
+    def __init__(self, job_id, total, created_at=None):
+        self.id = job_id
+        self.status = 'queued'
+        self.total = total
+        self.results = []  # записи по файлам в порядке завершения
+        self.error = None
+        self.stats = None
+        self.created_at = created_at or time.time()
+        self.finished_at = None
+        self.version = 0  # растёт при каждом изменении — для SSE
+
+    @property
+    def completed(self):
+        return len(self.results)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'completed': self.completed,
+            'succeeded': sum(1 for r in self.results if r.get('success')),
+            'results': sorted(self.results, key=lambda r: r['index']),
+            'error': self.error,
+            'stats': self.stats,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class _SQLiteQueue:
+    """
+    Очередь задач в SQLite: задания и статусы переживают перезапуск и видны всем процессам.
+    owner — JobManager, который выполняет задачу; он раз в heartbeat обновляет updated_at
+    своих незавершённых задач, поэтому задачу без обновлений можно считать брошенной.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT,"
+                " state TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+            )
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+            if 'owner' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _connect(self):
+        import sqlite3  # нужен только очереди заданий: DiskResultStore создаётся при запуске без него
+        return sqlite3.connect(self.path, timeout=30)
+
+    def enqueue(self, job, payload, owner):
+        # Начальный статус сохраняется сразу: в нём total, посчитанный при постановке задачи
+        with self._lock, self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, payload, state, created_at, updated_at, owner)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.status, json.dumps(payload), json.dumps(job.to_dict()),
+                 job.created_at, job.created_at, owner),
+            )
+
+    def save(self, job):
+        # Полезная нагрузка больше не нужна после завершения — освобождаем место
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, state = ?, updated_at = ?"
+                + (", payload = NULL" if job.finished else "")
+                + " WHERE id = ?",
+                (job.status, json.dumps(job.to_dict()), time.time(), job.id),
+            )
+
+    def heartbeat(self, owner):
+        """Отмечает, что owner жив и выполняет свои задачи"""
+        with self._lock, self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET updated_at = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time(), owner),
+            )
+
+    def claim_stale(self, owner, stale_before):
+        """
+        Забирает незавершённые задачи, которые никто не выполняет (процесс-владелец умер
+        или перезапущен): [(id, payload, state)]. Задачу получает только один процесс.
+        """
+        with self._lock, self._connect() as db:
+            rows = db.execute(
+                "SELECT id, payload, state, updated_at FROM jobs WHERE status IN ('queued', 'running')"
+                " AND (updated_at < ? OR owner IS NULL) ORDER BY created_at",
+                (stale_before,),
+            ).fetchall()
+            claimed = []
+            for job_id, payload, state, updated_at in rows:
+                cursor = db.execute(
+                    "UPDATE jobs SET owner = ?, updated_at = ? WHERE id = ? AND updated_at = ?",
+                    (owner, time.time(), job_id, updated_at),
+                )
+                if cursor.rowcount == 1:
+                    claimed.append((job_id, payload, state))
+            return claimed
+
+    def load(self, job_id):
+        with self._lock, self._connect() as db:
+            row = db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def counts(self):
+        with self._lock, self._connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def delete_older_than(self, timestamp):
+        with self._lock, self._connect() as db:
+            db.execute("DELETE FROM jobs WHERE updated_at < ? AND status IN ('done', 'failed')", (timestamp,))
+
+
+class JobManager:
+    """
+    Запускает runner(job, payload) в фоне. runner сообщает о прогрессе через
+    manager.record(job, result) и может вернуть сводку (stats).
+
+    С db_path статус задачи сохраняется в базе при каждом изменении, поэтому
+    get() и events() работают и для задач, которые выполняет другой процесс.
+    """
+
+    def __init__(self, runner, threads=2, max_jobs=200, ttl=3600, db_path=None, heartbeat=10):
+        from concurrent.futures import ThreadPoolExecutor  # менеджер создаётся при первой фоновой задаче
+        self.runner = runner
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.owner = uuid.uuid4().hex
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='stamp-job')
+        self._queue = _SQLiteQueue(db_path) if db_path else None
+        if self._queue:
+            threading.Thread(target=self._heartbeat_loop, name='stamp-job-heartbeat', daemon=True).start()
+
+    def submit(self, payload, total):
+        job = Job(uuid.uuid4().hex, total)
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        if self._queue:
+            self._queue.enqueue(job, payload, self.owner)
+        self._executor.submit(self._run, job, payload)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._queue:
+            # Задача другого процесса или предыдущего запуска: отдаём сохранённый статус
+            state = self._queue.load(job_id)
+            if state:
+                job = Job(job_id, state['total'], state['created_at'])
+                job.status = state['status']
+                job.results = state['results']
+                job.error = state['error']
+                job.stats = state['stats']
+                job.finished_at = state['finished_at']
+        return job
+
+    def record(self, job, result):
+        """Результат одного файла задачи"""
+        with self._changed:
+            job.results.append(result)
+            job.version += 1
+            self._changed.notify_all()
+        if self._queue:
+            self._queue.save(job)
+
+    def events(self, job_id, heartbeat=15, poll=1.0):
+        """
+        Генератор событий прогресса: ('progress', dict) на каждый файл,
+        ('ping', None) раз в heartbeat секунд и ('done', dict) в конце.
+        Задачу другого процесса опрашивает в базе раз в poll секунд.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            if self.get(job_id) is not None:
+                yield from self._polled_events(job_id, heartbeat, poll)
+            return
+        sent = 0
+        while True:
+            with self._changed:
+                if job.completed <= sent and not job.finished:
+                    self._changed.wait(timeout=heartbeat)
+                new_results = job.results[sent:]
+                finished = job.finished
+            for result in new_results:
+                sent += 1
+                yield 'progress', {'completed': sent, 'total': job.total, 'result': result}
+            if finished and sent >= job.completed:
+                yield 'done', job.to_dict()
+                return
+            if not new_results:
+                yield 'ping', None
+
+    def _polled_events(self, job_id, heartbeat, poll):
+        sent = set()  # индексы файлов: в сохранённом статусе результаты упорядочены по индексу
+        idle = 0.0
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            new_results = [r for r in job.results if r['index'] not in sent]
+            for result in new_results:
+                sent.add(result['index'])
+                yield 'progress', {'completed': len(sent), 'total': job.total, 'result': result}
+            if job.finished:
+                yield 'done', job.to_dict()
+                return
+            if new_results:
+                idle = 0.0
+            elif idle >= heartbeat:
+                yield 'ping', None
+                idle = 0.0
+            time.sleep(poll)
+            idle += poll
+
+    def stats(self):
+        if self._queue:
+            counts = self._queue.counts()
+            return {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')}
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed')}
+
+    def _run(self, job, payload):
+        self._set_status(job, 'running')
+        try:
+            job.stats = self.runner(job, payload)
+            self._set_status(job, 'done')
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            job.error = str(e)
+            self._set_status(job, 'failed')
+
+    def _set_status(self, job, status):
+        with self._changed:
+            job.status = status
+            if job.finished:
+                job.finished_at = time.time()
+            job.version += 1
+            self._changed.notify_all()
+        if self._queue:
+            self._queue.save(job)
+
+    def _heartbeat_loop(self):
+        while True:
+            try:
+                self._queue.heartbeat(self.owner)
+                self._resume()
+            except Exception:
+                logging.exception("Job queue heartbeat failed")
+            time.sleep(self.heartbeat)
+
+    def _resume(self):
+        """Запускает брошенные задачи: прерванные перезапуском или умершим процессом"""
+        for job_id, payload, state in self._queue.claim_stale(self.owner, time.time() - 3 * self.heartbeat):
+            if payload is None:
+                continue
+            payload = json.loads(payload)
+            # total — сохранённый при постановке задачи (submit): не все файлы payload попадают в обработку.
+            # Без статуса — задача поставлена до того, как он стал сохраняться сразу
+            state = json.loads(state) if state else {'total': len(payload.get('files', [])), 'created_at': None}
+            job = Job(job_id, state['total'], state['created_at'])
+            with self._lock:
+                self._jobs[job.id] = job
+            logging.info(f"Resuming job {job_id} from {self._queue.path}")
+            self._executor.submit(self._run, job, payload)
+
+    def _evict(self):
+        """Удаляет завершённые задачи старше TTL и самые старые сверх max_jobs"""
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < now - self.ttl]:
+            del self._jobs[job_id]
+        for job_id in [j.id for j in self._jobs.values() if j.finished][:max(0, len(self._jobs) - self.max_jobs + 1)]:
+            del self._jobs[job_id]
+        if self._queue:
+            self._queue.delete_older_than(now - self.ttl)
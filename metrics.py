@@ -0,0 +1,218 @@
+"""
+Метрики в текстовом формате Prometheus (без prometheus_client).
+
+- Гистограммы длительности этапов обработки (timed/observe_stage).
+- Счётчики документов и страниц по эндпоинтам (count_document) —
+  эндпоинт берётся из set_endpoint() текущего потока.
+- Процессы пула batch_engine не видят реестр основного процесса: там
+  наблюдения собираются через capture() и переносятся в основной
+  процесс через merge().
+
+Значения хранятся в памяти процесса; при нескольких воркерах gunicorn
+каждый отдаёт свои метрики (Prometheus суммирует их по instance).
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм длительности, секунды
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # метки -> [счётчики по корзинам, сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} '
+                                 f'{cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class Gauges:
+    """Группа значений, которые вычисляются при каждом запросе /metrics: collect() -> {метки: значение}"""
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.collect().items()):
+            if value is not None:
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'falcon_stage_duration_seconds', 'Длительность этапов обработки PDF', ['stage']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'falcon_request_duration_seconds', 'Время обработки запроса до начала ответа', ['endpoint']))
+REQUESTS = REGISTRY.register(Counter(
+    'falcon_requests_total', 'Запросы по эндпоинтам и кодам ответа', ['endpoint', 'status']))
+DOCUMENTS = REGISTRY.register(Counter(
+    'falcon_documents_total', 'Обработанные документы', ['endpoint']))
+PAGES = REGISTRY.register(Counter(
+    'falcon_pages_total', 'Страницы в обработанных документах', ['endpoint']))
+BYTES_IN = REGISTRY.register(Counter(
+    'falcon_request_bytes_total', 'Байты тел запросов', ['endpoint']))
+BYTES_OUT = REGISTRY.register(Counter(
+    'falcon_response_bytes_total', 'Байты тел ответов', ['endpoint']))
+
+_local = threading.local()
+
+
+def set_endpoint(endpoint):
+    """Эндпоинт, к которому относятся документы, обработанные в текущем потоке"""
+    _local.endpoint = endpoint
+
+
+def current_endpoint():
+    return getattr(_local, 'endpoint', None) or 'none'
+
+
+def observe_stage(stage, seconds):
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append(('stage', stage, seconds))
+    else:
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def count_document(pages, objects=None, size=None):
+    """Обработанный документ: страницы, число объектов (по xref) и размер исходника в байтах"""
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append(('document', (pages, objects, size), None))
+        return
+    endpoint = current_endpoint()
+    DOCUMENTS.inc(endpoint=endpoint)
+    PAGES.inc(pages, endpoint=endpoint)
+    documents = getattr(_local, 'documents', None)
+    if documents is not None:
+        documents.append({'pages': pages, 'objects': objects, 'bytes': size})
+
+
+def track_documents(documents):
+    """Список, в который дописываются сведения о документах текущего потока (None — не собирать)"""
+    _local.documents = documents
+
+
+@contextmanager
+def capture():
+    """Собирает наблюдения текущего потока в список вместо реестра (для процессов пула)"""
+    samples = []
+    previous = getattr(_local, 'captured', None)
+    _local.captured = samples
+    try:
+        yield samples
+    finally:
+        _local.captured = previous
+
+
+def merge(samples):
+    """Переносит наблюдения из capture() в реестр; документы — на эндпоинт текущего потока"""
+    for kind, value, seconds in samples:
+        if kind == 'stage':
+            observe_stage(value, seconds)
+        else:
+            count_document(*value)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,144 @@
+"""
+Изображения печатей в виде, готовом для вставки в PDF как Image XObject.
+
+Изображение кодируется один раз: RGB и альфа-канал отдельно, Flate — либо
+с PNG-предиктором (данные IDAT из PNG, который PIL сжимает в C с адаптивной
+фильтрацией строк), либо без него, смотря что компактнее для канала.
+Поток встраивается в PDF как есть, без повторного декодирования.
+"""
+
+import hashlib
+import io
+import struct
+import zlib
+from collections import namedtuple
+
+from PyPDF2.generic import DictionaryObject, EncodedStreamObject, NameObject, NumberObject
+from PIL import Image
+
+from caching import LRUCache
+from seal_assets import scale_alpha, trim
+
+# Прозрачность квантуется с этим шагом: на каждую печать не больше 21 варианта
+OPACITY_STEP = 0.05
+
+# rgb/alpha — (сжатые данные, с PNG-предиктором или нет); alpha=None для непрозрачных изображений,
+# digest — идентификатор содержимого для ключей кешей; box — положение изображения в прямоугольнике
+# печати в долях (x0, y0, x1, y1), если прозрачные поля обрезаны (None — занимает его целиком)
+EncodedImage = namedtuple('EncodedImage', 'width height rgb alpha digest box', defaults=(None,))
+
+
+def opacity_bucket(opacity):
+    """Приводит прозрачность к ближайшему шагу OPACITY_STEP в диапазоне [0, 1]"""
+    opacity = min(1.0, max(0.0, float(opacity)))
+    return round(round(opacity / OPACITY_STEP) * OPACITY_STEP, 2)
+
+
+def _png_idat(img, compress_level):
+    """Сжатые строки PNG (конкатенация чанков IDAT) для изображения в режиме RGB или L"""
+    buf = io.BytesIO()
+    img.save(buf, 'PNG', compress_level=compress_level)
+    data = buf.getvalue()
+    pos = 8  # сигнатура PNG
+    idat = []
+    while pos < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        if chunk_type == b'IDAT':
+            idat.append(data[pos + 8:pos + 8 + length])
+        pos += 12 + length
+    return b''.join(idat)
+
+
+def _encode_channel(img, compress_level):
+    """Меньший из вариантов: строки с PNG-фильтрами или просто Flate"""
+    with_predictor = _png_idat(img, compress_level)
+    plain = zlib.compress(img.tobytes(), compress_level)
+    return (with_predictor, True) if len(with_predictor) < len(plain) else (plain, False)
+
+
+def encode_image(img, opacity=1.0, compress_level=6, rgb=None, trim_borders=False):
+    """
+    PIL.Image -> EncodedImage; прозрачность применяется к альфа-каналу через таблицу (в C).
+    rgb — уже закодированный цветовой канал того же изображения (для вариантов прозрачности,
+    с тем же trim_borders). trim_borders — не встраивать прозрачные поля: рамка обрезки
+    считается по исходной альфе, поэтому у всех вариантов прозрачности она одна.
+    """
+    img = img.convert('RGBA')
+    box = None
+    if trim_borders:
+        img, box = trim(img)
+    img = scale_alpha(img, opacity)
+    alpha = img.getchannel('A')
+    has_alpha = alpha.getextrema() != (255, 255)
+
+    if rgb is None:
+        rgb = _encode_channel(img.convert('RGB'), compress_level)
+    alpha = _encode_channel(alpha, compress_level) if has_alpha else None
+    # rgb может быть memoryview из файла артефактов — хеш считается по частям
+    digest = hashlib.sha1(rgb[0])
+    digest.update(alpha[0] if alpha else b'')
+    digest.update(repr(box).encode())
+    return EncodedImage(img.width, img.height, rgb, alpha, digest.hexdigest(), box)
+
+
+def pack_image(encoded):
+    """EncodedImage -> (описание, [блоки]) для caching.ArtifactFile"""
+    meta = {
+        'width': encoded.width,
+        'height': encoded.height,
+        'digest': encoded.digest,
+        'box': encoded.box,
+        'predictors': [encoded.rgb[1]] + ([encoded.alpha[1]] if encoded.alpha else []),
+    }
+    return meta, [encoded.rgb[0]] + ([encoded.alpha[0]] if encoded.alpha else [])
+
+
+def unpack_image(meta, blobs):
+    """Обратное к pack_image; данные каналов остаются memoryview из файла"""
+    channels = list(zip(blobs, meta['predictors']))
+    box = tuple(meta['box']) if meta['box'] else None
+    return EncodedImage(meta['width'], meta['height'], channels[0], channels[1] if len(channels) > 1 else None,
+                        meta['digest'], box)
+
+
+# Закодированные произвольные PNG (не из кеша печатей), ключ — sha1 PNG
+_PNG_CACHE = LRUCache(maxsize=32)
+
+
+def encode_png(png_bytes):
+    key = hashlib.sha1(png_bytes).hexdigest()
+    return _PNG_CACHE.get_or_build(key, lambda: encode_image(Image.open(io.BytesIO(png_bytes))))
+
+
+def _image_stream(width, height, colorspace, colors, channel):
+    data, predictor = channel
+    image = EncodedStreamObject()
+    image[NameObject('/Type')] = NameObject('/XObject')
+    image[NameObject('/Subtype')] = NameObject('/Image')
+    image[NameObject('/Width')] = NumberObject(width)
+    image[NameObject('/Height')] = NumberObject(height)
+    image[NameObject('/ColorSpace')] = NameObject(colorspace)
+    image[NameObject('/BitsPerComponent')] = NumberObject(8)
+    image[NameObject('/Filter')] = NameObject('/FlateDecode')
+    if predictor:
+        parms = DictionaryObject()
+        parms[NameObject('/Predictor')] = NumberObject(15)
+        parms[NameObject('/Colors')] = NumberObject(colors)
+        parms[NameObject('/BitsPerComponent')] = NumberObject(8)
+        parms[NameObject('/Columns')] = NumberObject(width)
+        image[NameObject('/DecodeParms')] = parms
+    image._data = data
+    return image
+
+
+def image_xobject(encoded, add_object):
+    """
+    Строит Image XObject (с SMask, если есть альфа) и возвращает ссылку на него.
+    add_object(obj) -> IndirectObject регистрирует поток в целевом документе.
+    """
+    image = _image_stream(encoded.width, encoded.height, '/DeviceRGB', 3, encoded.rgb)
+    if encoded.alpha is not None:
+        smask = _image_stream(encoded.width, encoded.height, '/DeviceGray', 1, encoded.alpha)
+        del smask['/Type']
+        image[NameObject('/SMask')] = add_object(smask)
+    return add_object(image)
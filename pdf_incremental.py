@@ -0,0 +1,531 @@
+"""
+Инкрементальное сохранение PDF: исходные байты не переписываются,
+в конец файла дописываются только изменённые/новые объекты и новая
+секция xref (PDF 32000-1, 7.5.6). Подписи исходного документа остаются валидными.
+
+CopyThroughWriter — полная перезапись в одну ревизию на той же основе:
+неизменённые объекты копируются побайтно, без разбора и клонирования страниц.
+"""
+
+import hashlib
+import io
+import os
+import re
+import shutil
+import struct
+import zlib
+
+from PyPDF2 import PageObject, PdfReader
+from PyPDF2.generic import (
+    ArrayObject,
+    ByteStringObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    read_object,
+)
+
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_XREF_TYPE_RE = re.compile(rb"/Type\s*/XRef\b")
+_OBJECT_HEADER_RE = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj\b")
+# После endobj должен начинаться следующий объект, секция xref или конец файла
+_AFTER_OBJECT_RE = re.compile(rb"\s*(?:\d+\s+\d+\s+obj|xref|trailer|startxref|%|$)")
+# Ключевое слово stream после словаря потока и конец данных потока. Без \b поиск идёт
+# по литеральному префиксу в разы быстрее; случайное совпадение не пройдёт проверку /Length
+_STREAM_RE = re.compile(rb"stream(?:\r\n|\n|\r)")
+_ENDSTREAM_RE = re.compile(rb"\s*endstream\b")
+_LENGTH_RE = re.compile(rb"/Length\s+(\d+)(?:\s+(\d+)\s+R)?")
+# Словарь линеаризации (первый объект файла) и смещение потока подсказок (/H [смещение длина ...])
+_LINEARIZED_RE = re.compile(rb"/Linearized\b")
+_HINT_OFFSET_RE = re.compile(rb"/H\s*\[\s*(\d+)")
+# Классическая таблица xref: заголовки подсекций "начало число" и записи "смещение поколение n|f"
+_XREF_TOKEN_RE = re.compile(rb"\d+|[nf]")
+
+_INHERITABLE = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+# Окно чтения вокруг заголовка объекта (растёт, пока в него не попадёт конец словаря)
+# и блок копирования объектов: исходник целиком в память не читается
+OBJECT_WINDOW = 1024
+COPY_CHUNK = 1 << 20
+
+
+def page_count(reader):
+    """Число страниц из /Count корня дерева страниц, без обхода всех страниц"""
+    return int(reader.trailer["/Root"].get_object()["/Pages"].get_object()["/Count"])
+
+
+def find_page(reader, index):
+    """
+    Страница по индексу: спуск по дереву /Pages с пропуском поддеревьев по /Count.
+    Разбираются только узлы на пути к странице; унаследованные атрибуты
+    (Resources, MediaBox, CropBox, Rotate) копируются в страницу, как в PdfReader.pages.
+    """
+    node = reader.trailer["/Root"].get_object()["/Pages"].get_object()
+    if not 0 <= index < int(node["/Count"]):
+        raise IndexError(f"Page index out of range: {index}")
+    inherited = {}
+    remaining = index
+    while True:
+        for attr in _INHERITABLE:
+            if attr in node:
+                inherited[attr] = node.raw_get(attr)
+        kids = node["/Kids"]
+        if int(node["/Count"]) == len(kids):
+            # Все потомки — листья: сразу берём нужного, соседей не читаем
+            ref = kids[remaining]
+            kid = ref.get_object()
+            if "/Kids" in kid:
+                break
+            remaining = 0
+        else:
+            for ref in kids:
+                kid = ref.get_object()
+                size = int(kid["/Count"]) if "/Kids" in kid else 1
+                if remaining < size:
+                    break
+                remaining -= size
+            else:
+                break
+        if "/Kids" in kid:
+            node = kid
+            continue
+        for attr, value in inherited.items():
+            if attr not in kid:
+                kid[NameObject(attr)] = value
+        page = PageObject(reader, ref if isinstance(ref, IndirectObject) else None)
+        page.update(kid)
+        return page
+    # Дерево не сходится с /Count — полагаемся на обычный обход
+    return reader.pages[index]
+
+
+class IncrementalUpdateUnsupported(ValueError):
+    """Документ нельзя дописать инкрементально (шифрование, повреждённый хвост)"""
+
+
+class IncrementalWriter:
+    """
+    Копит изменения поверх исходного PDF и дописывает их одной ревизией.
+    Исходник — bytes/memoryview или seekable бинарный файл (например, spooled-файл загрузки).
+    """
+
+    def __init__(self, pdf_source, reader=None):
+        self.original = pdf_source
+        if hasattr(pdf_source, "read"):
+            pdf_source.seek(0, os.SEEK_END)
+            self._length = pdf_source.tell()
+        else:
+            self._length = len(pdf_source)
+        self.reader = reader or PdfReader(pdf_source if hasattr(pdf_source, "read") else io.BytesIO(pdf_source))
+        if self.reader.is_encrypted:
+            raise IncrementalUpdateUnsupported("Incremental update of encrypted PDF is not supported")
+
+        matches = _STARTXREF_RE.findall(self._read(max(0, self._length - 2048), 2048))
+        if not matches:
+            raise IncrementalUpdateUnsupported("startxref not found")
+        self.prev_xref = int(matches[-1])
+        # Исходная таблица — классическая ("xref") или поток перекрёстных ссылок (PDF 1.5+)
+        self.xref_is_stream = self._read(self.prev_xref, 4) != b"xref"
+
+        # В PDF с потоками xref PyPDF2 не всегда переносит /Size в trailer
+        known_ids = [idnum for table in self.reader.xref.values() for idnum in table]
+        known_ids.extend(self.reader.xref_objStm)
+        self._next_id = max([int(self.reader.trailer.get("/Size", 0))] + [i + 1 for i in known_ids])
+        self._objects = {}  # idnum -> (generation, объект)
+
+    def _read(self, offset, size):
+        if hasattr(self.original, "read"):
+            self.original.seek(offset)
+            return self.original.read(size)
+        return bytes(self.original[offset:offset + size])
+
+    def add_object(self, obj):
+        """Регистрирует новый объект и возвращает ссылку на него"""
+        idnum = self._next_id
+        self._next_id += 1
+        self._objects[idnum] = (0, obj)
+        return IndirectObject(idnum, 0, self.reader)
+
+    def update_object(self, ref, obj):
+        """Помечает существующий объект как изменённый"""
+        self._objects[ref.idnum] = (ref.generation, obj)
+
+    def write(self, stream):
+        needs_eol = self._read(self._length - 1, 1) not in (b"\n", b"\r")
+        if hasattr(self.original, "read"):
+            self.original.seek(0)
+            shutil.copyfileobj(self.original, stream)
+        else:
+            stream.write(self.original)
+        if needs_eol:
+            stream.write(b"\n")
+
+        offsets = {}
+        pos = self._length + needs_eol
+        for idnum in sorted(self._objects):
+            generation, obj = self._objects[idnum]
+            buf = io.BytesIO()
+            buf.write(b"%d %d obj\n" % (idnum, generation))
+            obj.write_to_stream(buf, None)
+            buf.write(b"\nendobj\n")
+            offsets[idnum] = (pos, generation)
+            data = buf.getvalue()
+            stream.write(data)
+            pos += len(data)
+
+        trailer = self._trailer()
+        if self.xref_is_stream:
+            self._write_xref_stream(stream, offsets, trailer, pos)
+        else:
+            self._write_xref_table(stream, offsets, trailer, pos)
+
+    def write_bytes(self):
+        out = io.BytesIO()
+        self.write(out)
+        return out.getvalue()
+
+    def _trailer(self):
+        src = self.reader.trailer
+        trailer = DictionaryObject()
+        trailer[NameObject("/Size")] = NumberObject(self._next_id)
+        trailer[NameObject("/Prev")] = NumberObject(self.prev_xref)
+        for key in ("/Root", "/Info"):
+            if key in src:
+                trailer[NameObject(key)] = src.raw_get(key)
+        if "/ID" in src:
+            first = src["/ID"][0]
+            seed = first.original_bytes if hasattr(first, "original_bytes") else bytes(first)
+            revision = hashlib.md5(seed + str(sorted(self._objects)).encode()).digest()
+            trailer[NameObject("/ID")] = ArrayObject([first, ByteStringObject(revision)])
+        return trailer
+
+    @staticmethod
+    def _subsections(ids):
+        """Разбивает отсортированные номера объектов на непрерывные подсекции"""
+        sections = []
+        for idnum in ids:
+            if sections and sections[-1][-1] + 1 == idnum:
+                sections[-1].append(idnum)
+            else:
+                sections.append([idnum])
+        return sections
+
+    def _write_xref_table(self, stream, offsets, trailer, xref_pos):
+        out = [b"xref\n"]
+        for section in self._subsections(sorted(offsets)):
+            out.append(b"%d %d\n" % (section[0], len(section)))
+            for idnum in section:
+                offset, generation = offsets[idnum]
+                out.append(b"%010d %05d n \n" % (offset, generation))
+        stream.write(b"".join(out))
+        stream.write(b"trailer\n")
+        trailer.write_to_stream(stream, None)
+        stream.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
+
+    def _write_xref_stream(self, stream, offsets, trailer, xref_pos):
+        # Поток xref сам является объектом и обязан быть в собственном индексе
+        xref_id = self._next_id
+        trailer[NameObject("/Size")] = NumberObject(xref_id + 1)
+        offsets = dict(offsets)
+        offsets[xref_id] = (xref_pos, 0)
+
+        ids = sorted(offsets)
+        rows = b"".join(struct.pack(">BIH", 1, offsets[i][0], offsets[i][1]) for i in ids)
+        index = ArrayObject()
+        for section in self._subsections(ids):
+            index.extend([NumberObject(section[0]), NumberObject(len(section))])
+
+        xref = EncodedStreamObject()
+        xref.update(trailer)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        xref[NameObject("/Index")] = index
+        xref[NameObject("/Filter")] = NameObject("/FlateDecode")
+        xref._data = zlib.compress(rows)
+
+        stream.write(b"%d 0 obj\n" % xref_id)
+        xref.write_to_stream(stream, None)
+        stream.write(b"\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
+
+
+class CopyThroughWriter(IncrementalWriter):
+    """
+    Полная перезапись в одну ревизию без разбора неизменённых объектов.
+
+    Живые объекты исходника (последние версии из xref) копируются как есть,
+    изменённые и новые сериализуются заново, в конце — одна свежая секция xref
+    без /Prev. Прежние ревизии и замещённые объекты в результат не попадают,
+    как и словарь линеаризации с потоком подсказок: после перезаписи их смещения неверны.
+    Если границы объектов не удаётся надёжно определить, конструктор или write()
+    бросают IncrementalUpdateUnsupported — вызывающий переходит на PdfWriter.
+
+    Исходник не копируется в память: объекты ищутся по окнам вокруг их смещений,
+    а в результат переносятся блоками по COPY_CHUNK (spooled-файл остаётся на диске).
+    """
+
+    def __init__(self, pdf_source, reader=None):
+        super().__init__(pdf_source, reader)
+        head = self._read(0, OBJECT_WINDOW)
+        self._header_end = head.find(b"\n") + 1
+        if not head.startswith(b"%PDF-") or self._header_end <= 0:
+            raise IncrementalUpdateUnsupported("PDF header not found")
+        self._chunks, self._compressed = self._locate_objects()
+
+    def _copy(self, stream, start, end):
+        """Переносит байты исходника [start, end) в stream"""
+        if not hasattr(self.original, "read"):
+            stream.write(memoryview(self.original)[start:end])
+            return
+        self.original.seek(start)
+        while start < end:
+            chunk = self.original.read(min(COPY_CHUNK, end - start))
+            if not chunk:
+                raise IncrementalUpdateUnsupported("Unexpected end of the source PDF")
+            stream.write(chunk)
+            start += len(chunk)
+
+    def _stream_length(self, dictionary):
+        """/Length из словаря потока (bytes); косвенная ссылка разрешается через reader"""
+        match = _LENGTH_RE.search(dictionary)
+        if not match:
+            return None
+        if match.group(2) is None:
+            return int(match.group(1))
+        try:
+            length = self.reader.get_object(IndirectObject(int(match.group(1)), int(match.group(2)), self.reader))
+        except Exception:
+            return None
+        return int(length) if isinstance(length, int) and length >= 0 else None
+
+    def _object_span(self, idnum, generation, offset):
+        """
+        (начало, словарь, конец) объекта, на который указывает xref: словарь — байты
+        от заголовка до endobj или ключевого слова stream, конец — позиция после endobj
+        """
+        size = OBJECT_WINDOW
+        while True:
+            window = self._read(offset, size)
+            header = _OBJECT_HEADER_RE.match(window)
+            if not header or (int(header.group(1)), int(header.group(2))) != (idnum, generation):
+                raise IncrementalUpdateUnsupported(f"Object {idnum} {generation} not found at offset {offset}")
+            first_end = window.find(b"endobj", header.end())
+            keyword = _STREAM_RE.search(window, header.end(), first_end if first_end >= 0 else len(window))
+            # Окно расширяется, пока конец словаря (с переводом строки после stream) не попадёт в него
+            if len(window) < size or (keyword.end() < len(window) if keyword else first_end >= 0):
+                break
+            size *= 4
+        if keyword is None:
+            if first_end < 0:
+                raise IncrementalUpdateUnsupported(f"Cannot find the end of object {idnum} {generation}")
+            dict_end = first_end
+            end = offset + first_end
+        else:
+            # Данные потока могут содержать и endobj, и endstream — пропускаем их по /Length
+            dict_end = keyword.start()
+            length = self._stream_length(window[header.end():dict_end])
+            if length is None:
+                raise IncrementalUpdateUnsupported(f"Wrong /Length of stream {idnum} {generation}")
+            data_end = offset + keyword.end() + length
+            tail = self._read(data_end, 256)
+            closing = _ENDSTREAM_RE.match(tail)
+            end = tail.find(b"endobj", closing.end()) if closing else -1
+            if end < 0:
+                raise IncrementalUpdateUnsupported(f"Wrong /Length of stream {idnum} {generation}")
+            end += data_end
+        if not _AFTER_OBJECT_RE.match(self._read(end + 6, 64)):
+            raise IncrementalUpdateUnsupported(f"Cannot find the end of object {idnum} {generation}")
+        return offset + header.start(1), window[:dict_end], end + 6
+
+    def _xref_table(self, offset):
+        """Классическая секция xref по смещению offset -> ({idnum: запись}, trailer)"""
+        data = bytearray()
+        end = -1
+        while end < 0:
+            chunk = self._read(offset + len(data), 1 << 16)
+            if not chunk:
+                raise IncrementalUpdateUnsupported(f"Trailer of xref section at {offset} not found")
+            data += chunk
+            end = data.find(b"trailer", max(0, len(data) - len(chunk) - 7))
+        tokens = _XREF_TOKEN_RE.findall(data, 4, end)
+        entries = {}
+        i = 0
+        while i < len(tokens):
+            start, count = int(tokens[i]), int(tokens[i + 1])
+            rows = tokens[i + 2:i + 2 + 3 * count]
+            if len(rows) != 3 * count:
+                raise IncrementalUpdateUnsupported(f"Truncated xref section at {offset}")
+            rows = iter(rows)
+            entries.update({idnum: (1 if kind == b"n" else 0, int(field2), int(field3))
+                            for idnum, field2, field3, kind in zip(range(start, start + count), rows, rows, rows)})
+            i += 2 + 3 * count
+        stream = self.reader.stream
+        stream.seek(offset + data.index(b"<<", end))
+        return entries, read_object(stream, self.reader)
+
+    def _xref_stream(self, offset):
+        """Поток xref по смещению offset -> ({idnum: запись}, словарь потока)"""
+        stream = self.reader.stream
+        stream.seek(offset)
+        self.reader.read_object_header(stream)
+        xref = read_object(stream, self.reader)
+        if xref.get("/Type") != "/XRef":
+            raise IncrementalUpdateUnsupported(f"No xref section at offset {offset}")
+        widths = [int(width) for width in xref["/W"]]
+        index = [int(value) for value in xref.get("/Index", [0, xref["/Size"]])]
+        rows = xref.get_data()
+        entries = {}
+        pos = 0
+        for start, count in zip(index[::2], index[1::2]):
+            for idnum in range(start, start + count):
+                fields = []
+                for width in widths[:3]:
+                    fields.append(int.from_bytes(rows[pos:pos + width], "big"))
+                    pos += width
+                # Ширина 0 — значение по умолчанию: тип 1, остальные поля 0
+                entries[idnum] = (fields[0] if widths[0] else 1, fields[1], fields[2])
+        return entries, xref
+
+    def _latest_entries(self):
+        """
+        Действующие записи xref: idnum -> (тип, поле 2, поле 3), как в потоке xref
+        (0 — свободен, 1 — по смещению, 2 — в потоке объектов).
+
+        Секции читаются от новой к старой по /Prev, и побеждает первая запись объекта.
+        На reader.xref опереться нельзя: PyPDF2 оставляет в нём старое смещение объекта,
+        который новая ревизия перенесла в поток объектов, и не помнит свободные
+        записи потоков xref — копия отдала бы устаревшие или удалённые объекты.
+        """
+        latest = {}
+        visited = set()
+        offset = self.prev_xref
+        try:
+            while offset is not None and offset not in visited:
+                visited.add(offset)
+                if self._read(offset, 4) == b"xref":
+                    entries, trailer = self._xref_table(offset)
+                    # Гибридный файл: объекты из потоков объектов перечислены только в /XRefStm
+                    if "/XRefStm" in trailer:
+                        hidden, _ = self._xref_stream(int(trailer["/XRefStm"]))
+                        for idnum, entry in hidden.items():
+                            if entries.get(idnum, (0,))[0] == 0:
+                                entries[idnum] = entry
+                else:
+                    entries, trailer = self._xref_stream(offset)
+                for idnum, entry in entries.items():
+                    latest.setdefault(idnum, entry)
+                offset = int(trailer["/Prev"]) if "/Prev" in trailer else None
+        except IncrementalUpdateUnsupported:
+            raise
+        except Exception as e:
+            raise IncrementalUpdateUnsupported(f"Cannot read xref sections: {e}")
+        return latest
+
+    def _locate_objects(self):
+        """
+        ({idnum: (generation, начало, конец)} для живых несжатых объектов,
+         {idnum: (поток объектов, индекс)} для сжатых)
+        """
+        latest = {}
+        compressed = {}
+        for idnum, (kind, field2, field3) in self._latest_entries().items():
+            if kind == 1:
+                latest[idnum] = (field3, field2)
+            elif kind == 2:
+                compressed[idnum] = (field2, field3)
+
+        chunks = {}
+        linearized = _LINEARIZED_RE.search(self._read(self._header_end, 1024))
+        linearized = self._header_end + linearized.start() if linearized else -1
+        hints = set()
+        for idnum, (generation, offset) in latest.items():
+            start, dictionary, end = self._object_span(idnum, generation, offset)
+            # Старые потоки xref в новый файл не переносим — их заменяет новая секция
+            if _XREF_TYPE_RE.search(dictionary):
+                continue
+            # Словарь линеаризации тоже: после перезаписи документ не линеаризован
+            if offset < linearized < offset + len(dictionary):
+                hint = _HINT_OFFSET_RE.search(dictionary)
+                if hint:
+                    hints.add(int(hint.group(1)))
+                continue
+            chunks[idnum] = (generation, start, end)
+        # На поток подсказок ссылается только /H по смещению — он уходит вместе со словарём
+        return {idnum: chunk for idnum, chunk in chunks.items() if chunk[1] not in hints}, compressed
+
+    def _trailer(self):
+        trailer = super()._trailer()
+        del trailer["/Prev"]
+        return trailer
+
+    def write(self, stream):
+        eol = self._header_end
+        stream.write(self._read(0, eol))
+        stream.write(b"%\xe2\xe3\xcf\xd3\n")
+        pos = eol + 6
+
+        entries = {}  # idnum -> (тип, поле 2, поле 3) как в потоке xref
+        for idnum in sorted(self._chunks, key=lambda i: self._chunks[i][1]):
+            if idnum in self._objects:
+                continue
+            generation, start, end = self._chunks[idnum]
+            entries[idnum] = (1, pos, generation)
+            self._copy(stream, start, end)
+            stream.write(b"\n")
+            pos += end - start + 1
+        for idnum in sorted(self._objects):
+            generation, obj = self._objects[idnum]
+            buf = io.BytesIO()
+            buf.write(b"%d %d obj\n" % (idnum, generation))
+            obj.write_to_stream(buf, None)
+            buf.write(b"\nendobj\n")
+            entries[idnum] = (1, pos, generation)
+            stream.write(buf.getvalue())
+            pos += buf.tell()
+
+        # Объекты внутри потоков объектов остаются на месте, если их контейнер скопирован
+        for idnum, (container, index) in self._compressed.items():
+            if idnum not in entries and container in entries and container not in self._objects:
+                entries[idnum] = (2, container, index)
+
+        trailer = self._trailer()
+        if any(entry[0] == 2 for entry in entries.values()):
+            self._write_full_xref_stream(stream, entries, trailer, pos)
+        else:
+            self._write_full_xref_table(stream, entries, trailer, pos)
+
+    def _write_full_xref_table(self, stream, entries, trailer, xref_pos):
+        size = self._next_id
+        out = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for idnum in range(1, size):
+            if idnum in entries:
+                _, offset, generation = entries[idnum]
+                out.append(b"%010d %05d n \n" % (offset, generation))
+            else:
+                out.append(b"0000000000 00000 f \n")
+        stream.write(b"".join(out))
+        stream.write(b"trailer\n")
+        trailer.write_to_stream(stream, None)
+        stream.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
+
+    def _write_full_xref_stream(self, stream, entries, trailer, xref_pos):
+        xref_id = self._next_id
+        entries = dict(entries)
+        entries[xref_id] = (1, xref_pos, 0)
+        trailer[NameObject("/Size")] = NumberObject(xref_id + 1)
+        rows = [struct.pack(">BIH", 0, 0, 65535)]
+        for idnum in range(1, xref_id + 1):
+            kind, field2, field3 = entries.get(idnum, (0, 0, 0))
+            rows.append(struct.pack(">BIH", kind, field2, field3))
+
+        xref = EncodedStreamObject()
+        xref.update(trailer)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        xref[NameObject("/Filter")] = NameObject("/FlateDecode")
+        xref._data = zlib.compress(b"".join(rows))
+
+        stream.write(b"%d 0 obj\n" % xref_id)
+        xref.write_to_stream(stream, None)
+        stream.write(b"\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
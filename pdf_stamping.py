@@ -0,0 +1,98 @@
+"""
+Наложение печатей на страницы без оверлеев и merge_page.
+
+StampSession обслуживает один выходной документ: каждое изображение печати
+(или векторная печать — Form XObject) встраивается в него один раз, а страницы
+ссылаются на общий XObject из небольшого фрагмента потока содержимого. Размер результата и время
+не растут от числа страниц с одной и той же печатью.
+"""
+
+import zlib
+
+from PyPDF2.generic import ArrayObject, DictionaryObject, EncodedStreamObject, IndirectObject, NameObject
+
+from pdf_images import image_xobject
+from pdf_vector import VectorSeal, form_xobject
+
+
+def _content_stream(data):
+    stream = EncodedStreamObject()
+    stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+    stream._data = zlib.compress(data)
+    return stream
+
+
+class StampSession:
+    """
+    Печати одного документа.
+
+    add_object(obj) -> IndirectObject регистрирует новый объект в выходном документе
+    (PdfWriter._add_object или IncrementalWriter.add_object); update_object(ref, obj),
+    если задан, вызывается для каждой изменённой страницы (нужно инкрементальному режиму).
+    """
+
+    def __init__(self, add_object, update_object=None):
+        self._add_object = add_object
+        self._update_object = update_object
+        self._images = {}  # digest -> ссылка на Image XObject
+        self._save_state = None  # общий для всех страниц поток "q"
+        self.pages_stamped = 0
+
+    def image(self, encoded):
+        """Ссылка на изображение (EncodedImage или VectorSeal) в документе; одинаковые встраиваются один раз"""
+        ref = self._images.get(encoded.digest)
+        if ref is None:
+            build = form_xobject if isinstance(encoded, VectorSeal) else image_xobject
+            ref = self._images[encoded.digest] = build(encoded, self._add_object)
+        return ref
+
+    @property
+    def images_embedded(self):
+        return len(self._images)
+
+    def stamp(self, page, placements):
+        """
+        Рисует изображения на странице, не трогая её исходный поток содержимого.
+        placements: [(EncodedImage | VectorSeal, x, y, w, h)] в user-space страницы; изображение
+        с обрезанными полями (box) рисуется в соответствующей части прямоугольника.
+        """
+        resources = page.raw_get("/Resources").get_object() if "/Resources" in page else DictionaryObject()
+        resources = DictionaryObject(resources)
+        xobjects = resources.raw_get("/XObject").get_object() if "/XObject" in resources else DictionaryObject()
+        xobjects = DictionaryObject(xobjects)
+
+        ops = [b"Q"]
+        counter = 0
+        for encoded, x, y, w, h in placements:
+            name = f"/FTStamp{counter}"
+            while name in xobjects:
+                counter += 1
+                name = f"/FTStamp{counter}"
+            counter += 1
+            xobjects[NameObject(name)] = self.image(encoded)
+            if encoded.box is not None:
+                x0, y0, x1, y1 = encoded.box
+                x, y, w, h = x + w * x0, y + h * y0, w * (x1 - x0), h * (y1 - y0)
+            ops.append(b"q %.4f 0 0 %.4f %.4f %.4f cm %s Do Q" % (w, h, x, y, name.encode()))
+
+        resources[NameObject("/XObject")] = xobjects
+        page[NameObject("/Resources")] = resources
+
+        # Исходное содержимое оборачиваем в q ... Q, чтобы его графическое состояние не влияло на печать
+        if self._save_state is None:
+            self._save_state = self._add_object(_content_stream(b"q\n"))
+        contents = ArrayObject([self._save_state])
+        if "/Contents" in page:
+            original = page.raw_get("/Contents")
+            if isinstance(original, IndirectObject) and isinstance(original.get_object(), ArrayObject):
+                original = original.get_object()
+            if isinstance(original, ArrayObject):
+                contents.extend(original)
+            else:
+                contents.append(original)
+        contents.append(self._add_object(_content_stream(b"\n".join(ops) + b"\n")))
+        page[NameObject("/Contents")] = contents
+
+        if self._update_object is not None:
+            self._update_object(page.indirect_reference, page)
+        self.pages_stamped += 1
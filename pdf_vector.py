@@ -0,0 +1,183 @@
+"""
+Векторные печати: одностраничный PDF (или SVG через svglib, если он
+установлен) встраивается в документ как Form XObject — без растеризации.
+
+Исходник читается один раз: поток содержимого страницы и её ресурсы
+(шрифты, изображения, градиенты) отвязываются от исходного документа и
+хранятся в памяти. Встраивание — копия этих объектов в выходной документ
+(один раз на документ, см. StampSession), а размещение на странице — та же
+матрица cm, что и для растровой печати: /Matrix формы переводит её BBox в
+единичный квадрат.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import zlib
+from collections import namedtuple
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, EncodedStreamObject, FloatObject, IndirectObject,
+                            NameObject, NumberObject, StreamObject)
+
+VECTOR_EXTENSIONS = ('.pdf', '.svg')
+
+# content — несжатый поток содержимого; resources — DictionaryObject, не связанный с исходным документом;
+# bbox — (x0, y0, x1, y1) в единицах исходника; digest — идентификатор для ключей кешей.
+# box — как у EncodedImage: форма всегда занимает прямоугольник печати целиком
+VectorSeal = namedtuple('VectorSeal', 'content resources bbox digest box', defaults=(None,))
+
+
+class VectorSealError(ValueError):
+    """Файл нельзя использовать как векторную печать"""
+
+
+def _detach(obj, memo):
+    """Копия объекта PyPDF2 со всеми вложенными, без ссылок на исходный документ"""
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key not in memo:
+            memo[key] = None  # циклы (например, /Parent) обрываются
+            memo[key] = _detach(obj.get_object(), memo)
+        return memo[key]
+    if isinstance(obj, StreamObject):
+        stream = EncodedStreamObject()
+        for name, value in obj.items():
+            if name != '/Length':
+                stream[NameObject(name)] = _detach(value, memo)
+        stream._data = obj._data
+        return stream
+    if isinstance(obj, DictionaryObject):
+        copy = DictionaryObject()
+        for name, value in obj.items():
+            value = _detach(value, memo)
+            if value is not None:
+                copy[NameObject(name)] = value
+        return copy
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(_detach(value, memo) for value in obj)
+    return obj
+
+
+def _from_pdf(data):
+    reader = PdfReader(io.BytesIO(data))
+    if len(reader.pages) != 1:
+        raise VectorSealError(f"ожидается одна страница, в файле {len(reader.pages)}")
+    page = reader.pages[0]
+    if int(page.get('/Rotate', 0)) % 360:
+        raise VectorSealError("страницы с /Rotate не поддерживаются")
+    contents = page.get_contents()
+    content = contents.get_data() if contents is not None else b''
+    resources = page.raw_get('/Resources') if '/Resources' in page else DictionaryObject()
+    box = page.cropbox
+    bbox = tuple(float(v) for v in (box.left, box.bottom, box.right, box.top))
+    if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+        raise VectorSealError(f"пустой CropBox {bbox}")
+    return content, _detach(resources, {}), bbox
+
+
+def _svg_to_pdf(path):
+    try:
+        from reportlab.graphics import renderPDF
+        from svglib.svglib import svg2rlg
+    except ImportError:
+        raise VectorSealError("для SVG нужен пакет svglib")
+    drawing = svg2rlg(path)
+    if drawing is None:
+        raise VectorSealError("не удалось разобрать SVG")
+    return renderPDF.drawToString(drawing)
+
+
+def load_vector(path):
+    """Файл .pdf или .svg -> VectorSeal"""
+    if path.lower().endswith('.svg'):
+        data = _svg_to_pdf(path)
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    content, resources, bbox = _from_pdf(data)
+    digest = hashlib.sha1(b'vector:' + data).hexdigest()
+    return VectorSeal(content, resources, bbox, digest)
+
+
+_SOURCES = {}
+
+
+def load_vector_source(path):
+    """
+    Векторная печать из файла; читается один раз (повторно — если файл изменился).
+    None, если файла нет или он не подходит (причина пишется в лог).
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _SOURCES.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        seal = load_vector(path)
+    except Exception as e:
+        logging.warning(f"Vector seal {path} ignored: {e}")
+        seal = None
+    _SOURCES[path] = (mtime, seal)
+    return seal
+
+
+def with_opacity(seal, opacity):
+    """Вариант печати с прозрачностью: ExtGState /ca /CA в начале потока формы"""
+    if opacity >= 0.999:
+        return seal
+    resources = DictionaryObject(seal.resources)
+    states = DictionaryObject(resources.get('/ExtGState', DictionaryObject()))
+    name = '/FTAlpha'
+    while name in states:
+        name += 'X'
+    state = DictionaryObject()
+    state[NameObject('/Type')] = NameObject('/ExtGState')
+    state[NameObject('/ca')] = FloatObject(opacity)
+    state[NameObject('/CA')] = FloatObject(opacity)
+    states[NameObject(name)] = state
+    resources[NameObject('/ExtGState')] = states
+    content = name.encode() + b' gs\n' + seal.content
+    digest = hashlib.sha1(f"{seal.digest}:{opacity}".encode()).hexdigest()
+    return seal._replace(content=content, resources=resources, digest=digest)
+
+
+def _attach(obj, add_object, memo):
+    """Копия отвязанного объекта в выходной документ: потоки становятся косвенными объектами"""
+    if isinstance(obj, StreamObject):
+        ref = memo.get(id(obj))
+        if ref is None:
+            stream = EncodedStreamObject()
+            stream._data = obj._data
+            ref = memo[id(obj)] = add_object(stream)
+            for name, value in obj.items():
+                stream[NameObject(name)] = _attach(value, add_object, memo)
+        return ref
+    if isinstance(obj, DictionaryObject):
+        return DictionaryObject({NameObject(name): _attach(value, add_object, memo) for name, value in obj.items()})
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(_attach(value, add_object, memo) for value in obj)
+    return obj
+
+
+def form_xobject(seal, add_object):
+    """
+    Строит Form XObject и возвращает ссылку на него. Как и у Image XObject,
+    форма рисуется в единичном квадрате: размер и положение задаёт cm на странице.
+    """
+    x0, y0, x1, y1 = seal.bbox
+    width, height = x1 - x0, y1 - y0
+    form = EncodedStreamObject()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/FormType')] = NumberObject(1)
+    form[NameObject('/BBox')] = ArrayObject(FloatObject(v) for v in seal.bbox)
+    form[NameObject('/Matrix')] = ArrayObject(FloatObject(v) for v in (
+        1 / width, 0, 0, 1 / height, -x0 / width, -y0 / height))
+    form[NameObject('/Resources')] = _attach(seal.resources, add_object, {})
+    form[NameObject('/Filter')] = NameObject('/FlateDecode')
+    form._data = zlib.compress(seal.content)
+    return add_object(form)
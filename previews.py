@@ -0,0 +1,120 @@
+"""
+Превью страниц для редактора: миниатюры, отрисованные на сервере.
+
+Редактору не нужно разбирать и рисовать весь документ в браузере: он получает
+размеры страниц и запрашивает картинки только видимых страниц. Растеризация —
+через pypdfium2 (необязательная зависимость): без него render_page бросает
+PreviewUnavailable, и редактор рисует страницы сам через pdf.js.
+
+Масштаб квантуется с шагом SCALE_STEP, чтобы вариантов одной страницы в кеше
+было немного.
+
+Для проверки размещения печатей placement_png вырезает из миниатюры область
+с печатями, нарисованными там, где их покажет просмотрщик (см. geometry).
+"""
+
+import io
+import threading
+
+from PIL import Image
+
+SCALE_STEP = 0.05
+MIN_SCALE = 0.05
+MAX_SCALE = 3.0
+
+# pdfium не потокобезопасен — все обращения к нему последовательно
+_PDFIUM_LOCK = threading.Lock()
+
+
+class PreviewUnavailable(RuntimeError):
+    """Растеризация недоступна (не установлен pypdfium2)"""
+
+
+def _pdfium():
+    try:
+        import pypdfium2
+    except ImportError:
+        raise PreviewUnavailable("для превью страниц нужен пакет pypdfium2")
+    return pypdfium2
+
+
+def available():
+    try:
+        _pdfium()
+    except PreviewUnavailable:
+        return False
+    return True
+
+
+def quantize_scale(scale):
+    """Масштаб (пикселей на пункт), приведённый к шагу SCALE_STEP в диапазоне [MIN_SCALE, MAX_SCALE]"""
+    scale = min(MAX_SCALE, max(MIN_SCALE, float(scale)))
+    return round(round(scale / SCALE_STEP) * SCALE_STEP, 2)
+
+
+def union_region(rects, page_size, padding=12.0):
+    """Общий прямоугольник rects с полями padding, обрезанный границами страницы"""
+    width, height = page_size
+    left = max(0.0, min(x for x, _, _, _ in rects) - padding)
+    bottom = max(0.0, min(y for _, y, _, _ in rects) - padding)
+    right = min(width, max(x + w for x, _, w, _ in rects) + padding)
+    top = min(height, max(y + h for _, y, _, h in rects) + padding)
+    return left, bottom, max(0.0, right - left), max(0.0, top - bottom)
+
+
+def placement_png(page_png, scale, page_height, region, stamps, rotation=0, compress_level=3):
+    """
+    Фрагмент миниатюры страницы (PNG при scale) в области region с нарисованными печатями.
+    stamps — [(PIL-изображение печати, видимый прямоугольник, прозрачность, запрошенный
+    прямоугольник или None)]: если печать ляжет не туда, куда её поставили, запрошенное
+    место обводится красным. Печать рисуется в user-space, поэтому на странице с /Rotate
+    она повёрнута вместе со страницей — rotation.
+    """
+    def box(x, y, w, h):
+        return (round(x * scale), round((page_height - y - h) * scale),
+                round((x + w) * scale), round((page_height - y) * scale))
+
+    # Печати рисуются сразу на вырезанном фрагменте — остальная страница не конвертируется
+    left0, top0, right0, bottom0 = box(*region)
+    crop = Image.open(io.BytesIO(page_png)).crop((left0, top0, right0, bottom0)).convert('RGB')
+    for seal, rect, opacity, requested in stamps:
+        left, top, right, bottom = box(*rect)
+        if right - left < 1 or bottom - top < 1:
+            continue
+        size = (right - left, bottom - top) if rotation % 180 == 0 else (bottom - top, right - left)
+        layer = seal.convert('RGBA').resize(size, Image.LANCZOS)
+        if rotation:
+            layer = layer.rotate(-rotation, expand=True)  # /Rotate — по часовой стрелке
+        if opacity < 1.0:
+            layer.putalpha(layer.getchannel('A').point(lambda a: round(a * opacity)))
+        crop.paste(layer, (left - left0, top - top0), layer)  # часть за пределами фрагмента отсекается
+        if requested is not None:
+            from PIL import ImageDraw
+            left, top, right, bottom = box(*requested)
+            ImageDraw.Draw(crop).rectangle((left - left0, top - top0, right - left0, bottom - top0),
+                                           outline=(220, 30, 30), width=2)
+    buf = io.BytesIO()
+    crop.save(buf, 'PNG', compress_level=compress_level)
+    return buf.getvalue()
+
+
+def render_page(pdf_data, index, scale, compress_level=3):
+    """PNG страницы index (0-based) при scale пикселей на пункт; IndexError — нет такой страницы"""
+    pdfium = _pdfium()
+    with _PDFIUM_LOCK:
+        document = pdfium.PdfDocument(bytes(pdf_data))
+        try:
+            if not 0 <= index < len(document):
+                raise IndexError(f"page {index} out of range")
+            page = document[index]
+            try:
+                bitmap = page.render(scale=scale, draw_annots=True, may_draw_forms=True)
+                img = bitmap.to_pil()
+            finally:
+                page.close()
+        finally:
+            document.close()
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'PNG', compress_level=compress_level)
+    return buf.getvalue()
+
@@ -0,0 +1,250 @@
+"""
+Профилирование медленных запросов (по умолчанию выключено).
+
+PROFILE_SLOW_MS > 0 включает режим: запросы к выбранным эндпоинтам
+снимаются профилировщиком, и если запрос оказался дольше порога, профиль
+сохраняется в PROFILE_DIR вместе со сведениями о документах запроса
+(страницы, объекты, размер). Хранится не больше PROFILE_MAX_FILES профилей.
+
+Режимы (PROFILE_MODE):
+- cprofile — cProfile, файл .prof (python -m pstats, snakeviz, gprof2dot);
+- sample — сэмплер стеков раз в PROFILE_SAMPLE_INTERVAL_MS, файл .folded
+  в формате flamegraph.pl / speedscope; накладные расходы заметно ниже.
+
+Задания пакетов, выполняемые в процессах пула batch_engine, профилируются
+там же, и их профиль добавляется к профилю запроса.
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 1.0))  # доля профилируемых запросов
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'falcon_profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+_local = threading.local()
+
+
+def enabled():
+    return PROFILE_SLOW_MS > 0
+
+
+def should_profile():
+    return enabled() and (PROFILE_RATE >= 1 or random.random() < PROFILE_RATE)
+
+
+class StackSampler:
+    """Раз в interval секунд снимает стек потока thread_id; результат — {свёрнутый стек: число сэмплов}"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+
+class _LoadedStats:
+    """Обёртка для pstats.Stats.add: словарь статистики cProfile, полученный из другого процесса"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """Профиль одного запроса (или одного задания в процессе пула)"""
+
+    def __init__(self, mode=None):
+        self.mode = mode if mode in PROFILE_MODES else 'cprofile'
+        self.documents = []  # сведения о документах, заполняются через metrics.track_documents
+        self._children = []
+        self._profile = None
+        self._sampler = None
+        self.started = None
+        self.duration = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == 'sample':
+            self._sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000)
+            self._sampler.start()
+        else:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if self.duration is not None:
+            return self.duration
+        if self._sampler is not None:
+            self._sampler.stop()
+        else:
+            self._profile.disable()
+            self._profile.create_stats()
+        self.duration = time.perf_counter() - self.started
+        return self.duration
+
+    def data(self):
+        """Результат для передачи между процессами (marshal/pickle-совместимый)"""
+        return self._sampler.stacks if self._sampler is not None else self._profile.stats
+
+    def add_child(self, data):
+        if data:
+            self._children.append(data)
+
+    def dump(self, path):
+        """Записывает профиль вместе с профилями процессов пула"""
+        if self._sampler is not None:
+            stacks = Counter(self._sampler.stacks)
+            for child in self._children:
+                stacks.update(child)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        else:
+            import pstats
+            stats = pstats.Stats(self._profile)
+            for child in self._children:
+                stats.add(_LoadedStats(child))
+            stats.dump_stats(path)
+
+
+class ProfileStore:
+    """Каталог профилей: <id>.prof или <id>.folded и <id>.json с описанием; старые удаляются"""
+
+    EXTENSIONS = {'cprofile': '.prof', 'sample': '.folded'}
+
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, profiler, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        # Имя начинается с времени (до миллисекунд): сортировка по имени — по времени создания
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f"{int(now * 1000) % 1000:03d}"
+        profile_id = f"{stamp}-{uuid.uuid4().hex[:8]}"
+        meta = dict(meta, id=profile_id, mode=profiler.mode, filename=profile_id + self.EXTENSIONS[profiler.mode])
+        profiler.dump(os.path.join(self.directory, meta['filename']))
+        with open(os.path.join(self.directory, profile_id + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        self._evict()
+        return meta
+
+    def list(self):
+        """Описания профилей, новые первыми"""
+        profiles = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return profiles
+        for name in sorted((n for n in names if n.endswith('.json')), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def get(self, profile_id):
+        """(описание, путь к файлу профиля) или None"""
+        if not profile_id or os.path.basename(profile_id) != profile_id:
+            return None
+        try:
+            with open(os.path.join(self.directory, profile_id + '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        path = os.path.join(self.directory, meta['filename'])
+        return (meta, path) if os.path.exists(path) else None
+
+    def _evict(self):
+        with self._lock:
+            profiles = self.list()
+            for meta in profiles[self.max_files:]:
+                for name in (meta['id'] + '.json', meta['filename']):
+                    try:
+                        os.unlink(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+
+
+STORE = ProfileStore(PROFILE_DIR, PROFILE_MAX_FILES)
+
+
+def current():
+    """Профиль, который снимается в текущем потоке, или None"""
+    return getattr(_local, 'profiler', None)
+
+
+def begin(mode=None):
+    profiler = Profiler(mode or PROFILE_MODE)
+    _local.profiler = profiler
+    profiler.start()
+    return profiler
+
+
+def end(profiler, meta):
+    """Останавливает профиль; если запрос медленнее порога — сохраняет его. Возвращает описание или None"""
+    if getattr(_local, 'profiler', None) is profiler:
+        _local.profiler = None
+    duration_ms = profiler.stop() * 1000
+    if duration_ms < PROFILE_SLOW_MS:
+        return None
+    documents = profiler.documents
+    meta = dict(
+        meta,
+        duration_ms=round(duration_ms, 1),
+        created_at=time.time(),
+        documents=documents[:100],
+        totals={
+            'documents': len(documents),
+            'pages': sum(d['pages'] for d in documents),
+            'objects': sum(d['objects'] or 0 for d in documents),
+            'bytes': sum(d['bytes'] or 0 for d in documents),
+        },
+    )
+    try:
+        meta = STORE.save(profiler, meta)
+    except OSError as e:
+        logging.warning(f"Could not save profile: {e}")
+        return None
+    logging.info(f"Slow request profiled: {meta['endpoint']} {meta['duration_ms']} ms -> {meta['filename']}")
+    return meta
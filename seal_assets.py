@@ -0,0 +1,148 @@
+"""
+Подготовка изображений печатей: прозрачность, премультипликация, обрезка
+прозрачных полей и масштабирование — всё операциями Pillow над целыми
+каналами (таблицы и преобразования режимов выполняются в C, без Python-циклов
+по пикселям).
+
+Исходники загружаются с диска один раз, производные варианты хранятся в
+ASSET_CACHE по ключу; приложение заполняет его при старте.
+"""
+
+import math
+import os
+
+from PIL import Image
+
+from caching import LRUCache
+
+# Готовые варианты (блоки печатей, масштабированные исходники): ключ -> PIL.Image.
+# Изображения из кеша общие — их нельзя изменять на месте
+ASSET_CACHE = LRUCache(maxsize=64)
+
+_ALPHA_TABLES = {}
+
+
+def alpha_table(opacity):
+    """Таблица 256 значений для умножения альфа-канала на opacity (для Image.point)"""
+    key = round(opacity, 4)
+    table = _ALPHA_TABLES.get(key)
+    if table is None:
+        table = _ALPHA_TABLES[key] = [int(v * opacity) for v in range(256)]
+    return table
+
+
+def scale_alpha(img, opacity):
+    """RGBA с альфа-каналом, умноженным на opacity; при opacity ≈ 1 изображение возвращается как есть"""
+    img = img if img.mode == 'RGBA' else img.convert('RGBA')
+    if opacity >= 0.999:
+        return img
+    r, g, b, a = img.split()
+    return Image.merge('RGBA', (r, g, b, a.point(alpha_table(opacity))))
+
+
+def premultiply(img):
+    """RGBA -> RGBa: цвет, умноженный на альфу (для интерполяции без тёмных ореолов по краям)"""
+    return img.convert('RGBa') if img.mode != 'RGBa' else img
+
+
+def unpremultiply(img):
+    return img.convert('RGBA') if img.mode != 'RGBA' else img
+
+
+def trim_box(img):
+    """Рамка непрозрачной части (left, top, right, bottom) в пикселях или None, если всё прозрачно"""
+    img = img if img.mode in ('RGBA', 'RGBa') else img.convert('RGBA')
+    return img.getchannel('A').getbbox()
+
+
+def trim(img):
+    """
+    Обрезает прозрачные поля. Возвращает (изображение, box), где box — положение
+    обрезанной части в исходном прямоугольнике в долях (x0, y0, x1, y1), ось y вверх,
+    как в PDF; None, если обрезать нечего.
+    """
+    bbox = trim_box(img)
+    if bbox is None or bbox == (0, 0) + img.size:
+        return img, None
+    left, top, right, bottom = bbox
+    width, height = img.size
+    box = (left / width, (height - bottom) / height, right / width, (height - top) / height)
+    return img.crop(bbox), box
+
+
+def resize(img, size):
+    """LANCZOS в премультиплицированном виде; режим результата — как у исходника"""
+    if img.size == tuple(size):
+        return img
+    mode = img.mode
+    resized = premultiply(img.convert('RGBA') if mode != 'RGBa' else img).resize(size, Image.Resampling.LANCZOS)
+    return resized if mode == 'RGBa' else unpremultiply(resized)
+
+
+def fit_size(size, max_width, max_height):
+    """Размер, вписанный в max_width × max_height с сохранением пропорций"""
+    width, height = size
+    scale = min(max_width / width, max_height / height)
+    return int(width * scale), int(height * scale)
+
+
+def fit(img, max_width, max_height):
+    return resize(img, fit_size(img.size, max_width, max_height))
+
+
+def dpi_size(width_pt, height_pt, dpi):
+    """Размер в пикселях для физического размера width_pt × height_pt при заданном DPI"""
+    return max(1, round(width_pt / 72 * dpi)), max(1, round(height_pt / 72 * dpi))
+
+
+def resample_to_dpi(img, width_pt, height_pt, dpi):
+    """Масштабирует изображение под физический размер печати (в пунктах) при заданном DPI"""
+    return resize(img, dpi_size(width_pt, height_pt, dpi))
+
+
+def resolution_tier(source_size, width_pt, height_pt, dpi, max_upscale=1.0, min_pixels=16):
+    """
+    Ступень разрешения для печати размером width_pt × height_pt при заданном DPI.
+
+    Ступени — масштабы исходника 2^(k/2); выбирается ближайшая к нужному масштабу,
+    не больше max_upscale и не меньше min_pixels по меньшей стороне. Близкие размеры
+    печатей получают одну и ту же ступень, поэтому вариантов немного.
+    """
+    width, height = source_size
+    needed = max(width_pt / 72 * dpi / width, height_pt / 72 * dpi / height)
+    tier = round(2 * math.log2(max(needed, 1e-6)))
+    tier = min(tier, math.floor(2 * math.log2(max(max_upscale, 1e-6)) + 1e-9))
+    smallest = min(width, height)
+    return max(tier, math.ceil(2 * math.log2(min(min_pixels, smallest) / smallest)))
+
+
+def tier_size(source_size, tier):
+    """Размер изображения ступени tier (см. resolution_tier)"""
+    scale = 2 ** (tier / 2)
+    return max(1, round(source_size[0] * scale)), max(1, round(source_size[1] * scale))
+
+
+_SOURCES = {}
+
+
+def load_source(path):
+    """
+    Исходное изображение печати в RGBA; читается с диска один раз
+    (повторно — только если файл изменился). None, если файла нет.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _SOURCES.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with Image.open(path) as img:
+        img = img.convert('RGBA')
+    _SOURCES[path] = (mtime, img)
+    return img
+
+
+def asset(key, build):
+    """Вариант из ASSET_CACHE; build() вызывается только при промахе"""
+    return ASSET_CACHE.get_or_build(key, build)
@@ -0,0 +1,206 @@
+"""
+Правила наложения печатей: какие страницы и чем штамповать.
+
+Вместо списка печатей с координатами для каждой страницы документ описывается
+несколькими правилами, например «инициалы на каждой странице, печать с
+подписью на последней»:
+
+    [{"pages": "all", "seal": "falcon", "width": 40, "height": 30,
+      "anchor": "bottom-right", "x": 20, "y": 20},
+     {"pages": "last", "signature": true}]
+
+Поля правила:
+- pages — селектор страниц (по умолчанию "all"): "all", "odd", "even",
+  "first", "last", номер страницы (с 1; отрицательный — с конца), диапазон
+  "2-5" или "3-" (до конца), {"first": N}, {"last": N}, {"range": [2, 5]}
+  или список селекторов (объединение);
+- text — дополнительно оставить только страницы, в тексте которых есть одна
+  из строк (без учёта регистра); true — ключевые слова подписи
+  (SIGNATURE_KEYWORDS, как в find_signature_position);
+- seal ("falcon" | "ip"), signature (блок с подписью), opacity (0..1);
+- x, y, width, height — в единицах unit ("pt" по умолчанию или "mm");
+  x, y — отступ от угла anchor ("bottom-left" по умолчанию, "bottom-right",
+  "top-left", "top-right") видимой страницы. Не заданные — стандартные
+  координаты печати.
+
+plan() вычисляет печати для всех правил сразу: {страница: [(правило, (x, y, w, h))]}
+в видимых координатах — дальше их накладывают за один проход по документу
+(StampSession встраивает каждое изображение один раз).
+"""
+
+import re
+from collections import namedtuple
+
+SIGNATURE_KEYWORDS = ('подпись', 'podpis', 'подпи', 'signature', 'подпис', 'директор', 'заикин')
+
+SEALS = ('falcon', 'ip')
+ANCHORS = ('bottom-left', 'bottom-right', 'top-left', 'top-right')
+UNITS = {'pt': 1.0, 'mm': 72 / 25.4}
+MAX_RULES = 32
+
+_FIELDS = ('pages', 'text', 'seal', 'signature', 'opacity', 'x', 'y', 'width', 'height', 'anchor', 'unit')
+_RANGE = re.compile(r'(\d+)\s*-\s*(\d*)')
+
+# pages — селектор в исходном виде (проверен), text — кортеж строк в нижнем регистре или None;
+# x, y, width, height — в пунктах или None
+Rule = namedtuple('Rule', 'pages text seal signature opacity x y width height anchor')
+
+
+class RuleError(ValueError):
+    """Неверное описание правила"""
+
+
+def _indices(spec, total):
+    """Индексы страниц (0-based, могут выходить за границы) для селектора spec"""
+    if isinstance(spec, bool):
+        raise RuleError(f"Неверный селектор страниц: {spec!r}")
+    if isinstance(spec, int):
+        if spec == 0:
+            raise RuleError("Страницы нумеруются с 1")
+        return [spec - 1] if spec > 0 else [total + spec]
+    if isinstance(spec, str):
+        name = spec.strip().lower()
+        if name == 'all':
+            return range(total)
+        if name == 'odd':
+            return range(0, total, 2)
+        if name == 'even':
+            return range(1, total, 2)
+        if name == 'first':
+            return [0]
+        if name == 'last':
+            return [total - 1]
+        if name.isdigit():
+            return _indices(int(name), total)
+        match = _RANGE.fullmatch(name)
+        if match:
+            start, end = int(match.group(1)), int(match.group(2) or total)
+            if start < 1:
+                raise RuleError("Страницы нумеруются с 1")
+            return range(start - 1, min(end, total))
+    elif isinstance(spec, dict) and len(spec) == 1:
+        (key, value), = spec.items()
+        if key in ('first', 'last') and isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+            return range(min(value, total)) if key == 'first' else range(max(0, total - value), total)
+        if key == 'range' and isinstance(value, list) and len(value) == 2:
+            return _indices(f"{value[0]}-{value[1] if value[1] is not None else ''}", total)
+    elif isinstance(spec, list):
+        return [i for item in spec for i in _indices(item, total)]
+    raise RuleError(f"Неверный селектор страниц: {spec!r}")
+
+
+def _number(spec, name, scale=1.0, minimum=None):
+    value = spec.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise RuleError(f"{name}: ожидается число, получено {value!r}")
+    if minimum is not None and value < minimum:
+        raise RuleError(f"{name}: значение меньше {minimum}")
+    return float(value) * scale
+
+
+def parse_rule(spec):
+    """dict из JSON -> Rule; RuleError, если правило описано неверно"""
+    if not isinstance(spec, dict):
+        raise RuleError(f"Правило должно быть объектом, получено {spec!r}")
+    unknown = set(spec) - set(_FIELDS)
+    if unknown:
+        raise RuleError(f"Неизвестные поля правила: {', '.join(sorted(unknown))}")
+
+    pages = spec.get('pages', 'all')
+    _indices(pages, 1)  # проверка селектора
+
+    text = spec.get('text')
+    if text is True:
+        text = SIGNATURE_KEYWORDS
+    elif isinstance(text, str):
+        text = (text,)
+    elif text is not None and text is not False:
+        if not isinstance(text, list) or not text or not all(isinstance(t, str) and t for t in text):
+            raise RuleError(f"text: ожидается строка, список строк или true, получено {text!r}")
+    text = tuple(t.lower() for t in text) if text else None
+
+    seal = spec.get('seal', 'falcon')
+    if seal not in SEALS:
+        raise RuleError(f"seal: ожидается одно из {', '.join(SEALS)}, получено {seal!r}")
+    anchor = spec.get('anchor', 'bottom-left')
+    if anchor not in ANCHORS:
+        raise RuleError(f"anchor: ожидается одно из {', '.join(ANCHORS)}, получено {anchor!r}")
+    unit = spec.get('unit', 'pt')
+    if unit not in UNITS:
+        raise RuleError(f"unit: ожидается одно из {', '.join(UNITS)}, получено {unit!r}")
+    opacity = _number(spec, 'opacity', minimum=0.0)
+    if opacity is not None and opacity > 1.0:
+        raise RuleError("opacity: значение больше 1")
+
+    scale = UNITS[unit]
+    return Rule(pages, text, seal, bool(spec.get('signature', False)), 1.0 if opacity is None else opacity,
+                _number(spec, 'x', scale), _number(spec, 'y', scale),
+                _number(spec, 'width', scale, minimum=0.01), _number(spec, 'height', scale, minimum=0.01),
+                anchor)
+
+
+def parse_rules(specs):
+    """Список правил из JSON -> [Rule]; RuleError с номером неверного правила"""
+    if not isinstance(specs, list) or not specs:
+        raise RuleError("rules: ожидается непустой список правил")
+    if len(specs) > MAX_RULES:
+        raise RuleError(f"rules: не больше {MAX_RULES} правил")
+    rules = []
+    for number, spec in enumerate(specs, 1):
+        try:
+            rules.append(parse_rule(spec))
+        except RuleError as e:
+            raise RuleError(f"Правило {number}: {e}")
+    return rules
+
+
+def select_pages(rule, total, page_text):
+    """Индексы страниц (0-based, по возрастанию), к которым применяется правило; page_text(i) — текст страницы"""
+    indices = sorted({i for i in _indices(rule.pages, total) if 0 <= i < total})
+    if rule.text is None:
+        return indices
+    return [i for i in indices if any(t in page_text(i).lower() for t in rule.text)]
+
+
+def rule_rect(rule, page_size, default):
+    """Видимый прямоугольник (x, y, w, h) печати правила на странице размером page_size; default — стандартный"""
+    dx, dy, dw, dh = default
+    w = dw if rule.width is None else rule.width
+    h = dh if rule.height is None else rule.height
+    x = dx if rule.x is None else rule.x
+    y = dy if rule.y is None else rule.y
+    width, height = page_size
+    if rule.anchor.endswith('right'):
+        x = width - x - w
+    if rule.anchor.startswith('top'):
+        y = height - y - h
+    return x, y, w, h
+
+
+def plan(rules, total, page_size, page_text, default_rect):
+    """
+    Печати всех правил: {индекс страницы: [(правило, (x, y, w, h))]} в порядке правил
+    (следующее правило рисуется поверх предыдущего).
+
+    page_size(i) — видимый размер страницы, page_text(i) — её текст: каждый запрашивается
+    не больше одного раза на страницу, текст — только для правил с text.
+    default_rect(rule) — стандартный прямоугольник печати правила.
+    """
+    sizes = {}
+    texts = {}
+
+    def cached_text(i):
+        if i not in texts:
+            texts[i] = page_text(i) or ''
+        return texts[i]
+
+    planned = {}
+    for rule in rules:
+        default = default_rect(rule)
+        for index in select_pages(rule, total, cached_text):
+            if index not in sizes:
+                sizes[index] = page_size(index)
+            planned.setdefault(index, []).append((rule, rule_rect(rule, sizes[index], default)))
+    return planned
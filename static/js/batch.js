@@ -110,35 +110,55 @@ function processFilesReliable() {
     // Показываем прогресс
     showProgress('Отправка файлов на сервер...');
 
-    fetch('/batch-stamp', { method: 'POST', body: fd })
+    if (document.getElementById('zipDownload')?.checked) {
+        downloadZip(fd, runBtn);
+        return;
+    }
+
+    // Потоковый ответ NDJSON: каждый файл приходит и скачивается сразу после обработки
+    const total = filesQueue.length;
+    let done = 0;
+    let summary = null;
+    const okItems = [];
+    const bad = [];
+    const downloads = createDownloadQueue();
+
+    fetch('/batch-stamp?stream=ndjson', { method: 'POST', body: fd })
         .then(r => {
             if (!r.ok) {
                 return r.json().then(errorData => {
                     throw new Error('Ошибка сервера: ' + (errorData.error || r.statusText));
                 });
             }
-            return r.json(); // ждём JSON
+            return readNdjson(r, record => {
+                if (record.type === 'summary') {
+                    summary = record;
+                    return;
+                }
+                done++;
+                updateProgress(done, total);
+                if (record.ok) {
+                    okItems.push(record);
+                    downloads.push(record);
+                } else {
+                    bad.push(record);
+                }
+            });
         })
-        .then(res => {
-            if (!res.success) {
-                throw new Error('Ошибка обработки на сервере');
+        .then(() => downloads.drain())
+        .then(() => {
+            if (!summary) {
+                throw new Error('Ответ сервера оборвался');
             }
-            
-            // Скачиваем только успешные файлы
-            const okItems = res.items.filter(it => it.ok);
             if (!okItems.length) {
                 showError('Ни один файл не обработан');
                 return;
             }
             
-            // Скачиваем файлы по одному с паузами
-            downloadFilesSequentially(okItems);
-            
             // Показываем ошибки по неудачным
-            const bad = res.items.filter(it => !it.ok);
             if (bad.length) {
                 console.warn('Ошибки обработки:', bad);
-                showWarning(`Обработано ${okItems.length} из ${res.count} файлов. ${bad.length} файлов с ошибками.`);
+                showWarning(`Обработано ${okItems.length} из ${summary.count} файлов. ${bad.length} файлов с ошибками.`);
             } else {
                 showSuccess(`Обработано ${okItems.length} файлов. Все файлы скачаны.`);
             }
@@ -153,6 +173,81 @@ function processFilesReliable() {
         });
 }
 
+// ZIP-архив: сервер пишет архив по мере обработки, PDF передаются без base64
+function downloadZip(fd, runBtn) {
+    showProgress('Обработка файлов и сборка архива...');
+
+    fetch('/batch-stamp?format=zip&compression=stored', { method: 'POST', body: fd })
+        .then(r => {
+            if (!r.ok) {
+                return r.json().then(errorData => {
+                    throw new Error('Ошибка сервера: ' + (errorData.error || r.statusText));
+                });
+            }
+            return r.blob();
+        })
+        .then(blob => {
+            const url = URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = `stamped_${Date.now()}.zip`;
+            document.body.appendChild(a);
+            a.click();
+            a.remove();
+            setTimeout(() => URL.revokeObjectURL(url), 10000);
+            showSuccess('Архив скачан. Ошибки обработки (если были) перечислены в manifest.json.');
+        })
+        .catch(e => {
+            console.error(e);
+            showError('Ошибка: ' + e.message);
+        })
+        .finally(() => {
+            runBtn.disabled = false;
+            runBtn.innerHTML = '<i class="fas fa-cogs me-2"></i>ОБРАБОТАТЬ ФАЙЛЫ';
+        });
+}
+
+// Читает ответ построчно (NDJSON) и вызывает onRecord для каждой записи
+async function readNdjson(response, onRecord) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (value) {
+            buffer += decoder.decode(value, { stream: true });
+            let newline;
+            while ((newline = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, newline).trim();
+                buffer = buffer.slice(newline + 1);
+                if (line) onRecord(JSON.parse(line));
+            }
+        }
+        if (done) break;
+    }
+    if (buffer.trim()) onRecord(JSON.parse(buffer));
+}
+
+function updateProgress(done, total) {
+    const progressBar = document.getElementById('progressBar');
+    if (progressBar) progressBar.style.width = `${Math.round(done / total * 100)}%`;
+    showProgress(`Обработано ${done} из ${total}...`);
+}
+
+// Очередь скачивания: файлы скачиваются по одному с паузами по мере поступления
+function createDownloadQueue() {
+    let chain = Promise.resolve();
+    return {
+        push(item) {
+            chain = chain.then(() => downloadFilesSequentially([item]))
+                         .then(() => new Promise(resolve => setTimeout(resolve, 250)));
+        },
+        drain() {
+            return chain;
+        }
+    };
+}
+
 function showProgress(message) {
     const progressContainer = document.getElementById('progressContainer');
     const progressText = document.getElementById('progressText');
@@ -0,0 +1,112 @@
+"""
+Потоковая выдача бинарных результатов пакета: ZIP-архив или multipart/mixed.
+Архив пишется по мере готовности файлов и не собирается целиком в памяти.
+"""
+
+import json
+import uuid
+import zipfile
+from urllib.parse import quote
+
+ZIP_COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+
+class _ChunkSink:
+    """Файлоподобный приёмник без seek/tell: zipfile пишет в него с data descriptor'ами"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _unique_name(name, used):
+    """Не допускает повторяющихся имён внутри архива: a.pdf, a (2).pdf, ..."""
+    if name not in used:
+        used.add(name)
+        return name
+    stem, dot, ext = name.rpartition('.')
+    if not dot:
+        stem, ext = name, ''
+    n = 2
+    while True:
+        candidate = f"{stem} ({n}).{ext}" if dot else f"{stem} ({n})"
+        if candidate not in used:
+            used.add(candidate)
+            return candidate
+        n += 1
+
+
+def iter_zip(entries, compression='stored'):
+    """
+    entries: итератор (имя, bytes | None, метаданные dict).
+    Файлы с данными кладутся в архив, в конце добавляется manifest.json
+    со всеми записями (в том числе ошибками). Отдаёт куски архива.
+    """
+    if compression not in ZIP_COMPRESSION:
+        raise ValueError(f"Unknown compression: {compression} (expected one of {', '.join(ZIP_COMPRESSION)})")
+
+    sink = _ChunkSink()
+    manifest = []
+    used = set()
+    with zipfile.ZipFile(sink, 'w', compression=ZIP_COMPRESSION[compression]) as zf:
+        for name, data, meta in entries:
+            record = dict(meta)
+            if data is not None:
+                record['filename'] = _unique_name(name, used)
+                # PDF уже сжат внутри, deflate даёт немного — поэтому по умолчанию stored
+                zf.writestr(record['filename'], data)
+            manifest.append(record)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    yield sink.drain()
+
+
+def new_boundary():
+    return f"falcon-{uuid.uuid4().hex}"
+
+
+def iter_multipart(entries, boundary):
+    """
+    entries: итератор (имя, bytes | None, метаданные dict).
+    Каждый успешный файл — бинарная часть application/pdf, ошибки — части application/json.
+    """
+    for name, data, meta in entries:
+        if data is not None:
+            headers = (
+                f"--{boundary}\r\n"
+                f"Content-Type: application/pdf\r\n"
+                f"Content-Disposition: attachment; filename*=UTF-8''{quote(name, safe='')}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"X-Result: {json.dumps(meta, ensure_ascii=True)}\r\n\r\n"
+            )
+            yield headers.encode('utf-8')
+            yield data
+            yield b"\r\n"
+        else:
+            body = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+            headers = (
+                f"--{boundary}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n"
+            )
+            yield headers.encode('utf-8')
+            yield body
+            yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+import batch_engine
+
+# Блокировка, которую держит другой поток основного процесса в момент создания пула
+LOCK = threading.Lock()
+
+
+def locked_job(job):
+    with LOCK:
+        return {'ok': True, 'value': job * 2}
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(batch_engine, 'BATCH_WORKERS', 2)
+    batch_engine._reset_pool()
+    yield
+    batch_engine._reset_pool()
+
+
+def test_pool_not_forked_from_threaded_process(pool):
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with LOCK:
+            held.set()
+            release.wait(60)
+
+    holder = threading.Thread(target=hold, daemon=True)
+    holder.start()
+    held.wait()
+    try:
+        # При fork процесс пула унаследовал бы захваченную LOCK и завис
+        assert batch_engine._get_pool()._mp_context.get_start_method() != 'fork'
+        results = dict(batch_engine.iter_batch(locked_job, [1, 2, 3], workers=2))
+    finally:
+        release.set()
+        holder.join()
+    assert results == {0: {'ok': True, 'value': 2}, 1: {'ok': True, 'value': 4}, 2: {'ok': True, 'value': 6}}
@@ -0,0 +1,36 @@
+import io
+
+import pytest
+
+import app
+import benchmark
+from caching import LRUCache, TieredCache
+from jobs import DiskResultStore
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'documents')
+    monkeypatch.setattr(app, 'DOCUMENT_SESSIONS', DiskResultStore(directory))
+    monkeypatch.setattr(app, 'PREVIEW_CACHE', TieredCache(LRUCache(max_bytes=1 << 20)))
+    return directory
+
+
+def test_session_opened_in_other_worker(stores, monkeypatch):
+    client = app.app.test_client()
+    pdf = benchmark.make_document('text', 2)
+    response = client.post('/api/documents', data={'file': (io.BytesIO(pdf), 'doc.pdf')},
+                           content_type='multipart/form-data')
+    doc = response.get_json()
+
+    # Другой воркер: свой экземпляр хранилища над тем же каталогом
+    monkeypatch.setattr(app, 'DOCUMENT_SESSIONS', DiskResultStore(stores))
+    seals = [{'pageIndex': 1, 'xPt': 50, 'yPt': 60, 'wPt': 100, 'hPt': 80}]
+    placements = client.post(doc['placements_url'] + '?image=0', json={'seals': seals}).get_json()
+    assert placements['success'] and placements['placements'][0]['matches']
+
+    response = client.post(doc['save_url'], json={'seals': seals})
+    assert response.status_code == 200 and response.data.startswith(b'%PDF-')
+    assert response.headers['Content-Disposition'].endswith('doc_stamped.pdf')
+
+    assert client.post('/api/documents/0123456789abcdef/save', json={'seals': seals}).status_code == 404
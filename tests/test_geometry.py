@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+import geometry
+from geometry import PageGeometry
+
+
+def legacy_visual_to_user(g, x, y, w, h):
+    """Прежний пересчёт: ветки 90/270 перепутаны, поворот от MediaBox, clamp к MediaBox"""
+    pw, ph, rot = g.media_width, g.media_height, g.rotate
+    if rot == 90:
+        nx, ny, nw, nh = y, pw - (x + w), h, w
+    elif rot == 180:
+        nx, ny, nw, nh = pw - (x + w), ph - (y + h), w, h
+    elif rot == 270:
+        nx, ny, nw, nh = ph - (y + h), x, h, w
+    else:
+        nx, ny, nw, nh = x, y, w, h
+    nx += g.crop[0]
+    ny += g.crop[1]
+    nx = max(0.0, min(nx, pw - nw))
+    ny = max(0.0, min(ny, ph - nh))
+    return nx, ny, nw, nh
+
+
+GEOMETRIES = [
+    PageGeometry(595.0, 842.0, rotate, crop)
+    for rotate in (0, 90, 180, 270)
+    for crop in ((0.0, 0.0, 595.0, 842.0), (30.0, 40.0, 565.0, 800.0))
+]
+
+
+def place_one(g, x, y, w, h):
+    (_, nx, ny, nw, nh), = geometry.place(g, [None], [x], [y], [w], [h])
+    return nx, ny, nw, nh
+
+
+@pytest.mark.parametrize('g', GEOMETRIES, ids=lambda g: f"rot{g.rotate}-crop{int(g.crop[0])}")
+def test_stamp_lands_where_requested(g):
+    # Печать внутри видимой страницы просмотрщик показывает ровно там, где её поставили
+    width, height = geometry.visual_size(g)
+    rng = random.Random(g.rotate)
+    for _ in range(200):
+        w, h = rng.uniform(10, 200), rng.uniform(10, 200)
+        rect = (rng.uniform(0, width - w), rng.uniform(0, height - h), w, h)
+        assert geometry.user_to_visual(g, *place_one(g, *rect)) == pytest.approx(rect)
+
+
+@pytest.mark.parametrize('g', [g for g in GEOMETRIES if g.rotate in (0, 180) and not g.crop[0]],
+                         ids=lambda g: f"rot{g.rotate}")
+def test_unrotated_uncropped_pages_unchanged(g):
+    rect = (50.0, 60.0, 100.0, 80.0)
+    assert place_one(g, *rect) == pytest.approx(legacy_visual_to_user(g, *rect))
+
+
+def test_rotated_page_old_vs_new():
+    g = PageGeometry(595.0, 842.0, 90, (0.0, 0.0, 595.0, 842.0))
+    rect = (50.0, 60.0, 100.0, 80.0)
+    old = legacy_visual_to_user(g, *rect)
+    new = place_one(g, *rect)
+    assert old == pytest.approx((60.0, 445.0, 80.0, 100.0))
+    assert new == pytest.approx((455.0, 50.0, 80.0, 100.0))
+    # Прежний вариант просмотрщик показывал в другом углу страницы
+    assert geometry.user_to_visual(g, *old) == pytest.approx((445.0, 455.0, 100.0, 80.0))
+    assert geometry.user_to_visual(g, *new) == pytest.approx(rect)
+
+
+def test_cropped_page_old_vs_new():
+    g = PageGeometry(595.0, 842.0, 0, (30.0, 40.0, 565.0, 800.0))
+    # Печать у правого края: прежде прижималась к MediaBox и выходила за CropBox
+    rect = (600.0, 10.0, 100.0, 50.0)
+    assert legacy_visual_to_user(g, *rect) == pytest.approx((495.0, 50.0, 100.0, 50.0))
+    assert place_one(g, *rect) == pytest.approx((465.0, 50.0, 100.0, 50.0))
+
+
+def test_rendered_position_on_rotated_page():
+    pdfium = pytest.importorskip('pypdfium2')
+    import app
+    import benchmark
+    from PIL import ImageChops
+
+    pdf = benchmark.make_document('rotated', 2)
+    stamped = app.stamp_pdf_pages(pdf, {i: [{'image': app.seal_image('falcon'), 'x': 50, 'y': 60, 'w': 100, 'h': 100}]
+                                        for i in range(2)})
+    for i in range(2):
+        before = pdfium.PdfDocument(pdf)[i].render(scale=1).to_pil().convert('L')
+        after = pdfium.PdfDocument(stamped)[i].render(scale=1).to_pil().convert('L')
+        left, top, right, bottom = ImageChops.difference(before, after).getbbox()
+        height = after.size[1]
+        # Изображение печати обрезано по содержимому — оно внутри запрошенного прямоугольника
+        assert 48 <= left and right <= 152
+        assert height - 162 <= top and bottom <= height - 58
+
+
+def test_invalid_size_rejected():
+    with pytest.raises(ValueError, match='Invalid size'):
+        geometry.place(GEOMETRIES[0], [None], [0], [0], [0], [10])
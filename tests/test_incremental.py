@@ -0,0 +1,152 @@
+import io
+import os
+import tracemalloc
+
+import pytest
+from PyPDF2 import PdfReader
+
+from pdf_incremental import COPY_CHUNK, CopyThroughWriter, IncrementalUpdateUnsupported
+
+# Поток страницы содержит строки, похожие на конец объекта и потока
+CONTENT = b"% endstream\nendobj\n9 0 obj\nBT /F1 12 Tf 72 720 Td (endobj) Tj ET\n"
+
+
+def build_pdf(objects):
+    """PDF из тел объектов {номер: bytes} с таблицей xref"""
+    out = io.BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = out.tell()
+        out.write(b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n")
+    xref = out.tell()
+    size = max(objects) + 1
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+    for number in range(1, size):
+        out.write(b"%010d 00000 n \n" % offsets[number] if number in offsets else b"0000000000 00000 f \n")
+    out.write(b"trailer\n<< /Size %d /Root 2 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref))
+    return out.getvalue()
+
+
+def document(length=b"5 0 R", linearized=False, extra=None):
+    objects = {
+        2: b"<< /Type /Catalog /Pages 3 0 R >>",
+        3: b"<< /Type /Pages /Kids [4 0 R] /Count 1 >>",
+        4: b"<< /Type /Page /Parent 3 0 R /MediaBox [0 0 612 792] /Contents 7 0 R >>",
+        5: b"%d" % len(CONTENT),
+        7: b"<< /Length " + length + b" >>\nstream\n" + CONTENT + b"\nendstream",
+        **(extra or {}),
+    }
+    if not linearized:
+        return build_pdf(objects)
+    # Словарь линеаризации — первый объект, /H указывает на поток подсказок (объект 6)
+    objects[1] = b"<< /Linearized 1 /L 0 /H [0000000000 16] /O 4 /E 0 /N 1 /T 0 >>"
+    objects[6] = b"<< /Length 4 >>\nstream\nHINT\nendstream"
+    data = build_pdf(objects)
+    return data.replace(b"0000000000 16]", b"%010d 16]" % data.index(b"6 0 obj"))
+
+
+def copy_through(data):
+    out = io.BytesIO()
+    CopyThroughWriter(data).write(out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('length', [b"5 0 R", b"%d" % len(CONTENT)], ids=['indirect', 'direct'])
+def test_stream_with_endobj_copied_whole(length):
+    result = copy_through(document(length))
+    page = PdfReader(io.BytesIO(result)).pages[0]
+    assert page.get_contents().get_data() == CONTENT
+
+
+def test_file_source_copied_in_chunks(tmp_path):
+    blob = os.urandom(8 * COPY_CHUNK)
+    data = document(extra={6: b"<< /Length %d >>\nstream\n" % len(blob) + blob + b"\nendstream"})
+    source = tmp_path / 'in.pdf'
+    source.write_bytes(data)
+
+    with open(source, 'rb') as f, open(tmp_path / 'out.pdf', 'wb') as out:
+        reader = PdfReader(f)
+        tracemalloc.start()
+        try:
+            CopyThroughWriter(f, reader).write(out)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    # Исходник не читается в память целиком: в пике — пара блоков копирования
+    assert peak < 3 * COPY_CHUNK
+    assert (tmp_path / 'out.pdf').read_bytes() == copy_through(data)
+
+
+def test_wrong_length_falls_back():
+    with pytest.raises(IncrementalUpdateUnsupported):
+        CopyThroughWriter(document(b"%d" % (len(CONTENT) - 3)))
+
+
+def test_linearization_dropped():
+    data = document(linearized=True)
+    reader = PdfReader(io.BytesIO(data))
+    assert reader.get_object(6).get_data() == b"HINT"
+    assert b"/Linearized" in data
+
+    result = copy_through(data)
+    assert b"/Linearized" not in result and b"HINT" not in result
+    page = PdfReader(io.BytesIO(result)).pages[0]
+    assert page.get_contents().get_data() == CONTENT
+
+
+def append_update(data, objects=None, compressed=None, free=(), xref_stream=True):
+    """
+    Дописывает ревизию: новые объекты {номер: тело}, сжатые в поток объектов 8 {номер: тело}
+    и свободные номера free; секция xref — потоком (объект 9) или классической таблицей.
+    """
+    out = io.BytesIO(data)
+    out.seek(0, io.SEEK_END)
+    prev = int(data[data.rindex(b"startxref") + 9:].split()[0])
+    entries = {number: (0, 0, 1) for number in free}
+    for number, body in sorted((objects or {}).items()):
+        entries[number] = (1, out.tell(), 0)
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    if compressed:
+        header = b" ".join(b"%d 0" % number for number in compressed) + b" "
+        bodies = b" ".join(compressed.values())
+        entries[8] = (1, out.tell(), 0)
+        out.write(b"8 0 obj\n<< /Type /ObjStm /N %d /First %d /Length %d >>\nstream\n"
+                  % (len(compressed), len(header), len(header) + len(bodies)) + header + bodies + b"\nendstream\nendobj\n")
+        entries.update({number: (2, 8, i) for i, number in enumerate(compressed)})
+    xref = out.tell()
+    if xref_stream:
+        entries[9] = (1, xref, 0)
+        index = b" ".join(b"%d 1" % number for number in sorted(entries))
+        rows = b"".join(bytes([kind]) + field2.to_bytes(4, "big") + field3.to_bytes(2, "big")
+                        for kind, field2, field3 in (entries[n] for n in sorted(entries)))
+        out.write(b"9 0 obj\n<< /Type /XRef /Size 10 /Root 2 0 R /Prev %d /W [1 4 2] /Index [%s] /Length %d >>\nstream\n"
+                  % (prev, index, len(rows)) + rows + b"\nendstream\nendobj\n")
+    else:
+        out.write(b"xref\n")
+        for number in sorted(entries):
+            kind, field2, field3 = entries[number]
+            out.write(b"%d 1\n%010d %05d %s \n" % (number, field2, field3, b"n" if kind else b"f"))
+        out.write(b"trailer\n<< /Size 10 /Root 2 0 R /Prev %d >>\n" % prev)
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref)
+    return out.getvalue()
+
+
+def test_object_moved_to_object_stream_copied_latest():
+    # Ревизия с потоком xref переносит страницу (уже с /Rotate 90) в поток объектов
+    page = b"<< /Type /Page /Parent 3 0 R /MediaBox [0 0 612 792] /Contents 7 0 R /Rotate 90 >>"
+    data = append_update(document(extra={1: b"null", 6: b"null"}), compressed={4: page})
+    assert PdfReader(io.BytesIO(data)).pages[0]["/Rotate"] == 90
+
+    result = copy_through(data)
+    assert PdfReader(io.BytesIO(result)).pages[0]["/Rotate"] == 90
+    assert result.count(b"/Type /Page ") == 1
+
+
+@pytest.mark.parametrize('xref_stream', [True, False], ids=['xref-stream', 'xref-table'])
+def test_freed_object_not_restored(xref_stream):
+    data = append_update(document(extra={6: b"(deleted)"}), free=(6,), xref_stream=xref_stream)
+
+    result = copy_through(data)
+    assert b"(deleted)" not in result
+    assert PdfReader(io.BytesIO(result)).pages[0].get_contents().get_data() == CONTENT
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+from jobs import DiskResultStore, Job, JobManager, _SQLiteQueue
+
+
+def test_disk_store_shared_between_instances(tmp_path):
+    # Два экземпляра над одним каталогом — как два воркера gunicorn
+    writer = DiskResultStore(str(tmp_path), ttl=60)
+    reader = DiskResultStore(str(tmp_path), ttl=60)
+    writer.put('upload/a.pdf', b'%PDF-data', {'filename': 'a.pdf'})
+    assert reader.get('upload/a.pdf') == (b'%PDF-data', {'filename': 'a.pdf'})
+    assert reader.get('upload/missing.pdf') is None
+    reader.delete('upload/a.pdf')
+    assert writer.get('upload/a.pdf') is None
+
+
+def test_disk_store_ttl_and_touch(tmp_path):
+    store = DiskResultStore(str(tmp_path), ttl=60)
+    store.put('old', b'1')
+    store.put('kept', b'2')
+    past = time.time() - 120
+    for key in ('old', 'kept'):
+        os.utime(store._path(key), (past, past))
+    assert store.get('old') is None
+    assert not os.path.exists(store._path('old'))
+
+    os.utime(store._path('kept'), (time.time() - 50, time.time() - 50))
+    assert store.get('kept', touch=True) is not None
+    assert os.path.getmtime(store._path('kept')) > time.time() - 5
+
+
+def test_disk_store_limits(tmp_path):
+    store = DiskResultStore(str(tmp_path), max_items=2, max_bytes=100, ttl=60)
+    for i, key in enumerate(('a', 'b', 'c')):
+        store.put(key, b'x' * 10)
+        os.utime(store._path(key), (time.time() - 10 + i, time.time() - 10 + i))
+    store.put('d', b'x' * 10)
+    assert store.get('a') is None and store.get('b') is None
+    assert len(store) == 2
+    store.put('big', b'x' * 95)
+    assert store.stats()['bytes'] <= 100
+
+
+def _runner(started, release):
+    def run(job, payload):
+        for index in range(payload['count']):
+            manager = run.manager
+            manager.record(job, {'index': index, 'success': True})
+            started.set()
+            release.wait(5)
+        return {'files': payload['count']}
+    return run
+
+
+def test_job_visible_from_other_manager(tmp_path):
+    db = str(tmp_path / 'jobs.sqlite3')
+    started, release = threading.Event(), threading.Event()
+    runner = _runner(started, release)
+    owner = JobManager(runner, db_path=db)
+    runner.manager = owner
+    other = JobManager(runner, db_path=db)
+
+    job = owner.submit({'count': 2}, total=2)
+    assert started.wait(5)
+    remote = other.get(job.id)
+    assert remote.status == 'running' and remote.completed == 1
+
+    events = other.events(job.id, poll=0.05)
+    assert next(events) == ('progress', {'completed': 1, 'total': 2, 'result': {'index': 0, 'success': True}})
+    release.set()
+    rest = list(events)
+    assert [e for e, _ in rest] == ['progress', 'done']
+    assert rest[-1][1]['status'] == 'done' and rest[-1][1]['completed'] == 2
+    assert other.stats()['done'] == 1
+
+
+def test_stale_job_claimed_once(tmp_path):
+    db = str(tmp_path / 'jobs.sqlite3')
+    queue = _SQLiteQueue(db)
+    queue.enqueue(Job('dead', 1, time.time() - 100), {'count': 1}, 'gone')
+    # updated_at старше порога: владелец не присылал heartbeat
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = 'dead'", (time.time() - 100,))
+    first = queue.claim_stale('a', time.time() - 30)
+    second = queue.claim_stale('b', time.time() - 30)
+    assert [row[0] for row in first] == ['dead'] and second == []
+
+    queue.enqueue(Job('alive', 1), {'count': 1}, 'c')
+    assert queue.claim_stale('a', time.time() - 30) == []
+
+
+def test_resumed_job_keeps_submitted_total(tmp_path):
+    db = str(tmp_path / 'jobs.sqlite3')
+    # Как в /api/batch-process: файлы с pdfData не-строкой не обрабатываются и в total не входят
+    payload = {'files': [{'pdfData': 'a'}, {'pdfData': None}, {'pdfData': 'b'}]}
+    queue = _SQLiteQueue(db)
+    queue.enqueue(Job('dead', 2, time.time() - 100), payload, 'gone')
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = 'dead'", (time.time() - 100,))
+
+    def run(job, payload):
+        files = [f for f in payload['files'] if isinstance(f['pdfData'], str)]
+        for index in range(len(files)):
+            manager.record(job, {'index': index, 'success': True})
+
+    manager = JobManager(run, db_path=db)
+    manager._resume()
+    deadline = time.time() + 5
+    while not (manager.get('dead') and manager.get('dead').finished) and time.time() < deadline:
+        time.sleep(0.02)
+    state = manager.get('dead').to_dict()
+    assert state['status'] == 'done'
+    assert state['total'] == state['completed'] == 2
@@ -0,0 +1,29 @@
+import io
+
+from PyPDF2 import PageObject, PdfReader
+
+import app
+import benchmark
+import stamp_rules
+
+
+def stamped_pages(pdf):
+    return [i for i, page in enumerate(PdfReader(io.BytesIO(pdf)).pages)
+            if '/XObject' in page['/Resources']]
+
+
+def test_text_rule_treats_failed_extraction_as_empty(monkeypatch):
+    pdf = benchmark.make_document('plain', 3)
+    assert stamped_pages(pdf) == []
+    extract_text = PageObject.extract_text
+
+    def extract_text_failing_on_page_2(page, *args, **kwargs):
+        text = extract_text(page, *args, **kwargs)
+        if text.startswith('Page 2,'):
+            raise KeyError('/Font')
+        return text
+
+    monkeypatch.setattr(PageObject, 'extract_text', extract_text_failing_on_page_2)
+    rules = stamp_rules.parse_rules([{'pages': 'all', 'text': 'lorem'}])
+    for mode in ('rewrite', 'incremental'):
+        assert stamped_pages(app.stamp_pdf_rules(pdf, rules, output_mode=mode)) == [0, 2]
@@ -0,0 +1,67 @@
+import io
+
+import pytest
+from PyPDF2 import PdfReader
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import app
+
+import benchmark
+from uploads import EOF_SCAN_CHUNK, InflightBudget, check_pdf_bytes, pdf_stream_error
+
+
+@pytest.fixture(scope='module')
+def pdf():
+    return benchmark.make_document('text', 2)
+
+
+@pytest.mark.parametrize('padding', [b'\0' * 2048, b'\0' * (3 * EOF_SCAN_CHUNK + 7), b'\r\n \n'])
+def test_trailing_padding_accepted(pdf, padding):
+    data = pdf + padding
+    assert len(PdfReader(io.BytesIO(data)).pages) == 2  # PyPDF2 такой файл читает
+    check_pdf_bytes(data)
+    stream = io.BytesIO(data)
+    stream.seek(5)
+    assert pdf_stream_error(stream) is None
+    assert stream.tell() == 5
+
+
+def test_marker_on_chunk_boundary(pdf):
+    # %%EOF разрезан границей блоков при чтении с конца
+    data = pdf + b'\0' * (EOF_SCAN_CHUNK - 2)
+    assert pdf_stream_error(io.BytesIO(data)) is None
+
+
+def test_truncated_and_not_pdf(pdf):
+    truncated = pdf[:pdf.rindex(b'%%EOF')]
+    with pytest.raises(ValueError, match='%%EOF'):
+        check_pdf_bytes(truncated)
+    assert '%%EOF' in pdf_stream_error(io.BytesIO(truncated + b'\0' * 100000))
+    with pytest.raises(ValueError, match='%PDF'):
+        check_pdf_bytes(b'hello %%EOF')
+
+
+class RecordingBudget(InflightBudget):
+    def __init__(self):
+        super().__init__(total_bytes=1 << 30, client_bytes=1 << 30)
+        self.clients = []
+
+    def acquire(self, size, client):
+        self.clients.append(client)
+        return super().acquire(size, client)
+
+
+@pytest.mark.parametrize('hops, expected', [(0, '10.0.0.1'), (1, '203.0.113.7')], ids=['direct', 'one-proxy'])
+def test_forwarded_for_not_trusted_beyond_proxies(pdf, monkeypatch, hops, expected):
+    budget = RecordingBudget()
+    monkeypatch.setattr(app, 'UPLOAD_BUDGET', budget)
+    if hops:
+        monkeypatch.setattr(app.app, 'wsgi_app', ProxyFix(app.app.wsgi_app, x_for=hops))
+    client = app.app.test_client()
+    # Левая запись подставлена клиентом, правую добавил прокси
+    headers = {'X-Forwarded-For': '1.2.3.4, 203.0.113.7'}
+    for _ in range(2):
+        client.post('/upload', data={'file': (io.BytesIO(pdf), 'a.pdf')}, headers=headers,
+                    environ_base={'REMOTE_ADDR': '10.0.0.1'}, content_type='multipart/form-data')
+        headers['X-Forwarded-For'] = '5.6.7.8, 203.0.113.7'
+    assert budget.clients == [expected, expected]
@@ -0,0 +1,122 @@
+"""
+Ограничение памяти под загрузки.
+
+- InflightBudget — бюджет байт тел запросов, которые обрабатываются
+  одновременно: общий на процесс и на одного клиента. Запрос, которому не
+  хватает общего бюджета, ждёт освобождения до wait секунд (backpressure),
+  затем получает 503; клиент, превысивший свою долю, сразу получает 429.
+  В обоих случаях с Retry-After.
+- pdf_stream_error / check_pdf_bytes — быстрая проверка заголовка %PDF и
+  маркера %%EOF до полного разбора документа. Маркер, как и в PyPDF2, ищется
+  с конца по всему файлу: после него бывает мусор (например, выравнивание
+  нулями), и такие файлы PyPDF2 читает.
+"""
+
+import io
+import os
+import threading
+import time
+
+# Заголовок ищется в первом килобайте; маркер конца — с конца файла блоками по EOF_SCAN_CHUNK
+PDF_PROBE_BYTES = 1024
+EOF_SCAN_CHUNK = 64 * 1024
+EOF_MARKER = b'%%EOF'
+
+
+class BudgetExceeded(Exception):
+    """Запрос не помещается в бюджет: status — 429 или 503, retry_after — секунды"""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class InflightBudget:
+    def __init__(self, total_bytes, client_bytes, wait=2.0, retry_after=5):
+        self.total_bytes = total_bytes
+        self.client_bytes = client_bytes
+        self.wait = wait
+        self.retry_after = retry_after
+        self.in_use = 0
+        self.rejected = {429: 0, 503: 0}
+        self._clients = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, size, client):
+        """
+        Резервирует size байт для клиента client. Возвращает токен для release()
+        или бросает BudgetExceeded.
+        """
+        size = min(size, self.total_bytes)  # запрос больше бюджета ждёт, пока остальные не закончатся
+        deadline = time.monotonic() + self.wait
+        with self._cond:
+            if self._clients.get(client, 0) + size > self.client_bytes and self._clients.get(client):
+                self.rejected[429] += 1
+                raise BudgetExceeded(429, "Слишком много одновременных загрузок с этого адреса", self.retry_after)
+            while self.in_use + size > self.total_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected[503] += 1
+                    raise BudgetExceeded(503, "Сервер перегружен загрузками, повторите позже", self.retry_after)
+                self._cond.wait(remaining)
+            self.in_use += size
+            self._clients[client] = self._clients.get(client, 0) + size
+        return size, client
+
+    def release(self, token):
+        size, client = token
+        with self._cond:
+            self.in_use -= size
+            left = self._clients.get(client, 0) - size
+            if left > 0:
+                self._clients[client] = left
+            else:
+                self._clients.pop(client, None)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_use_bytes': self.in_use,
+                'max_bytes': self.total_bytes,
+                'client_max_bytes': self.client_bytes,
+                'clients': len(self._clients),
+                'rejected': dict(self.rejected),
+            }
+
+
+def _stream_has_eof(stream, size):
+    """Есть ли в потоке маркер %%EOF; блоки читаются с конца (обычно хватает одного)"""
+    end = size
+    overlap = len(EOF_MARKER) - 1
+    while end > 0:
+        start = max(0, end - EOF_SCAN_CHUNK)
+        stream.seek(start)
+        # Блоки перекрываются, чтобы не пропустить маркер на их границе
+        if EOF_MARKER in stream.read(min(size, end + overlap) - start):
+            return True
+        end = start
+    return False
+
+
+def pdf_stream_error(stream):
+    """Текст ошибки, если поток не похож на целый PDF, иначе None; позиция потока сохраняется"""
+    position = stream.tell()
+    try:
+        stream.seek(0)
+        if b'%PDF-' not in stream.read(PDF_PROBE_BYTES):
+            return "Файл не является PDF: нет заголовка %PDF"
+        if not _stream_has_eof(stream, stream.seek(0, os.SEEK_END)):
+            return "PDF повреждён или загружен не полностью: нет маркера %%EOF"
+        return None
+    finally:
+        stream.seek(position)
+
+
+def check_pdf_bytes(data):
+    """ValueError, если данные не похожи на целый PDF"""
+    # BytesIO поверх bytes не копирует буфер
+    error = pdf_stream_error(io.BytesIO(data))
+    if error:
+        raise ValueError(error)